@@ -1,10 +1,16 @@
 #include "ds.h"
+#include "kernels.h"
 #include "kmeans.h"
+#include "linear_tree.h"
 #include "morton.h"
+#include "particles.h"
+#include "pm.h"
+#include "time_utils.h"
 #include "types.h"
 #include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #ifdef _OPENMP
 #include <omp.h>
 #endif
@@ -15,97 +21,325 @@
 static const double COINCIDENT_EPS      = 1e-9;
 static const double DOMAIN_PADDING_FRAC = 0.05;
 static const int    ARENA_NODE_FACTOR   = 100;
-#define CHUNK_SIZE 128
+static const int    PAR_CELLS_PER_THREAD = 16;
+static const int    PAR_MAX_DEPTH     = 6;
+static const size_t POOL_BLOCK_NODES  = 1024;
+static const int    COM_TASK_DEPTH    = 4;
+static const int    WALK_GROUP_SIZE   = 16;
+static const int    GROUP_LIST_INIT   = 1024;
+static const int    DUAL_TASK_DEPTH   = 5;
+static const int    SPLIT_DEFAULT_GRID = 256;
+static const double SPLIT_CUTOFF      = 4.5;  /* short-range cutoff in split scales */
+static const double REFIT_MAX_GROWTH  = 0.1;  /* rebuild once cells widen by more */
+#define CHUNK_SIZE  128
+#define SPLIT_TABLE 1024
 
 /* Pre-allocated node pool, reused every timestep */
-static NodeArena arena   = {NULL, 0, 0};
-static int       arena_N = 0;
+static NodeArena arena = {NULL, 0, 0};
+
+/* Flat tree and the sorted Morton codes it is built from */
+static LinearTree ltree        = {NULL, 0, 0};
+static uint64_t*  morton_codes = NULL;
+static int        codes_N      = 0;
+
+/* Depth-first packed copy of the pointer tree */
+static PackedNode* packed       = NULL;
+static size_t      packed_cap   = 0;
+static int         n_packed     = 0;
+
+/* Structure-of-arrays view of the pointer tree */
+static WalkView view = {NULL, NULL, NULL, NULL, NULL, NULL, 0, 0};
+
+/* Quadrupole moments of the pointer tree, indexed like the arena */
+static CellQuadrupole* cell_quad = NULL;
+static size_t          quad_cap  = 0;
+
+/* Cell radii and local fields of the dual walk, indexed like the arena */
+static double*    cell_radius = NULL;
+static CellLocal* cell_local  = NULL;
+static size_t     dual_cap    = 0;
+
+/* TreePM short-range factor on [0, split_cut], rebuilt with the scale */
+static double split_table[SPLIT_TABLE + 2];
+static double split_scale = 0.0;
+static double split_cut   = 0.0;
+static double split_step  = 0.0;
+
+/* Tree kept across steps in refit mode */
+static TNode* tree_root = NULL;
+static int    tree_N    = 0;
+
+/* Totals gathered by one refit pass */
+typedef struct {
+    int    count;      /* particles found in leaves */
+    double cell_size;  /* summed geometric widths of internal nodes */
+    double box_size;   /* summed refitted widths of internal nodes */
+} RefitSum;
 
 /* Shared within each timestep */
 static double G_val     = 0.0;
 static double theta_val = 0.0;
+static int    com_on_insert = 1;  /* else internal nodes are filled by accumulate_com */
+static ForceKernel kernel_fn = NULL;  /* batched leaf and interaction-list sums */
+static int    use_quad  = 0;  /* accepted cells add their quadrupole term */
+static int    force_store = FORCE_STORE_FORCE;
 
 static int    is_leaf(TNode* node);
 static int    quadrant(double px, double py, double mx, double my);
 static void   init_domain(const double* x, const double* y, int N,
                           double* x_min, double* x_max,
                           double* y_min, double* y_max);
-static void   expand_domain_if_needed(const double* x, const double* y, int N,
+static int    expand_domain_if_needed(const double* x, const double* y, int N,
                                       double* x_min, double* x_max,
                                       double* y_min, double* y_max);
-static TNode* create_node(double LB, double RB, double DB, double UB);
-static void   insert(TNode* node, int idx, ParticleSystem* sys);
+static TNode* create_node(NodeArena* pool, double LB, double RB, double DB,
+                          double UB);
+static TNode* create_child(NodeArena* pool, TNode* node, int q);
+static void   reorder_particles(ParticleSystem* sys, KernelConfig* config,
+                                double LB, double RB, double DB, double UB,
+                                uint64_t* codes);
+static void   insert(TNode* node, int idx, ParticleSystem* sys, NodeArena* pool);
+static void   accumulate_com(TNode* node, int depth);
+static void   prepare_quadrupole(size_t max_nodes);
+static void   accumulate_quadrupole(TNode* node, int depth);
+static void   refit_node(TNode* node, const ParticleSystem* sys, double LB,
+                         double RB, double DB, double UB, int depth,
+                         RefitSum* sum);
+static int    refit_tree(TNode* root, const ParticleSystem* sys, double LB,
+                         double RB, double DB, double UB, int n_threads);
+static TNode* build_tree_serial(ParticleSystem* sys, double LB, double RB,
+                                double DB, double UB, int n_threads);
+static TNode* build_tree_parallel(ParticleSystem* sys, double LB, double RB,
+                                  double DB, double UB, int n_threads);
 static void   compute_force_single(int i, ParticleSystem* sys, TNode* root,
                                    double* res_fx, double* res_fy);
+static void   compute_force_linear(int i, ParticleSystem* sys,
+                                   const LinearTree* tree,
+                                   double* res_fx, double* res_fy);
+static void   pack_tree(TNode* root, size_t max_nodes);
+static void   compute_force_packed(int i, ParticleSystem* sys,
+                                   double* res_fx, double* res_fy);
+static void   build_walk_view(TNode* root, size_t max_nodes);
+static void   compute_force_view(int i, ParticleSystem* sys,
+                                 double* res_fx, double* res_fy);
+static void   compute_force_group(int lo, int hi, ParticleSystem* sys,
+                                  double* fx_out, double* fy_out,
+                                  InteractionList* list);
+static void   prepare_dual(size_t max_nodes);
+static void   accumulate_radius(TNode* node, int depth);
+static void   dual_interact(TNode* b, TNode* a, int depth);
+static void   compute_force_dual(int i, ParticleSystem* sys, TNode* root,
+                                 double* res_fx, double* res_fy);
+static void   init_split(double r_split);
+static void   compute_force_short(int i, ParticleSystem* sys, TNode* root,
+                                  double* res_fx, double* res_fy);
+
+static inline size_t node_id(const TNode* node) {
+    return (size_t)(node - arena.buffer);
+}
 
 void compute_force_barnes_hut(ParticleSystem* sys, KernelConfig* config) {
     int N = sys->N;
     const double* x = sys->pos_x;
     const double* y = sys->pos_y;
-    double* fx_out  = sys->fx;
-    double* fy_out  = sys->fy;
+    double t_start = sim_time_now();
 
     static int    domain_initialized = 0;
     static int    domain_N           = 0;
     static double x_min = 0.0, x_max = 0.0, y_min = 0.0, y_max = 0.0;
 
+    int domain_changed = 1;
     if (!domain_initialized || domain_N != N) {
         init_domain(x, y, N, &x_min, &x_max, &y_min, &y_max);
         domain_initialized = 1;
         domain_N = N;
     } else {
-        expand_domain_if_needed(x, y, N, &x_min, &x_max, &y_min, &y_max);
+        domain_changed = expand_domain_if_needed(x, y, N, &x_min, &x_max,
+                                                 &y_min, &y_max);
     }
 
-    /* Reorder particles for better cache locality during tree traversal */
-    if (config->k_clusters > 0) {
-        static int*   clusters            = NULL;
-        static int*   c_size              = NULL;
-        static int    last_N              = 0, last_k = 0;
-        static double last_recluster_time = -1.0;
-        static const double RECLUSTER_INTERVAL = 1e-4;
-
-        if (!clusters || last_N < N) {
-            free(clusters);
-            clusters = (int*)malloc(N * sizeof(int));
-            last_N   = N;
+    int linear = (config->tree_build == TREE_BUILD_LINEAR);
+    int treepm = (config->pm_split > 0.0);
+    if ((linear || treepm) && (morton_codes == NULL || codes_N != N)) {
+        free(morton_codes);
+        morton_codes = (uint64_t*)malloc(N * sizeof(uint64_t));
+        if (!morton_codes) {
+            fprintf(stderr, "Error: Morton code allocation failed!\n");
+            exit(1);
         }
-        if (!c_size || last_k < config->k_clusters) {
-            free(c_size);
-            c_size = (int*)malloc(config->k_clusters * sizeof(int));
-            last_k = config->k_clusters;
+        codes_N = N;
+    }
+
+    /* A kept tree indexes particles by array position, so the particles
+     * are only reordered when it is about to be rebuilt. */
+    int reuse = config->tree_reuse == TREE_REUSE_REFIT && tree_root &&
+                tree_N == N && !domain_changed;
+    if (!reuse)
+        reorder_particles(sys, config, x_min, x_max, y_min, y_max,
+                          linear || treepm ? morton_codes : NULL);
+
+    /* Reordering may have swapped in the back buffers */
+    double* fx_out = sys->fx;
+    double* fy_out = sys->fy;
+
+    G_val     = G_FACTOR / N;
+    theta_val = config->theta_max;
+    com_on_insert = (config->tree_com != TREE_COM_BOTTOM_UP);
+    kernel_fn     = force_kernel_select(config->force_kernel);
+    use_quad      = (config->multipole == MULTIPOLE_QUADRUPOLE);
+    force_store   = config->force_store;
+    double t_ordered = sim_time_now();
+    config->stats.order_time += t_ordered - t_start;
+
+    if (linear) {
+        linear_tree_build(&ltree, sys, morton_codes, x_max - x_min,
+                          config->leaf_size);
+        double t_built = sim_time_now();
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, CHUNK_SIZE) num_threads(config->n_threads)
+#endif
+        for (int i = 0; i < N; i++) {
+            if (particle_active(sys, config, i))
+                compute_force_linear(i, sys, &ltree, &fx_out[i], &fy_out[i]);
         }
-        if (last_recluster_time < 0.0 ||
-            config->current_time - last_recluster_time >= RECLUSTER_INTERVAL) {
-            kmeans(sys, clusters, c_size, config->k_clusters, config->n_threads);
-            last_recluster_time = config->current_time;
+        config->stats.tree_time  += t_built - t_ordered;
+        config->stats.force_time += sim_time_now() - t_built;
+        return;
+    }
+
+    TNode* root = NULL;
+    if (reuse) {
+        if (refit_tree(tree_root, sys, x_min, x_max, y_min, y_max,
+                       config->n_threads)) {
+            root = tree_root;
+            config->stats.refits++;
+        } else {
+            reorder_particles(sys, config, x_min, x_max, y_min, y_max, NULL);
+            fx_out = sys->fx;
+            fy_out = sys->fy;
         }
-    } else {
-        z_order_sort(sys, x_min, x_max, y_min, y_max);
     }
 
-    /* Allocate (or resize) the arena once; reset it each timestep */
-    if (arena.buffer == NULL || arena_N != N) {
-        if (arena.buffer) free_arena(&arena);
-        init_arena(&arena, N * ARENA_NODE_FACTOR);
-        arena_N = N;
+    if (!root) {
+        /* Allocate (or resize) the arena once; reset it for every build.
+         * The parallel build can leave up to one partly used pool block
+         * per thread, so it gets that much on top of the node bound. */
+        size_t arena_cap = (size_t)N * ARENA_NODE_FACTOR;
+        if (config->tree_build == TREE_BUILD_PARALLEL)
+            arena_cap += (size_t)config->n_threads * POOL_BLOCK_NODES;
+        if (arena.buffer == NULL || arena.capacity != arena_cap) {
+            if (arena.buffer) free_arena(&arena);
+            init_arena(&arena, arena_cap);
+        }
+        reset_arena(&arena);
+
+        if (config->tree_build == TREE_BUILD_PARALLEL)
+            root = build_tree_parallel(sys, x_min, x_max, y_min, y_max,
+                                       config->n_threads);
+        else
+            root = build_tree_serial(sys, x_min, x_max, y_min, y_max,
+                                     config->n_threads);
+        if (config->tree_reuse == TREE_REUSE_REFIT)
+            config->stats.rebuilds++;
     }
-    reset_arena(&arena);
+    tree_root = root;
+    tree_N    = N;
 
-    G_val     = G_FACTOR / N;
-    theta_val = config->theta_max;
+    size_t n_nodes = arena.size < arena.capacity ? arena.size : arena.capacity;
+    if (use_quad) {
+        prepare_quadrupole(n_nodes);
+#ifdef _OPENMP
+#pragma omp parallel num_threads(config->n_threads)
+#pragma omp single
+#endif
+        accumulate_quadrupole(root, 0);
+    }
 
-    TNode* root = create_node(x_min, x_max, y_min, y_max);
-    for (int i = 0; i < N; i++)
-        insert(root, i, sys);
+    if (config->tree_walk == TREE_WALK_PACKED)
+        pack_tree(root, n_nodes);
+    else if (config->tree_walk == TREE_WALK_SOA ||
+             config->tree_walk == TREE_WALK_GROUP)
+        build_walk_view(root, n_nodes);
+    else if (config->tree_walk == TREE_WALK_DUAL) {
+        prepare_dual(n_nodes);
+#ifdef _OPENMP
+#pragma omp parallel num_threads(config->n_threads)
+#pragma omp single
+#endif
+        accumulate_radius(root, 0);
+    }
+    int pm_grid = config->pm_grid > 0 ? config->pm_grid : SPLIT_DEFAULT_GRID;
+    double r_split = config->pm_split * (x_max - x_min) / pm_grid;
+    if (treepm && r_split != split_scale)
+        init_split(r_split);
+    double t_built = sim_time_now();
 
-    /* Only the per-particle force traversal is parallelised;
-     * tree building and Morton sort remain serial. */
+    /* The force traversal is always parallel. */
+    if (treepm) {
+        pm_long_range(sys, morton_codes, x_min, x_max, y_min, y_max, pm_grid,
+                      r_split, config->force_store, config->n_threads);
 #ifdef _OPENMP
 #pragma omp parallel for schedule(dynamic, CHUNK_SIZE) num_threads(config->n_threads)
 #endif
-    for (int i = 0; i < N; i++)
-        compute_force_single(i, sys, root, &fx_out[i], &fy_out[i]);
+        for (int i = 0; i < N; i++) {
+            if (particle_active(sys, config, i))
+                compute_force_short(i, sys, root, &fx_out[i], &fy_out[i]);
+        }
+    } else if (config->tree_walk == TREE_WALK_PACKED) {
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, CHUNK_SIZE) num_threads(config->n_threads)
+#endif
+        for (int i = 0; i < N; i++) {
+            if (particle_active(sys, config, i))
+                compute_force_packed(i, sys, &fx_out[i], &fy_out[i]);
+        }
+    } else if (config->tree_walk == TREE_WALK_SOA) {
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, CHUNK_SIZE) num_threads(config->n_threads)
+#endif
+        for (int i = 0; i < N; i++) {
+            if (particle_active(sys, config, i))
+                compute_force_view(i, sys, &fx_out[i], &fy_out[i]);
+        }
+    } else if (config->tree_walk == TREE_WALK_GROUP) {
+        int n_groups = (N + WALK_GROUP_SIZE - 1) / WALK_GROUP_SIZE;
+#ifdef _OPENMP
+#pragma omp parallel num_threads(config->n_threads)
+#endif
+        {
+            InteractionList list = {NULL, NULL, NULL, 0, 0};
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic, 1)
+#endif
+            for (int g = 0; g < n_groups; g++) {
+                int lo = g * WALK_GROUP_SIZE;
+                int hi = lo + WALK_GROUP_SIZE < N ? lo + WALK_GROUP_SIZE : N;
+                compute_force_group(lo, hi, sys, fx_out, fy_out, &list);
+            }
+            free(list.pos_x); free(list.pos_y); free(list.mass);
+        }
+    } else if (config->tree_walk == TREE_WALK_DUAL) {
+#ifdef _OPENMP
+#pragma omp parallel num_threads(config->n_threads)
+#pragma omp single
+#endif
+        dual_interact(root, root, 0);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static, CHUNK_SIZE) num_threads(config->n_threads)
+#endif
+        for (int i = 0; i < N; i++)
+            compute_force_dual(i, sys, root, &fx_out[i], &fy_out[i]);
+    } else {
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, CHUNK_SIZE) num_threads(config->n_threads)
+#endif
+        for (int i = 0; i < N; i++) {
+            if (particle_active(sys, config, i))
+                compute_force_single(i, sys, root, &fx_out[i], &fy_out[i]);
+        }
+    }
+    config->stats.tree_time  += t_built - t_ordered;
+    config->stats.force_time += sim_time_now() - t_built;
 }
 
 /** Compute the bounding square for all particles with a small padding.
@@ -133,26 +367,433 @@ static void init_domain(const double* x, const double* y, int N,
 }
 
 /** Grow the domain if any particle has escaped the current bounds.
+ * Returns whether it did.
  * ----------------------------------------------------------------- */
-static void expand_domain_if_needed(const double* x, const double* y, int N,
-                                    double* x_min, double* x_max,
-                                    double* y_min, double* y_max) {
+static int expand_domain_if_needed(const double* x, const double* y, int N,
+                                   double* x_min, double* x_max,
+                                   double* y_min, double* y_max) {
     for (int i = 0; i < N; i++) {
         if (x[i] < *x_min || x[i] > *x_max || y[i] < *y_min || y[i] > *y_max) {
             init_domain(x, y, N, x_min, x_max, y_min, y_max);
-            return;
+            return 1;
+        }
+    }
+    return 0;
+}
+
+/** Reorder particles for better cache locality during tree traversal.
+ * The linear tree is derived from the sorted codes, so it always uses
+ * Morton ordering; codes, if given, receive the sorted Morton codes.
+ * ----------------------------------------------------------------- */
+static void reorder_particles(ParticleSystem* sys, KernelConfig* config,
+                              double LB, double RB, double DB, double UB,
+                              uint64_t* codes) {
+    int N = sys->N;
+    if (config->k_clusters > 0 && config->tree_build != TREE_BUILD_LINEAR) {
+        static int*   clusters            = NULL;
+        static int*   c_size              = NULL;
+        static int    last_N              = 0, last_k = 0;
+        static double last_recluster_time = -1.0;
+        static const double RECLUSTER_INTERVAL = 1e-4;
+
+        if (!clusters || last_N < N) {
+            free(clusters);
+            clusters = (int*)malloc(N * sizeof(int));
+            last_N   = N;
+        }
+        if (!c_size || last_k < config->k_clusters) {
+            free(c_size);
+            c_size = (int*)malloc(config->k_clusters * sizeof(int));
+            last_k = config->k_clusters;
+        }
+        if (last_recluster_time < 0.0 ||
+            config->current_time - last_recluster_time >= RECLUSTER_INTERVAL) {
+            kmeans(sys, clusters, c_size, config->k_clusters, config->n_threads);
+            last_recluster_time = config->current_time;
+        }
+    } else {
+        z_order_sort(sys, config, LB, RB, DB, UB, codes);
+    }
+}
+
+/** Build the quadtree by inserting every particle from the root.
+ * In bottom-up mode the insertions only build topology and the masses
+ * are filled in afterwards by a task-parallel post-order pass.
+ * ----------------------------------------------------------------- */
+static TNode* build_tree_serial(ParticleSystem* sys, double LB, double RB,
+                                double DB, double UB, int n_threads) {
+    TNode* root = create_node(&arena, LB, RB, DB, UB);
+    for (int i = 0; i < sys->N; i++)
+        insert(root, i, sys, &arena);
+
+    if (!com_on_insert) {
+#ifdef _OPENMP
+#pragma omp parallel num_threads(n_threads)
+#pragma omp single
+#else
+        (void)n_threads;
+#endif
+        accumulate_com(root, 0);
+    }
+    return root;
+}
+
+/** Post-order mass and centre-of-mass pass over a topology-only tree.
+ * Leaves already hold their particle (or merged coincident particles);
+ * each internal node sums its children. Subtrees above COM_TASK_DEPTH
+ * become OpenMP tasks; call from inside a single region for those to
+ * run in parallel, or with depth >= COM_TASK_DEPTH to stay serial.
+ * ----------------------------------------------------------------- */
+static void accumulate_com(TNode* node, int depth) {
+    if (node->particle_idx != -1 || is_leaf(node)) return;
+
+    for (int q = 0; q < 4; q++) {
+        TNode* c = node->child[q];
+        if (!c) continue;
+        if (depth < COM_TASK_DEPTH) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c, depth)
+#endif
+            accumulate_com(c, depth + 1);
+        } else {
+            accumulate_com(c, depth + 1);
+        }
+    }
+#ifdef _OPENMP
+    if (depth < COM_TASK_DEPTH) {
+#pragma omp taskwait
+    }
+#endif
+
+    double m = 0.0, cx = 0.0, cy = 0.0;
+    for (int q = 0; q < 4; q++) {
+        TNode* c = node->child[q];
+        if (!c) continue;
+        m  += c->mass;
+        cx += c->pos_x * c->mass;
+        cy += c->pos_y * c->mass;
+    }
+    /* A cell of massless tracers only sits at its centre */
+    node->mass  = m;
+    node->pos_x = m > 0.0 ? cx / m : (node->x_min + node->x_max) * 0.5;
+    node->pos_y = m > 0.0 ? cy / m : (node->y_min + node->y_max) * 0.5;
+}
+
+/** Size the quadrupole array for the current tree.
+ * ----------------------------------------------------------------- */
+static void prepare_quadrupole(size_t max_nodes) {
+    if (quad_cap < max_nodes) {
+        free(cell_quad);
+        cell_quad = (CellQuadrupole*)malloc(max_nodes * sizeof(CellQuadrupole));
+        if (!cell_quad) {
+            fprintf(stderr, "Error: quadrupole allocation failed!\n");
+            exit(1);
+        }
+        quad_cap = max_nodes;
+    }
+}
+
+/** Post-order pass computing each node's traceless quadrupole
+ * Q_ij = sum m (3 d_i d_j - |d|^2 delta_ij) about its centre of mass,
+ * from its children's moments shifted by the parallel-axis rule. Needs
+ * final masses and centres of mass. Tasks as in accumulate_com.
+ * ----------------------------------------------------------------- */
+static void accumulate_quadrupole(TNode* node, int depth) {
+    CellQuadrupole* Q = &cell_quad[node_id(node)];
+    Q->qxx = Q->qxy = Q->qyy = 0.0;
+    if (node->particle_idx != -1 || is_leaf(node)) return;
+
+    for (int q = 0; q < 4; q++) {
+        TNode* c = node->child[q];
+        if (!c) continue;
+        if (depth < COM_TASK_DEPTH) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c, depth)
+#endif
+            accumulate_quadrupole(c, depth + 1);
+        } else {
+            accumulate_quadrupole(c, depth + 1);
+        }
+    }
+#ifdef _OPENMP
+    if (depth < COM_TASK_DEPTH) {
+#pragma omp taskwait
+    }
+#endif
+
+    double qxx = 0.0, qxy = 0.0, qyy = 0.0;
+    for (int q = 0; q < 4; q++) {
+        TNode* c = node->child[q];
+        if (!c) continue;
+        double dx = c->pos_x - node->pos_x;
+        double dy = c->pos_y - node->pos_y;
+        const CellQuadrupole* Qc = &cell_quad[node_id(c)];
+        qxx += Qc->qxx + c->mass * (2.0 * dx * dx - dy * dy);
+        qyy += Qc->qyy + c->mass * (2.0 * dy * dy - dx * dx);
+        qxy += Qc->qxy + c->mass * 3.0 * dx * dy;
+    }
+    Q->qxx = qxx;
+    Q->qxy = qxy;
+    Q->qyy = qyy;
+}
+
+/** Refit one subtree of a kept tree to the current positions.
+ * [LB, RB] x [DB, UB] is the node's geometric cell, rederived from the
+ * root so repeated refits do not compound. Mass and centre of mass are
+ * summed bottom-up as in accumulate_com, and the node's box becomes the
+ * smallest square from the cell's lower corner that holds both the cell
+ * and its contents, so the opening test still covers every particle
+ * below it. Tasks as in accumulate_com.
+ * ----------------------------------------------------------------- */
+static void refit_node(TNode* node, const ParticleSystem* sys, double LB,
+                       double RB, double DB, double UB, int depth,
+                       RefitSum* sum) {
+    double lb = LB, rb = RB, db = DB, ub = UB;
+    sum->count = 0;
+    sum->cell_size = sum->box_size = 0.0;
+
+    if (node->particle_idx != -1 || is_leaf(node)) {
+        int i = node->particle_idx;
+        if (i != -1) {
+            node->mass  = sys->mass[i];
+            node->pos_x = sys->pos_x[i];
+            node->pos_y = sys->pos_y[i];
+            lb = node->pos_x < lb ? node->pos_x : lb;
+            rb = node->pos_x > rb ? node->pos_x : rb;
+            db = node->pos_y < db ? node->pos_y : db;
+            ub = node->pos_y > ub ? node->pos_y : ub;
+            sum->count = 1;
+        }
+    } else {
+        RefitSum part[4];
+        double mx = (LB + RB) * 0.5;
+        double my = (DB + UB) * 0.5;
+        for (int q = 0; q < 4; q++) {
+            TNode* c = node->child[q];
+            if (!c) continue;
+            double cl = q & 1 ? mx : LB, cr = q & 1 ? RB : mx;
+            double cd = q & 2 ? my : DB, cu = q & 2 ? UB : my;
+            RefitSum* s = &part[q];
+            if (depth < COM_TASK_DEPTH) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c, depth, cl, cr, cd, cu, s)
+#endif
+                refit_node(c, sys, cl, cr, cd, cu, depth + 1, s);
+            } else {
+                refit_node(c, sys, cl, cr, cd, cu, depth + 1, s);
+            }
+        }
+#ifdef _OPENMP
+        if (depth < COM_TASK_DEPTH) {
+#pragma omp taskwait
+        }
+#endif
+
+        double m = 0.0, cx = 0.0, cy = 0.0;
+        for (int q = 0; q < 4; q++) {
+            TNode* c = node->child[q];
+            if (!c) continue;
+            m  += c->mass;
+            cx += c->pos_x * c->mass;
+            cy += c->pos_y * c->mass;
+            lb = c->x_min < lb ? c->x_min : lb;
+            rb = c->x_max > rb ? c->x_max : rb;
+            db = c->y_min < db ? c->y_min : db;
+            ub = c->y_max > ub ? c->y_max : ub;
+            sum->count     += part[q].count;
+            sum->cell_size += part[q].cell_size;
+            sum->box_size  += part[q].box_size;
+        }
+        node->mass  = m;
+        node->pos_x = m > 0.0 ? cx / m : (LB + RB) * 0.5;
+        node->pos_y = m > 0.0 ? cy / m : (DB + UB) * 0.5;
+    }
+
+    double w = rb - lb > ub - db ? rb - lb : ub - db;
+    node->x_min = lb;  node->x_max = lb + w;
+    node->y_min = db;  node->y_max = db + w;
+    if (node->particle_idx == -1 && !is_leaf(node)) {
+        sum->cell_size += RB - LB;
+        sum->box_size  += w;
+    }
+}
+
+/** Refit the tree kept from the last step over the domain square
+ * [LB, RB] x [DB, UB]. Returns 0, leaving the tree unusable, when it
+ * must be rebuilt instead: its leaves no longer hold one particle each
+ * (coincident particles were merged), or the internal cells have grown
+ * by more than REFIT_MAX_GROWTH on average, which makes the walk open
+ * ever more of them.
+ * ----------------------------------------------------------------- */
+static int refit_tree(TNode* root, const ParticleSystem* sys, double LB,
+                      double RB, double DB, double UB, int n_threads) {
+    RefitSum sum;
+#ifdef _OPENMP
+#pragma omp parallel num_threads(n_threads)
+#pragma omp single
+#else
+    (void)n_threads;
+#endif
+    refit_node(root, sys, LB, RB, DB, UB, 0, &sum);
+
+    if (sum.count != sys->N) return 0;
+    return sum.box_size <= (1.0 + REFIT_MAX_GROWTH) * sum.cell_size;
+}
+
+/* Scratch for the parallel builder, resized with N */
+static int*    cell_of    = NULL;
+static int*    cell_order = NULL;
+static int*    cell_start = NULL;
+static TNode** skel_nodes = NULL;
+static TNode** task_nodes = NULL;
+static int*    task_lo    = NULL;
+static int*    task_hi    = NULL;
+static int     par_N = 0, par_cells = 0;
+static int     n_skel = 0, n_tasks = 0;
+
+/** Create the skeleton for cells [lo, hi) at the given depth.
+ * A node becomes a build task once it reaches the cell depth or holds
+ * at most one particle; everything above it is a skeleton node whose
+ * mass is filled in after the tasks finish.
+ * ----------------------------------------------------------------- */
+static void build_skeleton(TNode* node, int depth, int max_depth,
+                           int lo, int hi) {
+    int count = cell_start[hi] - cell_start[lo];
+    if (depth == max_depth || count <= 1) {
+        task_nodes[n_tasks] = node;
+        task_lo[n_tasks]    = cell_start[lo];
+        task_hi[n_tasks]    = cell_start[hi];
+        n_tasks++;
+        return;
+    }
+
+    skel_nodes[n_skel++] = node;
+    int span = (hi - lo) / 4;
+    for (int q = 0; q < 4; q++) {
+        int c_lo = lo + q * span;
+        if (cell_start[c_lo + span] == cell_start[c_lo]) continue;
+        node->child[q] = create_child(&arena, node, q);
+        build_skeleton(node->child[q], depth + 1, max_depth, c_lo, c_lo + span);
+    }
+}
+
+/** Build the quadtree in parallel.
+ * Particles are binned into the 4^depth cells of a uniform grid whose
+ * boundaries coincide with the quadtree's, the top levels are created
+ * serially, and each occupied cell is then filled by insert() as an
+ * independent task. Tasks draw nodes from per-thread blocks of the
+ * shared arena. Within a cell particles are inserted in index order, so
+ * every subtree is identical to the one the serial builder produces.
+ * ----------------------------------------------------------------- */
+static TNode* build_tree_parallel(ParticleSystem* sys, double LB, double RB,
+                                  double DB, double UB, int n_threads) {
+    int N = sys->N;
+    int depth = 0, cells = 1;
+    while (cells < PAR_CELLS_PER_THREAD * n_threads && depth < PAR_MAX_DEPTH) {
+        depth++;
+        cells *= 4;
+    }
+
+    if (cell_of == NULL || par_N != N || par_cells != cells) {
+        free(cell_of); free(cell_order); free(cell_start);
+        free(skel_nodes); free(task_nodes); free(task_lo); free(task_hi);
+        int max_nodes = (N < cells ? N : cells) * (depth + 1) + 1;
+        cell_of    = (int*)malloc(N * sizeof(int));
+        cell_order = (int*)malloc(N * sizeof(int));
+        cell_start = (int*)malloc((cells + 1) * sizeof(int));
+        skel_nodes = (TNode**)malloc(max_nodes * sizeof(TNode*));
+        task_nodes = (TNode**)malloc(max_nodes * sizeof(TNode*));
+        task_lo    = (int*)malloc(max_nodes * sizeof(int));
+        task_hi    = (int*)malloc(max_nodes * sizeof(int));
+        if (!cell_of || !cell_order || !cell_start || !skel_nodes ||
+            !task_nodes || !task_lo || !task_hi) {
+            fprintf(stderr, "Error: parallel tree scratch allocation failed!\n");
+            exit(1);
+        }
+        par_N     = N;
+        par_cells = cells;
+    }
+
+    /* Locate each particle's cell by descending with the same midpoints
+     * insert() uses, so that cell and subtree boundaries agree exactly. */
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) num_threads(n_threads)
+#endif
+    for (int i = 0; i < N; i++) {
+        double lb = LB, rb = RB, db = DB, ub = UB;
+        int id = 0;
+        for (int d = 0; d < depth; d++) {
+            double mx = (lb + rb) * 0.5;
+            double my = (db + ub) * 0.5;
+            int q = quadrant(sys->pos_x[i], sys->pos_y[i], mx, my);
+            if (q & 1) lb = mx; else rb = mx;
+            if (q & 2) db = my; else ub = my;
+            id = id * 4 + q;
+        }
+        cell_of[i] = id;
+    }
+
+    /* Stable counting sort of particle indices by cell */
+    for (int c = 0; c <= cells; c++) cell_start[c] = 0;
+    for (int i = 0; i < N; i++) cell_start[cell_of[i] + 1]++;
+    for (int c = 0; c < cells; c++) cell_start[c + 1] += cell_start[c];
+    for (int i = 0; i < N; i++) {
+        cell_order[cell_start[cell_of[i]]++] = i;
+    }
+    for (int c = cells; c > 0; c--) cell_start[c] = cell_start[c - 1];
+    cell_start[0] = 0;
+
+    n_skel  = 0;
+    n_tasks = 0;
+    TNode* root = create_node(&arena, LB, RB, DB, UB);
+    build_skeleton(root, 0, depth, 0, cells);
+
+#ifdef _OPENMP
+#pragma omp parallel num_threads(n_threads)
+#endif
+    {
+        NodeArena pool = {NULL, 0, 0};
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic, 1)
+#endif
+        for (int t = 0; t < n_tasks; t++) {
+            for (int k = task_lo[t]; k < task_hi[t]; k++)
+                insert(task_nodes[t], cell_order[k], sys, &pool);
+            if (!com_on_insert)
+                accumulate_com(task_nodes[t], COM_TASK_DEPTH);
         }
     }
+
+    /* Skeleton nodes were recorded parent-first, so walking the list
+     * backwards finishes every child before its parent. */
+    for (int s = n_skel - 1; s >= 0; s--) {
+        TNode* node = skel_nodes[s];
+        double m = 0.0, cx = 0.0, cy = 0.0;
+        for (int q = 0; q < 4; q++) {
+            TNode* c = node->child[q];
+            if (!c) continue;
+            m  += c->mass;
+            cx += c->pos_x * c->mass;
+            cy += c->pos_y * c->mass;
+        }
+        node->mass  = m;
+        node->pos_x = m > 0.0 ? cx / m : (node->x_min + node->x_max) * 0.5;
+        node->pos_y = m > 0.0 ? cy / m : (node->y_min + node->y_max) * 0.5;
+    }
+    return root;
 }
 
 /** Iterative tree traversal using an explicit stack.
  * Accepts a subtree as one pseudo-body when cell_width / r < theta.
+ * With quadrupoles on, an accepted cell also adds the field of its
+ * moment Q for the 1/r potential, G m [Q r / d^5 - 5/2 (r.Q.r) r / d^7]
+ * with r from the centre of mass to i and d = r + eps.
  * ----------------------------------------------------------------- */
 static void compute_force_single(int i, ParticleSystem* sys, TNode* root,
                                  double* res_fx, double* res_fy) {
     double pos_x = sys->pos_x[i];
     double pos_y = sys->pos_y[i];
-    double mass  = sys->mass[i];
+    double mass  = sink_mass(sys, force_store, i);
 
     TNode* stack[256];
     int sp = 0;
@@ -174,6 +815,481 @@ static void compute_force_single(int i, ParticleSystem* sys, TNode* root,
             double f = G_val * mass * node->mass / (denom * denom * denom);
             fx += f * (-dx);
             fy += f * (-dy);
+            if (use_quad && node->particle_idx == -1) {
+                double inv2 = 1.0 / (denom * denom);
+                double g    = G_val * mass * inv2 * inv2 / denom;
+                const CellQuadrupole* Q = &cell_quad[node_id(node)];
+                double qx   = Q->qxx * dx + Q->qxy * dy;
+                double qy   = Q->qxy * dx + Q->qyy * dy;
+                double rqr  = 2.5 * (dx * qx + dy * qy) * inv2;
+                fx += g * (qx - rqr * dx);
+                fy += g * (qy - rqr * dy);
+            }
+        } else {
+            for (int j = 0; j < 4; j++) {
+                if (node->child[j]) stack[sp++] = node->child[j];
+            }
+        }
+    }
+
+    *res_fx = fx;
+    *res_fy = fy;
+}
+
+/* Append node and its subtree to the packed array in depth-first order.
+ * Children go in the order compute_force_single pops them (3..0), so both
+ * walks sum contributions in the same order. */
+static void pack_node(const TNode* node) {
+    int n = n_packed++;
+    packed[n].pos_x = node->pos_x;
+    packed[n].pos_y = node->pos_y;
+    packed[n].mass  = node->mass;
+    packed[n].size  = (float)(node->x_max - node->x_min);
+    if (node->particle_idx == -1) {
+        for (int q = 3; q >= 0; q--)
+            if (node->child[q]) pack_node(node->child[q]);
+    }
+    packed[n].skip = n_packed;
+}
+
+/** Copy the pointer tree into the packed depth-first array.
+ * ----------------------------------------------------------------- */
+static void pack_tree(TNode* root, size_t max_nodes) {
+    if (packed_cap < max_nodes) {
+        free(packed);
+        packed = (PackedNode*)malloc(max_nodes * sizeof(PackedNode));
+        if (!packed) {
+            fprintf(stderr, "Error: packed tree allocation failed!\n");
+            exit(1);
+        }
+        packed_cap = max_nodes;
+    }
+    n_packed = 0;
+    pack_node(root);
+}
+
+/** Stackless walk of the packed tree for particle i.
+ * An accepted cell or a leaf jumps past its subtree; an opened cell
+ * steps into its first child. The opening test uses squared distances
+ * so the sqrt is only paid for accepted nodes. A leaf holding i itself
+ * is at distance exactly zero and contributes nothing, so it needs no
+ * special case.
+ * ----------------------------------------------------------------- */
+static void compute_force_packed(int i, ParticleSystem* sys,
+                                 double* res_fx, double* res_fy) {
+    double pos_x = sys->pos_x[i];
+    double pos_y = sys->pos_y[i];
+    double mass  = sink_mass(sys, force_store, i);
+
+    double fx = 0.0, fy = 0.0;
+    double theta2 = theta_val * theta_val;
+    int n = 0;
+    while (n < n_packed) {
+        const PackedNode* node = &packed[n];
+        double dx = pos_x - node->pos_x;
+        double dy = pos_y - node->pos_y;
+        double r2 = dx * dx + dy * dy;
+        double s  = node->size;
+
+        if (node->skip == n + 1 || s * s < theta2 * r2) {
+            double r = sqrt(r2);
+            double denom = r + EPSILON;
+            double f = G_val * mass * node->mass / (denom * denom * denom);
+            fx += f * (-dx);
+            fy += f * (-dy);
+            n = node->skip;
+        } else {
+            n++;
+        }
+    }
+
+    *res_fx = fx;
+    *res_fy = fy;
+}
+
+/* Append node and its subtree to the walk view, in the same order as
+ * pack_node. */
+static void view_node(const TNode* node) {
+    int n = view.count++;
+    view.com_x[n] = node->pos_x;
+    view.com_y[n] = node->pos_y;
+    view.mass[n]  = node->mass;
+    view.size[n]  = node->x_max - node->x_min;
+    view.leaf[n]  = node->particle_idx;
+    if (node->particle_idx == -1) {
+        for (int q = 3; q >= 0; q--)
+            if (node->child[q]) view_node(node->child[q]);
+    }
+    view.skip[n] = view.count;
+}
+
+/** Copy the pointer tree into the structure-of-arrays walk view.
+ * ----------------------------------------------------------------- */
+static void build_walk_view(TNode* root, size_t max_nodes) {
+    if (view.capacity < max_nodes) {
+        free(view.com_x); free(view.com_y); free(view.mass);
+        free(view.size);  free(view.skip);  free(view.leaf);
+        view.com_x = (double*)malloc(max_nodes * sizeof(double));
+        view.com_y = (double*)malloc(max_nodes * sizeof(double));
+        view.mass  = (double*)malloc(max_nodes * sizeof(double));
+        view.size  = (double*)malloc(max_nodes * sizeof(double));
+        view.skip  = (int*)malloc(max_nodes * sizeof(int));
+        view.leaf  = (int*)malloc(max_nodes * sizeof(int));
+        if (!view.com_x || !view.com_y || !view.mass || !view.size ||
+            !view.skip || !view.leaf) {
+            fprintf(stderr, "Error: walk view allocation failed!\n");
+            exit(1);
+        }
+        view.capacity = max_nodes;
+    }
+    view.count = 0;
+    view_node(root);
+}
+
+/** Stackless walk of the walk view for particle i.
+ * Same decisions and summation order as compute_force_single.
+ * ----------------------------------------------------------------- */
+static void compute_force_view(int i, ParticleSystem* sys,
+                               double* res_fx, double* res_fy) {
+    const double* com_x = view.com_x;
+    const double* com_y = view.com_y;
+    const double* nmass = view.mass;
+    const double* size  = view.size;
+    const int*    skip  = view.skip;
+    const int*    leaf  = view.leaf;
+    double pos_x = sys->pos_x[i];
+    double pos_y = sys->pos_y[i];
+    double mass  = sink_mass(sys, force_store, i);
+
+    double fx = 0.0, fy = 0.0;
+    int n = 0;
+    while (n < view.count) {
+        if (leaf[n] == i) {
+            n = skip[n];
+            continue;
+        }
+
+        double dx = pos_x - com_x[n];
+        double dy = pos_y - com_y[n];
+        double r  = sqrt(dx * dx + dy * dy);
+
+        if (leaf[n] != -1 || size[n] < theta_val * r) {
+            double denom = r + EPSILON;
+            double f = G_val * mass * nmass[n] / (denom * denom * denom);
+            fx += f * (-dx);
+            fy += f * (-dy);
+            n = skip[n];
+        } else {
+            n++;
+        }
+    }
+
+    *res_fx = fx;
+    *res_fy = fy;
+}
+
+/* Append one pseudo-body to an interaction list, growing it as needed. */
+static void list_push(InteractionList* list, double px, double py, double m) {
+    if (list->count == list->capacity) {
+        int cap = list->capacity ? 2 * list->capacity : GROUP_LIST_INIT;
+        list->pos_x = (double*)realloc(list->pos_x, cap * sizeof(double));
+        list->pos_y = (double*)realloc(list->pos_y, cap * sizeof(double));
+        list->mass  = (double*)realloc(list->mass,  cap * sizeof(double));
+        if (!list->pos_x || !list->pos_y || !list->mass) {
+            fprintf(stderr, "Error: interaction list allocation failed!\n");
+            exit(1);
+        }
+        list->capacity = cap;
+    }
+    list->pos_x[list->count] = px;
+    list->pos_y[list->count] = py;
+    list->mass[list->count]  = m;
+    list->count++;
+}
+
+/** Walk the view once for particles lo..hi-1 and share the result.
+ * A cell is accepted for the whole group when s < theta * d, where d is
+ * the distance from its centre of mass to the group's bounding box.
+ * Every member is at least d away, so each one would have accepted it
+ * on its own walk too. Leaves always go on the list; a member's own
+ * leaf sits at distance zero and contributes nothing.
+ * ----------------------------------------------------------------- */
+static void compute_force_group(int lo, int hi, ParticleSystem* sys,
+                                double* fx_out, double* fy_out,
+                                InteractionList* list) {
+    const double* px = sys->pos_x;
+    const double* py = sys->pos_y;
+
+    double bx_min = px[lo], bx_max = px[lo];
+    double by_min = py[lo], by_max = py[lo];
+    for (int i = lo + 1; i < hi; i++) {
+        if (px[i] < bx_min) bx_min = px[i];
+        if (px[i] > bx_max) bx_max = px[i];
+        if (py[i] < by_min) by_min = py[i];
+        if (py[i] > by_max) by_max = py[i];
+    }
+
+    double theta2 = theta_val * theta_val;
+    list->count = 0;
+    int n = 0;
+    while (n < view.count) {
+        double cx = view.com_x[n];
+        double cy = view.com_y[n];
+        if (view.leaf[n] != -1) {
+            list_push(list, cx, cy, view.mass[n]);
+            n = view.skip[n];
+            continue;
+        }
+
+        double dx = cx < bx_min ? bx_min - cx : (cx > bx_max ? cx - bx_max : 0.0);
+        double dy = cy < by_min ? by_min - cy : (cy > by_max ? cy - by_max : 0.0);
+        double s  = view.size[n];
+        if (s * s < theta2 * (dx * dx + dy * dy)) {
+            list_push(list, cx, cy, view.mass[n]);
+            n = view.skip[n];
+        } else {
+            n++;
+        }
+    }
+
+    for (int i = lo; i < hi; i++) {
+        double fx = 0.0, fy = 0.0;
+        kernel_fn(px[i], py[i], G_val * sink_mass(sys, force_store, i),
+                  list->pos_x, list->pos_y, list->mass, list->count, &fx, &fy);
+        fx_out[i] = fx;
+        fy_out[i] = fy;
+    }
+}
+
+/** Size the dual-walk arrays for the current tree and clear the locals.
+ * ----------------------------------------------------------------- */
+static void prepare_dual(size_t max_nodes) {
+    if (dual_cap < max_nodes) {
+        free(cell_radius);
+        free(cell_local);
+        cell_radius = (double*)malloc(max_nodes * sizeof(double));
+        cell_local  = (CellLocal*)malloc(max_nodes * sizeof(CellLocal));
+        if (!cell_radius || !cell_local) {
+            fprintf(stderr, "Error: dual walk allocation failed!\n");
+            exit(1);
+        }
+        dual_cap = max_nodes;
+    }
+    memset(cell_local, 0, max_nodes * sizeof(CellLocal));
+}
+
+/** Post-order pass bounding each node's particles by a circle about its
+ * centre of mass: the tighter of the children's circles shifted to the
+ * parent and the farthest corner of the cell. Leaves have radius zero
+ * (merged coincident particles sit within COINCIDENT_EPS). Tasks as in
+ * accumulate_com.
+ * ----------------------------------------------------------------- */
+static void accumulate_radius(TNode* node, int depth) {
+    double* r = &cell_radius[node_id(node)];
+    *r = 0.0;
+    if (node->particle_idx != -1 || is_leaf(node)) return;
+
+    for (int q = 0; q < 4; q++) {
+        TNode* c = node->child[q];
+        if (!c) continue;
+        if (depth < COM_TASK_DEPTH) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c, depth)
+#endif
+            accumulate_radius(c, depth + 1);
+        } else {
+            accumulate_radius(c, depth + 1);
+        }
+    }
+#ifdef _OPENMP
+    if (depth < COM_TASK_DEPTH) {
+#pragma omp taskwait
+    }
+#endif
+
+    double rc = 0.0;
+    for (int q = 0; q < 4; q++) {
+        TNode* c = node->child[q];
+        if (!c) continue;
+        double d = hypot(c->pos_x - node->pos_x, c->pos_y - node->pos_y) +
+                   cell_radius[node_id(c)];
+        if (d > rc) rc = d;
+    }
+    double wx = fmax(node->pos_x - node->x_min, node->x_max - node->pos_x);
+    double wy = fmax(node->pos_y - node->y_min, node->y_max - node->pos_y);
+    double rb = sqrt(wx * wx + wy * wy);
+    *r = rc < rb ? rc : rb;
+}
+
+/* Cell-cell interaction: the field of a's monopole at b's centre of mass
+ * and its first two derivatives, added to b's local. With R = COM_b -
+ * COM_a, r = |R|, d = r + eps and h = -3 / (r d^4):
+ *   g_i       = -m R_i / d^3
+ *   dg_i/dx_j = -m [delta_ij / d^3 + h R_i R_j]
+ *   d2g_i/dx_j dx_k = -m [h (delta_ij R_k + delta_ik R_j + delta_jk R_i)
+ *                         + (h' / r) R_i R_j R_k]. */
+static void cell_cell(TNode* b, const TNode* a) {
+    CellLocal* L = &cell_local[node_id(b)];
+    double rx = b->pos_x - a->pos_x;
+    double ry = b->pos_y - a->pos_y;
+    double r  = sqrt(rx * rx + ry * ry);
+    double d  = r + EPSILON;
+    double f  = a->mass / (d * d * d);
+    L->gx -= f * rx;
+    L->gy -= f * ry;
+    if (r > 0.0) {
+        double h = -3.0 * f / (r * d);
+        double k = f / (r * r * d) * (3.0 / r + 12.0 / d);
+        L->txx -= f + h * rx * rx;
+        L->txy -= h * rx * ry;
+        L->tyy -= f + h * ry * ry;
+        L->hxxx -= 3.0 * h * rx + k * rx * rx * rx;
+        L->hxxy -= h * ry + k * rx * rx * ry;
+        L->hxyy -= h * rx + k * rx * ry * ry;
+        L->hyyy -= 3.0 * h * ry + k * ry * ry * ry;
+    }
+}
+
+/** Dual-tree traversal of target node b against source node a.
+ * A pair is well separated when (r_a + r_b) < theta * |COM_b - COM_a|
+ * with the radii of accumulate_radius; it then interacts once through
+ * cell_cell instead of once per target particle. Two distinct leaves
+ * always interact directly, which is exact at b's particle; otherwise
+ * the larger node is split. Only b's subtree is written, so target
+ * splits above DUAL_TASK_DEPTH run as tasks, and the taskwait keeps a
+ * later source of the same target from overlapping them.
+ * ----------------------------------------------------------------- */
+static void dual_interact(TNode* b, TNode* a, int depth) {
+    int leaf_b = b->particle_idx != -1 || is_leaf(b);
+    int leaf_a = a->particle_idx != -1 || is_leaf(a);
+    if (leaf_b && leaf_a) {
+        if (a != b) cell_cell(b, a);
+        return;
+    }
+
+    double dx = b->pos_x - a->pos_x;
+    double dy = b->pos_y - a->pos_y;
+    double d2 = dx * dx + dy * dy;
+    double rr = cell_radius[node_id(a)] + cell_radius[node_id(b)];
+    if (a != b && rr * rr < theta_val * theta_val * d2) {
+        cell_cell(b, a);
+        return;
+    }
+
+    if (leaf_a || (!leaf_b && cell_radius[node_id(b)] >= cell_radius[node_id(a)])) {
+        int spawn = depth < DUAL_TASK_DEPTH;
+        for (int q = 0; q < 4; q++) {
+            TNode* c = b->child[q];
+            if (!c) continue;
+            if (spawn) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c, a, depth)
+#endif
+                dual_interact(c, a, depth + 1);
+            } else {
+                dual_interact(c, a, depth + 1);
+            }
+        }
+#ifdef _OPENMP
+        if (spawn) {
+#pragma omp taskwait
+        }
+#endif
+    } else {
+        for (int q = 0; q < 4; q++) {
+            if (a->child[q]) dual_interact(b, a->child[q], depth);
+        }
+    }
+}
+
+/** Evaluate the dual walk's locals for particle i.
+ * Quadratic expansions translate exactly, so instead of pushing locals
+ * down to the leaves the particle descends from the root and sums
+ * g + T dx + H dx dx / 2, dx = x_i - COM, of every cell on its path. The descent also
+ * reaches particles merged into a coincident leaf.
+ * ----------------------------------------------------------------- */
+static void compute_force_dual(int i, ParticleSystem* sys, TNode* root,
+                               double* res_fx, double* res_fy) {
+    double pos_x = sys->pos_x[i];
+    double pos_y = sys->pos_y[i];
+    double gx = 0.0, gy = 0.0;
+
+    TNode* node = root;
+    while (node) {
+        const CellLocal* L = &cell_local[node_id(node)];
+        double dx = pos_x - node->pos_x;
+        double dy = pos_y - node->pos_y;
+        gx += L->gx + L->txx * dx + L->txy * dy +
+              0.5 * (L->hxxx * dx * dx + 2.0 * L->hxxy * dx * dy + L->hxyy * dy * dy);
+        gy += L->gy + L->txy * dx + L->tyy * dy +
+              0.5 * (L->hxxy * dx * dx + 2.0 * L->hxyy * dx * dy + L->hyyy * dy * dy);
+        if (node->particle_idx != -1) break;
+        double mx = (node->x_min + node->x_max) * 0.5;
+        double my = (node->y_min + node->y_max) * 0.5;
+        node = node->child[quadrant(pos_x, pos_y, mx, my)];
+    }
+
+    double gm = G_val * sink_mass(sys, force_store, i);
+    *res_fx = gm * gx;
+    *res_fy = gm * gy;
+}
+
+/** Tabulate the short-range factor of the Gaussian split out to the
+ * cutoff, where it has fallen below 2%.
+ * ----------------------------------------------------------------- */
+static void init_split(double r_split) {
+    split_scale = r_split;
+    split_cut   = SPLIT_CUTOFF * r_split;
+    split_step  = split_cut / SPLIT_TABLE;
+    for (int k = 0; k < SPLIT_TABLE; k++)
+        split_table[k] = pm_short_factor(k * split_step, r_split);
+    split_table[SPLIT_TABLE] = split_table[SPLIT_TABLE + 1] = 0.0;
+}
+
+/** Short-range walk of the TreePM split for particle i.
+ * Like compute_force_single, but cells whose box lies beyond the cutoff
+ * are skipped without opening, so the walk only covers the neighbourhood
+ * of i, and every accepted interaction is scaled by the tabulated
+ * short-range factor. Adds to the mesh force already in res.
+ * ----------------------------------------------------------------- */
+static void compute_force_short(int i, ParticleSystem* sys, TNode* root,
+                                double* res_fx, double* res_fy) {
+    double pos_x = sys->pos_x[i];
+    double pos_y = sys->pos_y[i];
+    double mass  = sink_mass(sys, force_store, i);
+    double cut2  = split_cut * split_cut;
+    double inv_step = 1.0 / split_step;
+
+    TNode* stack[256];
+    int sp = 0;
+    if (root) stack[sp++] = root;
+
+    double fx = 0.0, fy = 0.0;
+
+    while (sp > 0) {
+        TNode* node = stack[--sp];
+        if (node->particle_idx == i) continue;
+
+        double bx = pos_x < node->x_min ? node->x_min - pos_x
+                  : (pos_x > node->x_max ? pos_x - node->x_max : 0.0);
+        double by = pos_y < node->y_min ? node->y_min - pos_y
+                  : (pos_y > node->y_max ? pos_y - node->y_max : 0.0);
+        if (bx * bx + by * by >= cut2) continue;
+
+        double dx = pos_x - node->pos_x;
+        double dy = pos_y - node->pos_y;
+        double r  = sqrt(dx * dx + dy * dy);
+        double s  = node->x_max - node->x_min;
+
+        if (node->particle_idx != -1 || (s < theta_val * r)) {
+            double t = r * inv_step;
+            t = t < SPLIT_TABLE ? t : SPLIT_TABLE;
+            int    k = (int)t;
+            double w = split_table[k] + (t - k) * (split_table[k + 1] - split_table[k]);
+            double denom = r + EPSILON;
+            double f = w * G_val * mass * node->mass / (denom * denom * denom);
+            fx += f * (-dx);
+            fy += f * (-dy);
         } else {
             for (int j = 0; j < 4; j++) {
                 if (node->child[j]) stack[sp++] = node->child[j];
@@ -181,6 +1297,60 @@ static void compute_force_single(int i, ParticleSystem* sys, TNode* root,
         }
     }
 
+    *res_fx += fx;
+    *res_fy += fy;
+}
+
+/** Walk the linear tree for particle i.
+ * Same acceptance rule as compute_force_single. A single-particle leaf
+ * is summed directly; a bucket leaf is first tested like any cell and
+ * only summed over its particle range when opened; i itself adds zero.
+ * ----------------------------------------------------------------- */
+static void compute_force_linear(int i, ParticleSystem* sys,
+                                 const LinearTree* tree,
+                                 double* res_fx, double* res_fy) {
+    const double* x = sys->pos_x;
+    const double* y = sys->pos_y;
+    const double* m = sys->mass;
+    double pos_x = x[i];
+    double pos_y = y[i];
+    double mass  = sink_mass(sys, force_store, i);
+
+    int stack[256];
+    int sp = 0;
+    if (tree->size > 0) stack[sp++] = 0;
+
+    double fx = 0.0, fy = 0.0;
+
+    while (sp > 0) {
+        const LNode* node = &tree->nodes[stack[--sp]];
+        int leaf = node->child[0] < 0 && node->child[1] < 0 &&
+                   node->child[2] < 0 && node->child[3] < 0;
+
+        double dx = pos_x - node->pos_x;
+        double dy = pos_y - node->pos_y;
+        double r  = sqrt(dx * dx + dy * dy);
+        int accept = node->count > 1 && node->size < theta_val * r;
+
+        if (leaf && !accept) {
+            int j = node->first;
+            kernel_fn(pos_x, pos_y, G_val * mass, x + j, y + j, m + j,
+                      node->count, &fx, &fy);
+            continue;
+        }
+
+        if (leaf || node->size < theta_val * r) {
+            double denom = r + EPSILON;
+            double f = G_val * mass * node->mass / (denom * denom * denom);
+            fx += f * (-dx);
+            fy += f * (-dy);
+        } else {
+            for (int j = 0; j < 4; j++) {
+                if (node->child[j] >= 0) stack[sp++] = node->child[j];
+            }
+        }
+    }
+
     *res_fx = fx;
     *res_fy = fy;
 }
@@ -188,7 +1358,7 @@ static void compute_force_single(int i, ParticleSystem* sys, TNode* root,
 /** Insert particle idx into the quadtree.
  * Coincident particles are merged into one aggregate leaf.
  * ----------------------------------------------------------------- */
-static void insert(TNode* node, int idx, ParticleSystem* sys) {
+static void insert(TNode* node, int idx, ParticleSystem* sys, NodeArena* pool) {
     double px   = sys->pos_x[idx];
     double py   = sys->pos_y[idx];
     double mass = sys->mass[idx];
@@ -209,9 +1379,11 @@ static void insert(TNode* node, int idx, ParticleSystem* sys) {
             if (fabs(px - sys->pos_x[old]) < COINCIDENT_EPS &&
                 fabs(py - sys->pos_y[old]) < COINCIDENT_EPS) {
                 double mt = node->mass + mass;
-                node->pos_x = (node->pos_x * node->mass + px * mass) / mt;
-                node->pos_y = (node->pos_y * node->mass + py * mass) / mt;
-                node->mass  = mt;
+                if (mt > 0.0) {
+                    node->pos_x = (node->pos_x * node->mass + px * mass) / mt;
+                    node->pos_y = (node->pos_y * node->mass + py * mass) / mt;
+                }
+                node->mass = mt;
                 return;
             }
 
@@ -225,17 +1397,19 @@ static void insert(TNode* node, int idx, ParticleSystem* sys) {
             double mx = (node->x_min + node->x_max) * 0.5;
             double my = (node->y_min + node->y_max) * 0.5;
             int oq = quadrant(old_px, old_py, mx, my);
-            double lb, rb, db, ub;
-            if (oq == 0)      { lb = node->x_min; rb = mx;          db = node->y_min; ub = my;          }
-            else if (oq == 1) { lb = mx;          rb = node->x_max; db = node->y_min; ub = my;          }
-            else if (oq == 2) { lb = node->x_min; rb = mx;          db = my;          ub = node->y_max; }
-            else              { lb = mx;          rb = node->x_max; db = my;          ub = node->y_max; }
-            node->child[oq] = create_node(lb, rb, db, ub);
-            insert(node->child[oq], old, sys);
+            node->child[oq] = create_child(pool, node, oq);
+            insert(node->child[oq], old, sys, pool);
 
-            node->mass  = old_m;
-            node->pos_x = old_px;
-            node->pos_y = old_py;
+            if (!com_on_insert) {
+                /* Keep any coincident particles merged into old */
+                node->child[oq]->mass  = old_m;
+                node->child[oq]->pos_x = old_px;
+                node->child[oq]->pos_y = old_py;
+            } else {
+                node->mass  = old_m;
+                node->pos_x = old_px;
+                node->pos_y = old_py;
+            }
         }
     }
 
@@ -243,26 +1417,33 @@ static void insert(TNode* node, int idx, ParticleSystem* sys) {
     double mx = (node->x_min + node->x_max) * 0.5;
     double my = (node->y_min + node->y_max) * 0.5;
     int q = quadrant(px, py, mx, my);
-    if (!node->child[q]) {
-        double lb, rb, db, ub;
-        if (q == 0)      { lb = node->x_min; rb = mx;          db = node->y_min; ub = my;          }
-        else if (q == 1) { lb = mx;          rb = node->x_max; db = node->y_min; ub = my;          }
-        else if (q == 2) { lb = node->x_min; rb = mx;          db = my;          ub = node->y_max; }
-        else             { lb = mx;          rb = node->x_max; db = my;          ub = node->y_max; }
-        node->child[q] = create_node(lb, rb, db, ub);
-    }
-    insert(node->child[q], idx, sys);
+    if (!node->child[q])
+        node->child[q] = create_child(pool, node, q);
+    insert(node->child[q], idx, sys, pool);
+    if (!com_on_insert) return;
 
-    /* Update this internal node's mass and centre of mass */
+    /* Update this internal node's mass and centre of mass; massless
+     * tracers leave the centre where it is */
     double mt = node->mass + mass;
-    node->pos_x = (node->pos_x * node->mass + px * mass) / mt;
-    node->pos_y = (node->pos_y * node->mass + py * mass) / mt;
-    node->mass  = mt;
+    if (mt > 0.0) {
+        node->pos_x = (node->pos_x * node->mass + px * mass) / mt;
+        node->pos_y = (node->pos_y * node->mass + py * mass) / mt;
+    }
+    node->mass = mt;
 }
 
-/* Allocate a node from the arena instead of calling malloc each time */
-static TNode* create_node(double LB, double RB, double DB, double UB) {
-    TNode* node = arena_alloc(&arena);
+/* Allocate a node from the arena instead of calling malloc each time.
+ * A pool other than the shared arena is a per-thread block that is
+ * refilled from the shared arena when it runs out. */
+static TNode* create_node(NodeArena* pool, double LB, double RB, double DB,
+                          double UB) {
+    TNode* node = arena_alloc(pool);
+    if (!node && pool != &arena) {
+        pool->buffer   = arena_alloc_block(&arena, POOL_BLOCK_NODES);
+        pool->capacity = pool->buffer ? POOL_BLOCK_NODES : 0;
+        pool->size     = 0;
+        node = arena_alloc(pool);
+    }
     if (!node) {
         fprintf(stderr, "Error: arena out of memory!\n");
         exit(1);
@@ -277,6 +1458,18 @@ static TNode* create_node(double LB, double RB, double DB, double UB) {
     return node;
 }
 
+/* Create the child cell of node covering quadrant q */
+static TNode* create_child(NodeArena* pool, TNode* node, int q) {
+    double mx = (node->x_min + node->x_max) * 0.5;
+    double my = (node->y_min + node->y_max) * 0.5;
+    double lb, rb, db, ub;
+    if (q == 0)      { lb = node->x_min; rb = mx;          db = node->y_min; ub = my;          }
+    else if (q == 1) { lb = mx;          rb = node->x_max; db = node->y_min; ub = my;          }
+    else if (q == 2) { lb = node->x_min; rb = mx;          db = my;          ub = node->y_max; }
+    else             { lb = mx;          rb = node->x_max; db = my;          ub = node->y_max; }
+    return create_node(pool, lb, rb, db, ub);
+}
+
 static int is_leaf(TNode* node) {
     return node->child[0] == NULL && node->child[1] == NULL &&
            node->child[2] == NULL && node->child[3] == NULL;
@@ -0,0 +1,623 @@
+#include "ds.h"
+#include "integrator.h"
+#include "io.h"
+#include "kernels.h"
+#include "morton.h"
+#include "time_utils.h"
+#include <math.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* Kernel microbenchmarks. Each one repeats its measurement, discards the
+ * warm-up run and reports the median, like the saved metrics. */
+
+static const int BENCH_REPEATS = 5;
+
+/* Keeps results of timed loops observable */
+static volatile uint64_t bench_sink;
+
+/* Problem sizes and thread counts of the saved weak-scaling sweep */
+static const int WEAK_N[]       = { 100000, 200000, 400000, 800000,
+                                    1600000, 2000000, 3200000 };
+static const int WEAK_THREADS[] = { 1, 2, 4, 8, 16, 20, 32 };
+#define N_WEAK ((int)(sizeof(WEAK_N) / sizeof(WEAK_N[0])))
+
+static int bench_sort(int argc, char* argv[]);
+static int bench_encode(int argc, char* argv[]);
+static int bench_walk(int argc, char* argv[]);
+static int bench_kernel(int argc, char* argv[]);
+static int bench_fmm(int argc, char* argv[]);
+static int bench_dual(int argc, char* argv[]);
+static int bench_integrators(int argc, char* argv[]);
+
+void compute_force_naive(ParticleSystem* sys, KernelConfig* config);
+void compute_force_barnes_hut(ParticleSystem* sys, KernelConfig* config);
+void compute_force_fmm(ParticleSystem* sys, KernelConfig* config);
+
+typedef struct {
+    const char* name;
+    int (*run)(int argc, char* argv[]);
+    const char* usage;
+} Bench;
+
+static const Bench BENCHES[] = {
+    { "sort", bench_sort,
+      "[n_threads]  qsort vs radix sort at the weak-scaling sizes" },
+    { "encode", bench_encode,
+      "[N]  Morton encode/decode throughput per implementation" },
+    { "walk", bench_walk,
+      "[n_threads] [N...]  pointer/packed/SoA node layouts, default N=100k,1M" },
+    { "kernel", bench_kernel,
+      "[list] [targets]  interactions/s per core for each force kernel" },
+    { "fmm", bench_fmm,
+      "[n_threads] [N...]  FMM orders vs Barnes-Hut, default N=1e5,1e6,1e7" },
+    { "dual", bench_dual,
+      "[n_threads] [N...]  dual-tree vs per-particle walk on uniform bodies" },
+    { "integrators", bench_integrators,
+      "[N] [T] [dt...]  energy drift vs force evaluations per integrator" },
+};
+#define N_BENCHES ((int)(sizeof(BENCHES) / sizeof(BENCHES[0])))
+
+int main(int argc, char* argv[]) {
+    if (argc >= 2) {
+        for (int b = 0; b < N_BENCHES; b++) {
+            if (strcmp(argv[1], BENCHES[b].name) == 0)
+                return BENCHES[b].run(argc - 2, argv + 2);
+        }
+    }
+    fprintf(stderr, "Usage: %s <benchmark> [args]\n", argv[0]);
+    for (int b = 0; b < N_BENCHES; b++)
+        fprintf(stderr, "  %-11s %s\n", BENCHES[b].name, BENCHES[b].usage);
+    return 1;
+}
+
+static uint64_t splitmix64(uint64_t* state) {
+    uint64_t z = (*state += 0x9E3779B97F4A7C15ULL);
+    z = (z ^ (z >> 30)) * 0xBF58476D1CE4E5B9ULL;
+    z = (z ^ (z >> 27)) * 0x94D049BB133111EBULL;
+    return z ^ (z >> 31);
+}
+
+static double uniform01(uint64_t* state) {
+    return (splitmix64(state) >> 11) * (1.0 / 9007199254740992.0);
+}
+
+/** Particles resembling generate_data.py's disk: one heavy central body
+ * and N-1 light bodies on a centre-dense exponential disk of radius 10.
+ * Velocities are zero; the force kernels do not read them.
+ * ----------------------------------------------------------------- */
+static ParticleSystem make_disk(int N, uint64_t seed) {
+    ParticleSystem sys;
+    memset(&sys, 0, sizeof(sys));
+    sys.N     = N;
+    sys.pos_x = (double*)calloc(N, sizeof(double));
+    sys.pos_y = (double*)calloc(N, sizeof(double));
+    sys.mass  = (double*)calloc(N, sizeof(double));
+    sys.vx    = (double*)calloc(N, sizeof(double));
+    sys.vy    = (double*)calloc(N, sizeof(double));
+    sys.fx    = (double*)calloc(N, sizeof(double));
+    sys.fy    = (double*)calloc(N, sizeof(double));
+    if (!sys.pos_x || !sys.pos_y || !sys.mass || !sys.vx || !sys.vy ||
+        !sys.fx || !sys.fy) {
+        fprintf(stderr, "Allocation failed at N=%d\n", N);
+        exit(1);
+    }
+
+    const double r_min = 0.05, radius = 10.0, r_scale = 2.0;
+    const double z = 1.0 - exp(-(radius - r_min) / r_scale);
+    uint64_t state = seed;
+    sys.mass[0] = 100.0;
+    for (int i = 1; i < N; i++) {
+        double theta = 2.0 * M_PI * uniform01(&state);
+        double r     = r_min - r_scale * log(1.0 - uniform01(&state) * z);
+        sys.pos_x[i] = r * cos(theta);
+        sys.pos_y[i] = r * sin(theta);
+        sys.mass[i]  = 1e-3 + 9e-3 * uniform01(&state);
+    }
+    return sys;
+}
+
+/** Particles like generate_data.py's random mode: uniform in [-1, 1]^2
+ * with masses uniform in [0.1, 10].
+ * ----------------------------------------------------------------- */
+static ParticleSystem make_uniform(int N, uint64_t seed) {
+    ParticleSystem sys = make_disk(N, seed);
+    uint64_t state = seed;
+    for (int i = 0; i < N; i++) {
+        sys.pos_x[i] = 2.0 * uniform01(&state) - 1.0;
+        sys.pos_y[i] = 2.0 * uniform01(&state) - 1.0;
+        sys.mass[i]  = 0.1 + 9.9 * uniform01(&state);
+    }
+    return sys;
+}
+
+static int compare_double(const void* a, const void* b) {
+    double da = *(const double*)a, db = *(const double*)b;
+    return (da > db) - (da < db);
+}
+
+/* Median of trials[1..n-1]; trials[0] is the warm-up run */
+static double median_after_warmup(double* trials, int n) {
+    qsort(trials + 1, n - 1, sizeof(double), compare_double);
+    int m = n - 1;
+    return (m % 2) ? trials[1 + m / 2]
+                   : 0.5 * (trials[m / 2] + trials[1 + m / 2]);
+}
+
+/** Sort random Morton entries with qsort and with the radix sort.
+ * Without an argument the radix sort uses the thread count paired with
+ * each N in the weak-scaling sweep.
+ * ----------------------------------------------------------------- */
+static int bench_sort(int argc, char* argv[]) {
+    int fixed_threads = argc >= 1 ? atoi(argv[0]) : 0;
+
+    printf("%10s %8s %12s %12s %8s\n", "N", "threads", "qsort_s", "radix_s",
+           "speedup");
+    for (int w = 0; w < N_WEAK; w++) {
+        int N = WEAK_N[w];
+        int n_threads = fixed_threads > 0 ? fixed_threads : WEAK_THREADS[w];
+
+        SortEntry* input   = (SortEntry*)malloc(N * sizeof(SortEntry));
+        SortEntry* entries = (SortEntry*)malloc(N * sizeof(SortEntry));
+        SortEntry* scratch = (SortEntry*)malloc(N * sizeof(SortEntry));
+        if (!input || !entries || !scratch) {
+            fprintf(stderr, "Allocation failed at N=%d\n", N);
+            return 1;
+        }
+        uint64_t state = 42;
+        for (int i = 0; i < N; i++) {
+            input[i].index = i;
+            input[i].code  = splitmix64(&state);
+        }
+
+        double t_qsort[BENCH_REPEATS], t_radix[BENCH_REPEATS];
+        for (int r = 0; r < BENCH_REPEATS; r++) {
+            memcpy(entries, input, N * sizeof(SortEntry));
+            double t0 = sim_time_now();
+            morton_sort_qsort(entries, N);
+            t_qsort[r] = sim_time_now() - t0;
+
+            memcpy(entries, input, N * sizeof(SortEntry));
+            t0 = sim_time_now();
+            morton_sort_radix(entries, scratch, N, n_threads);
+            t_radix[r] = sim_time_now() - t0;
+        }
+        for (int i = 1; i < N; i++) {
+            if (entries[i - 1].code > entries[i].code) {
+                fprintf(stderr, "Radix sort produced unsorted output at N=%d\n", N);
+                return 1;
+            }
+        }
+
+        double q = median_after_warmup(t_qsort, BENCH_REPEATS);
+        double r = median_after_warmup(t_radix, BENCH_REPEATS);
+        printf("%10d %8d %12.4f %12.4f %7.2fx\n", N, n_threads, q, r, q / r);
+
+        free(input);
+        free(entries);
+        free(scratch);
+    }
+    return 0;
+}
+
+typedef uint64_t (*EncodeFn)(uint32_t x, uint32_t y);
+typedef void (*DecodeFn)(uint64_t code, uint32_t* x, uint32_t* y);
+
+static uint64_t encode_magic(uint32_t x, uint32_t y) {
+    return morton_encode(x, y);
+}
+
+static void decode_magic(uint64_t code, uint32_t* x, uint32_t* y) {
+    morton_decode(code, x, y);
+}
+
+/** Encode N random coordinate pairs with each encoder, then decode them,
+ * and report codes per second. All encoders must agree with the loop.
+ * ----------------------------------------------------------------- */
+static int bench_encode(int argc, char* argv[]) {
+    int N = argc >= 1 ? atoi(argv[0]) : (1 << 22);
+    if (N <= 0) return 1;
+
+    static const struct { const char* name; EncodeFn fn; } encoders[] = {
+        { "loop",  morton_encode_loop },
+        { "magic", encode_magic },
+        { "lut",   morton_encode_lut },
+        { "pdep",  morton_encode_pdep },
+    };
+    static const struct { const char* name; DecodeFn fn; } decoders[] = {
+        { "magic", decode_magic },
+        { "pdep",  morton_decode_pdep },
+    };
+    int n_enc = (int)(sizeof(encoders) / sizeof(encoders[0]));
+    int n_dec = (int)(sizeof(decoders) / sizeof(decoders[0]));
+
+    uint32_t* x     = (uint32_t*)malloc(N * sizeof(uint32_t));
+    uint32_t* y     = (uint32_t*)malloc(N * sizeof(uint32_t));
+    uint64_t* codes = (uint64_t*)malloc(N * sizeof(uint64_t));
+    if (!x || !y || !codes) {
+        fprintf(stderr, "Allocation failed at N=%d\n", N);
+        return 1;
+    }
+    uint64_t state = 42;
+    for (int i = 0; i < N; i++) {
+        uint64_t r = splitmix64(&state);
+        x[i] = (uint32_t)r;
+        y[i] = (uint32_t)(r >> 32);
+        codes[i] = morton_encode_loop(x[i], y[i]);
+    }
+
+    printf("N=%d  bmi2=%s\n", N, morton_have_bmi2() ? "yes" : "no (pdep falls back to magic)");
+    printf("%-8s %-6s %14s\n", "op", "impl", "Mcodes/s");
+
+    for (int e = 0; e < n_enc; e++) {
+        for (int i = 0; i < N; i++) {
+            if (encoders[e].fn(x[i], y[i]) != codes[i]) {
+                fprintf(stderr, "Encoder %s disagrees at %d\n", encoders[e].name, i);
+                return 1;
+            }
+        }
+        double trials[BENCH_REPEATS];
+        uint64_t sink = 0;
+        for (int r = 0; r < BENCH_REPEATS; r++) {
+            double t0 = sim_time_now();
+            for (int i = 0; i < N; i++) sink ^= encoders[e].fn(x[i], y[i]);
+            trials[r] = sim_time_now() - t0;
+        }
+        double t = median_after_warmup(trials, BENCH_REPEATS);
+        bench_sink = sink;
+        printf("%-8s %-6s %14.1f\n", "encode", encoders[e].name, N / t * 1e-6);
+    }
+
+    for (int d = 0; d < n_dec; d++) {
+        for (int i = 0; i < N; i++) {
+            uint32_t dx, dy;
+            decoders[d].fn(codes[i], &dx, &dy);
+            if (dx != x[i] || dy != y[i]) {
+                fprintf(stderr, "Decoder %s disagrees at %d\n", decoders[d].name, i);
+                return 1;
+            }
+        }
+        double trials[BENCH_REPEATS];
+        uint32_t sink = 0;
+        for (int r = 0; r < BENCH_REPEATS; r++) {
+            double t0 = sim_time_now();
+            for (int i = 0; i < N; i++) {
+                uint32_t dx, dy;
+                decoders[d].fn(codes[i], &dx, &dy);
+                sink ^= dx ^ dy;
+            }
+            trials[r] = sim_time_now() - t0;
+        }
+        double t = median_after_warmup(trials, BENCH_REPEATS);
+        bench_sink = sink;
+        printf("%-8s %-6s %14.1f\n", "decode", decoders[d].name, N / t * 1e-6);
+    }
+
+    free(x);
+    free(y);
+    free(codes);
+    return 0;
+}
+
+/** Time tree build and force walk for each node layout on the same disk.
+ * For the SoA view and the group walk over it, bytes is the total per
+ * node across its arrays.
+ * ----------------------------------------------------------------- */
+static int bench_walk(int argc, char* argv[]) {
+    static const int default_N[] = { 100000, 1000000 };
+    int n_threads = argc >= 1 ? atoi(argv[0]) : 1;
+    int n_sizes   = argc >= 2 ? argc - 1 : 2;
+    if (n_threads <= 0) return 1;
+
+    static const struct { const char* name; int walk; size_t bytes; } layouts[] = {
+        { "pointer", TREE_WALK_POINTER, sizeof(TNode) },
+        { "packed",  TREE_WALK_PACKED,  sizeof(PackedNode) },
+        { "soa",     TREE_WALK_SOA,
+          4 * sizeof(double) + 2 * sizeof(int) },
+        { "group",   TREE_WALK_GROUP,
+          4 * sizeof(double) + 2 * sizeof(int) },
+    };
+    int n_layouts = (int)(sizeof(layouts) / sizeof(layouts[0]));
+
+    printf("%10s %-8s %6s %10s %10s %10s\n", "N", "layout", "bytes",
+           "nodes/line", "tree_s", "force_s");
+    for (int s = 0; s < n_sizes; s++) {
+        int N = argc >= 2 ? atoi(argv[s + 1]) : default_N[s];
+        if (N <= 1) return 1;
+        for (int l = 0; l < n_layouts; l++) {
+            ParticleSystem sys = make_disk(N, 7);
+            KernelConfig config;
+            memset(&config, 0, sizeof(config));
+            config.theta_max = 0.5;
+            config.n_threads = n_threads;
+            config.tree_walk = layouts[l].walk;
+
+            double tree[BENCH_REPEATS], force[BENCH_REPEATS];
+            for (int r = 0; r < BENCH_REPEATS; r++) {
+                KernelStats before = config.stats;
+                compute_force_barnes_hut(&sys, &config);
+                tree[r]  = config.stats.tree_time - before.tree_time;
+                force[r] = config.stats.force_time - before.force_time;
+            }
+            printf("%10d %-8s %6zu %10.2f %10.4f %10.4f\n", N, layouts[l].name,
+                   layouts[l].bytes, 64.0 / layouts[l].bytes,
+                   median_after_warmup(tree, BENCH_REPEATS),
+                   median_after_warmup(force, BENCH_REPEATS));
+            io_free_particles(&sys);
+        }
+    }
+    return 0;
+}
+
+/** Evaluate one interaction list of disk bodies for a set of targets
+ * with each force kernel on a single thread. Reports interactions per
+ * second and the largest force deviation from the scalar kernel.
+ * ----------------------------------------------------------------- */
+static int bench_kernel(int argc, char* argv[]) {
+    int count   = argc >= 1 ? atoi(argv[0]) : 4096;
+    int targets = argc >= 2 ? atoi(argv[1]) : 1024;
+    if (count <= 0 || targets <= 0 || targets > count) return 1;
+
+    static const struct { const char* name; int kind; } kernels[] = {
+        { "scalar", FORCE_KERNEL_SCALAR },
+        { "simd",   FORCE_KERNEL_SIMD },
+        { "avx2",   FORCE_KERNEL_AVX2 },
+        { "avx512", FORCE_KERNEL_AVX512 },
+    };
+    int n_kernels = (int)(sizeof(kernels) / sizeof(kernels[0]));
+
+    ParticleSystem sys = make_disk(count, 11);
+    double* ref_fx = (double*)malloc(targets * sizeof(double));
+    double* ref_fy = (double*)malloc(targets * sizeof(double));
+    if (!ref_fx || !ref_fy) {
+        fprintf(stderr, "Allocation failed at targets=%d\n", targets);
+        return 1;
+    }
+
+    printf("list=%d  targets=%d\n", count, targets);
+    printf("%-8s %-8s %14s %12s\n", "kernel", "runs_as", "Minteract/s", "max_rel_err");
+    static const char* names[] = { "scalar", "simd", "avx2", "avx512" };
+    for (int k = 0; k < n_kernels; k++) {
+        ForceKernel fn = force_kernel_select(kernels[k].kind);
+        double trials[BENCH_REPEATS];
+        double max_err = 0.0;
+        for (int r = 0; r < BENCH_REPEATS; r++) {
+            double t0 = sim_time_now();
+            for (int i = 0; i < targets; i++) {
+                double fx = 0.0, fy = 0.0;
+                fn(sys.pos_x[i], sys.pos_y[i], sys.mass[i], sys.pos_x,
+                   sys.pos_y, sys.mass, count, &fx, &fy);
+                sys.fx[i] = fx;
+                sys.fy[i] = fy;
+            }
+            trials[r] = sim_time_now() - t0;
+        }
+        for (int i = 0; i < targets; i++) {
+            if (k == 0) {
+                ref_fx[i] = sys.fx[i];
+                ref_fy[i] = sys.fy[i];
+                continue;
+            }
+            double norm = hypot(ref_fx[i], ref_fy[i]);
+            double err  = hypot(sys.fx[i] - ref_fx[i], sys.fy[i] - ref_fy[i]);
+            if (norm > 0.0 && !(err / norm <= max_err)) max_err = err / norm;
+        }
+        double t = median_after_warmup(trials, BENCH_REPEATS);
+        printf("%-8s %-8s %14.1f %12.2e\n", kernels[k].name,
+               names[force_kernel_resolve(kernels[k].kind)],
+               (double)targets * count / t * 1e-6, max_err);
+    }
+
+    free(ref_fx);
+    free(ref_fy);
+    io_free_particles(&sys);
+    return 0;
+}
+
+/* Median and 99th percentile of the relative force error of up to
+ * MAX_SAMPLE particles against a direct sum over all bodies */
+#define MAX_SAMPLE 256
+static void sampled_force_error(const ParticleSystem* sys, double* p50,
+                                double* p99) {
+    ForceKernel direct = force_kernel_select(FORCE_KERNEL_AVX512);
+    double G = 100.0 / sys->N;
+    double err[MAX_SAMPLE];
+    int n = 0;
+    int step = sys->N / MAX_SAMPLE > 0 ? sys->N / MAX_SAMPLE : 1;
+    for (int i = 0; i < sys->N && n < MAX_SAMPLE; i += step) {
+        double fx = 0.0, fy = 0.0;
+        direct(sys->pos_x[i], sys->pos_y[i], G * sys->mass[i], sys->pos_x,
+               sys->pos_y, sys->mass, sys->N, &fx, &fy);
+        double norm = hypot(fx, fy);
+        err[n++] = norm > 0.0 ? hypot(sys->fx[i] - fx, sys->fy[i] - fy) / norm : 0.0;
+    }
+    qsort(err, n, sizeof(double), compare_double);
+    *p50 = err[n / 2];
+    *p99 = err[(n * 99) / 100];
+}
+
+/** Force phase and sampled accuracy of the FMM at several orders against
+ * the linear-tree Barnes-Hut (leaf buckets of 8), both at theta = 0.5.
+ * ----------------------------------------------------------------- */
+static int bench_fmm(int argc, char* argv[]) {
+    static const int default_N[] = { 100000, 1000000, 10000000 };
+    int n_threads = argc >= 1 ? atoi(argv[0]) : 1;
+    int n_sizes   = argc >= 2 ? argc - 1 : 3;
+    if (n_threads <= 0) return 1;
+
+    static const struct { const char* name; int version, order; } engines[] = {
+        { "bh",    2, 0 },
+        { "fmm-2", 3, 2 },
+        { "fmm-4", 3, 4 },
+        { "fmm-6", 3, 6 },
+        { "fmm-8", 3, 8 },
+    };
+    int n_engines = (int)(sizeof(engines) / sizeof(engines[0]));
+
+    printf("%10s %-6s %10s %10s %10s %10s\n", "N", "engine", "tree_s", "force_s",
+           "err_p50", "err_p99");
+    for (int s = 0; s < n_sizes; s++) {
+        int N = argc >= 2 ? atoi(argv[s + 1]) : default_N[s];
+        if (N <= 1) return 1;
+        for (int e = 0; e < n_engines; e++) {
+            ParticleSystem sys = make_disk(N, 7);
+            KernelConfig config;
+            memset(&config, 0, sizeof(config));
+            config.theta_max    = 0.5;
+            config.n_threads    = n_threads;
+            config.tree_build   = TREE_BUILD_LINEAR;
+            config.leaf_size    = engines[e].version == 2 ? 8 : 0;
+            config.fmm_order    = engines[e].order;
+            config.force_kernel = FORCE_KERNEL_AVX512;
+
+            double tree[BENCH_REPEATS], force[BENCH_REPEATS];
+            for (int r = 0; r < BENCH_REPEATS; r++) {
+                KernelStats before = config.stats;
+                if (engines[e].version == 2) compute_force_barnes_hut(&sys, &config);
+                else                         compute_force_fmm(&sys, &config);
+                tree[r]  = config.stats.tree_time - before.tree_time;
+                force[r] = config.stats.force_time - before.force_time;
+            }
+            double p50, p99;
+            sampled_force_error(&sys, &p50, &p99);
+            printf("%10d %-6s %10.4f %10.4f %10.2e %10.2e\n", N, engines[e].name,
+                   median_after_warmup(tree, BENCH_REPEATS),
+                   median_after_warmup(force, BENCH_REPEATS), p50, p99);
+            io_free_particles(&sys);
+        }
+    }
+    return 0;
+}
+
+/** Force phase per particle and sampled accuracy of the pointer walk and
+ * the dual-tree walk on uniform bodies. The per-particle walk grows as
+ * N log N; the dual walk should stay flat per particle.
+ * ----------------------------------------------------------------- */
+static int bench_dual(int argc, char* argv[]) {
+    static const int default_N[] = { 100000, 200000, 400000 };
+    int n_threads = argc >= 1 ? atoi(argv[0]) : 1;
+    int n_sizes   = argc >= 2 ? argc - 1 : 3;
+    if (n_threads <= 0) return 1;
+
+    static const struct { const char* name; int walk; double theta; } walks[] = {
+        { "pointer", TREE_WALK_POINTER, 0.5 },
+        { "dual",    TREE_WALK_DUAL,    0.3 },
+        { "dual",    TREE_WALK_DUAL,    0.5 },
+    };
+    int n_walks = (int)(sizeof(walks) / sizeof(walks[0]));
+
+    printf("%10s %-8s %6s %10s %10s %10s %10s %10s\n", "N", "walk", "theta",
+           "tree_s", "force_s", "force_us", "err_p50", "err_p99");
+    for (int s = 0; s < n_sizes; s++) {
+        int N = argc >= 2 ? atoi(argv[s + 1]) : default_N[s];
+        if (N <= 1) return 1;
+        for (int w = 0; w < n_walks; w++) {
+            ParticleSystem sys = make_uniform(N, 7);
+            KernelConfig config;
+            memset(&config, 0, sizeof(config));
+            config.theta_max = walks[w].theta;
+            config.n_threads = n_threads;
+            config.tree_walk = walks[w].walk;
+
+            double tree[BENCH_REPEATS], force[BENCH_REPEATS];
+            for (int r = 0; r < BENCH_REPEATS; r++) {
+                KernelStats before = config.stats;
+                compute_force_barnes_hut(&sys, &config);
+                tree[r]  = config.stats.tree_time - before.tree_time;
+                force[r] = config.stats.force_time - before.force_time;
+            }
+            double p50, p99;
+            sampled_force_error(&sys, &p50, &p99);
+            double force_s = median_after_warmup(force, BENCH_REPEATS);
+            printf("%10d %-8s %6.2f %10.4f %10.4f %10.3f %10.2e %10.2e\n", N,
+                   walks[w].name, walks[w].theta,
+                   median_after_warmup(tree, BENCH_REPEATS), force_s,
+                   1e6 * force_s / N, p50, p99);
+            io_free_particles(&sys);
+        }
+    }
+    return 0;
+}
+
+/* Constants of the force engines, for the potential energy */
+static const double BENCH_G_FACTOR = 100.0;
+static const double BENCH_EPSILON  = 1e-3;
+
+/** Kinetic plus potential energy. The engines' pair force
+ * G m_i m_j r / (r + eps)^3 derives from the potential
+ * -G m_i m_j (1 / (r + eps) - eps / (2 (r + eps)^2)).
+ * ----------------------------------------------------------------- */
+static double total_energy(const ParticleSystem* sys) {
+    const int N = sys->N;
+    const double G = BENCH_G_FACTOR / N;
+    double kinetic = 0.0, potential = 0.0;
+    for (int i = 0; i < N; i++) {
+        kinetic += 0.5 * sys->mass[i] *
+                   (sys->vx[i] * sys->vx[i] + sys->vy[i] * sys->vy[i]);
+        double u = 0.0;
+        for (int j = i + 1; j < N; j++) {
+            double dx = sys->pos_x[j] - sys->pos_x[i];
+            double dy = sys->pos_y[j] - sys->pos_y[i];
+            double d  = sqrt(dx * dx + dy * dy) + BENCH_EPSILON;
+            u += sys->mass[j] * (1.0 / d - 0.5 * BENCH_EPSILON / (d * d));
+        }
+        potential -= G * sys->mass[i] * u;
+    }
+    return kinetic + potential;
+}
+
+/** Relative energy drift after time T of each registered integrator at
+ * a range of dt, against the force evaluations it spent. Bodies start
+ * on circular orbits about the central mass of the disk and feel exact
+ * (naive) forces, so the drift is the integrator's alone. A
+ * fourth-order scheme should reach a given drift at a larger dt than
+ * Verlet, and with fewer evaluations once the target is tight.
+ * ----------------------------------------------------------------- */
+static int bench_integrators(int argc, char* argv[]) {
+    static const double default_dt[] = { 8e-4, 4e-4, 2e-4, 1e-4 };
+    int    N       = argc >= 1 ? atoi(argv[0]) : 1000;
+    double T       = argc >= 2 ? atof(argv[1]) : 0.05;
+    int    n_dt    = argc >= 3 ? argc - 2 : 4;
+    if (N <= 1 || T <= 0.0) return 1;
+
+    printf("%-12s %10s %8s %8s %10s %10s\n", "integrator", "dt", "steps",
+           "forces", "time_s", "dE/E");
+    for (int s = 0; s < N_INTEGRATORS; s++) {
+        for (int d = 0; d < n_dt; d++) {
+            double dt = argc >= 3 ? atof(argv[d + 2]) : default_dt[d];
+            if (dt <= 0.0) return 1;
+            int nsteps = (int)(T / dt + 0.5);
+            if (nsteps < 1) nsteps = 1;
+
+            ParticleSystem sys = make_disk(N, 11);
+            double gm = BENCH_G_FACTOR / N * sys.mass[0];
+            for (int i = 1; i < N; i++) {
+                double r = sqrt(sys.pos_x[i] * sys.pos_x[i] +
+                                sys.pos_y[i] * sys.pos_y[i]);
+                double w = sqrt(gm / pow(r + BENCH_EPSILON, 3));
+                sys.vx[i] = -w * sys.pos_y[i];
+                sys.vy[i] =  w * sys.pos_x[i];
+            }
+            KernelConfig config;
+            memset(&config, 0, sizeof(config));
+            config.n_threads = 1;
+
+            double e0 = total_energy(&sys);
+            compute_force_naive(&sys, &config);
+            double t0 = sim_time_now();
+            long long n_forces = integrate_split(&sys, &config,
+                                                 compute_force_naive,
+                                                 &INTEGRATORS[s], nsteps,
+                                                 dt, 0);
+            double elapsed = sim_time_now() - t0;
+            double e1 = total_energy(&sys);
+            printf("%-12s %10.2e %8d %8lld %10.3f %10.2e\n",
+                   INTEGRATORS[s].name, dt, nsteps, n_forces + 1, elapsed,
+                   fabs(e1 - e0) / fabs(e0));
+            io_free_particles(&sys);
+        }
+    }
+    return 0;
+}
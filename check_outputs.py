@@ -0,0 +1,145 @@
+"""
+Bit-for-bit regression check of nbody_simulate against the baseline engine.
+
+  record: build the repository's first commit (the baseline engine), run
+          it on every case below and keep its final states in
+          data/outputs/reference/
+  check:  record first if those references are missing or stale, then
+          run the given binary on every case and compare each result
+          byte for byte
+
+Each case runs the baseline with its default settings. The binary under
+test runs with the same positional arguments plus the case's options,
+all of which must leave the results unchanged. Inputs are generated with
+fixed seeds.
+"""
+
+import filecmp
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import generate_data
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+REFERENCE_DIR = os.path.join(ROOT, "data", "outputs", "reference")
+STAMP = os.path.join(REFERENCE_DIR, "baseline_rev")
+
+INPUTS = {
+    # name: (generator, N, seed)
+    "disk": (generate_data.generate_disk, 2000, 1),
+    "random": (generate_data.generate_random, 2000, 2),
+}
+
+LABELS = {1: "naive", 2: "barnes_hut"}
+
+# name: (version, input, n_threads, options of the binary under test)
+CASES = {
+    "naive": (1, "disk", 1, []),
+    "naive_threads": (1, "random", 2, []),
+    "bh": (2, "disk", 1, []),
+    "bh_threads": (2, "random", 2, []),
+    "bh_radix": (2, "disk", 1, ["--sort=radix"]),
+    "bh_incremental": (2, "disk", 1, ["--sort=incremental"]),
+    "bh_packed": (2, "disk", 1, ["--walk=packed"]),
+    "bh_soa": (2, "disk", 1, ["--walk=soa"]),
+}
+# The baseline only parses <version> N <input> [nsteps] [n_threads], with
+# dt = 1e-5 and theta = 0.5
+STEPS = 20
+
+
+def input_path(name):
+    """Generate the input file of `name` once, from its fixed seed."""
+    generator, n, seed = INPUTS[name]
+    path = os.path.join(ROOT, "data", "inputs", f"check_{name}.gal")
+    if not os.path.exists(path):
+        random.seed(seed)
+        generator(n, path)
+    return path
+
+
+def run_case(binary, cwd, name, options):
+    """Run one case from cwd and return the path of its result file."""
+    version, inp, n_threads, _ = CASES[name]
+    n = INPUTS[inp][1]
+    cmd = [binary, str(version), str(n), input_path(inp), str(STEPS),
+           str(n_threads)] + options
+    subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.DEVNULL)
+    return os.path.join(cwd, "data", "outputs", f"result_{LABELS[version]}.gal")
+
+
+def git(*args):
+    return subprocess.run(["git", "-C", ROOT] + list(args), check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+
+def baseline_rev():
+    return git("rev-list", "--max-parents=0", "HEAD").splitlines()[0]
+
+
+def record():
+    """Build the baseline engine in a scratch tree and record its outputs."""
+    rev = baseline_rev()
+    os.makedirs(REFERENCE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory() as tree:
+        archive = subprocess.run(["git", "-C", ROOT, "archive", rev],
+                                 check=True, capture_output=True).stdout
+        subprocess.run(["tar", "-x", "-C", tree], input=archive, check=True)
+        build = os.path.join(tree, "build")
+        subprocess.run(["cmake", "-S", tree, "-B", build,
+                        "-DCMAKE_BUILD_TYPE=Release"], check=True,
+                       stdout=subprocess.DEVNULL)
+        subprocess.run(["cmake", "--build", build], check=True,
+                       stdout=subprocess.DEVNULL)
+        os.makedirs(os.path.join(tree, "data", "outputs"), exist_ok=True)
+        binary = os.path.join(build, "nbody_simulate")
+        for name in CASES:
+            shutil.copyfile(run_case(binary, tree, name, []),
+                            os.path.join(REFERENCE_DIR, f"{name}.gal"))
+            print(f"recorded {name}")
+    with open(STAMP, "w") as f:
+        f.write(rev + "\n")
+    return 0
+
+
+def references_current():
+    if not os.path.exists(STAMP):
+        return False
+    with open(STAMP) as f:
+        if f.read().strip() != baseline_rev():
+            return False
+    return all(os.path.exists(os.path.join(REFERENCE_DIR, f"{name}.gal"))
+               for name in CASES)
+
+
+def check(binary):
+    try:
+        if not references_current():
+            record()
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"No references, and the baseline engine failed to build: {e}")
+        return 1
+    failed = []
+    for name, case in CASES.items():
+        result = run_case(binary, ROOT, name, case[3])
+        same = filecmp.cmp(result, os.path.join(REFERENCE_DIR, f"{name}.gal"),
+                           shallow=False)
+        print(f"{'identical' if same else 'DIFFERS  '} {name}")
+        if not same:
+            failed.append(name)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("record", "check"):
+        print("Usage: python3 check_outputs.py record|check [path/to/nbody_simulate]")
+        sys.exit(1)
+    if sys.argv[1] == "record":
+        sys.exit(record())
+    binary = os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 else \
+        os.path.join(ROOT, "build", "nbody_simulate")
+    sys.exit(check(binary))
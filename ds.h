@@ -11,6 +11,71 @@ typedef struct TNode {
     struct TNode* child[4];
 } TNode;
 
+/* Node of the linear (pointer-free) quadtree. Children are indices into
+ * the same flat array and each node covers a contiguous range of the
+ * Morton-sorted particles. */
+typedef struct {
+    double pos_x, pos_y, mass;
+    double size;       /* cell width */
+    int first, count;  /* particles [first, first + count) */
+    int child[4];      /* -1 if absent */
+} LNode;
+
+typedef struct {
+    LNode* nodes;
+    int    capacity;
+    int    size;
+} LinearTree;
+
+/* Compact copy of a TNode tree for the force walk: 32 bytes, two nodes
+ * per 64-byte cache line. Nodes are stored in depth-first order, so the
+ * first child of node n is n + 1 and skip is the index just past n's
+ * subtree; a leaf is a node with skip == n + 1. */
+typedef struct {
+    double pos_x, pos_y, mass;
+    float  size;  /* cell width */
+    int    skip;
+} PackedNode;
+
+/* Structure-of-arrays copy of a TNode tree in the same depth-first order
+ * as PackedNode, so the walk only streams the fields it reads. leaf is
+ * the particle index of a leaf and -1 for internal nodes. */
+typedef struct {
+    double* com_x;
+    double* com_y;
+    double* mass;
+    double* size;
+    int*    skip;
+    int*    leaf;
+    int     count;
+    size_t  capacity;
+} WalkView;
+
+/* Pseudo-bodies accepted by one group walk, evaluated for every particle
+ * of the group. Each thread owns one and reuses it across groups. */
+typedef struct {
+    double* pos_x;
+    double* pos_y;
+    double* mass;
+    int     count;
+    int     capacity;
+} InteractionList;
+
+/* Traceless quadrupole moment of a TNode about its centre of mass, kept
+ * beside the tree and only with --multipole=quadrupole */
+typedef struct {
+    double qxx, qxy, qyy;
+} CellQuadrupole;
+
+/* Second-order local field of a dual-walk target cell about its centre
+ * of mass: acceleration per unit G (gx, gy), its gradient, the tidal
+ * tensor (txx, txy, tyy), and the symmetric second derivatives. */
+typedef struct {
+    double gx, gy;
+    double txx, txy, tyy;
+    double hxxx, hxxy, hxyy, hyyy;
+} CellLocal;
+
 typedef struct {
     TNode* buffer;
     size_t capacity;
@@ -29,6 +94,18 @@ static inline TNode* arena_alloc(NodeArena* a) {
     return &a->buffer[a->size++];
 }
 
+/* Reserve n consecutive nodes; safe to call from concurrent threads. */
+static inline TNode* arena_alloc_block(NodeArena* a, size_t n) {
+    size_t start;
+#ifdef _OPENMP
+#pragma omp atomic capture
+#endif
+    { start = a->size; a->size += n; }
+    if (start + n > a->capacity)
+        return NULL;
+    return &a->buffer[start];
+}
+
 static inline void reset_arena(NodeArena* a) {
     a->size = 0;
 }
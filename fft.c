@@ -0,0 +1,109 @@
+#include "fft.h"
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+static const int TRANSPOSE_BLOCK = 32;  /* complex elements per tile side */
+
+/* Twiddles cos/sin(2 pi k / n), k < n/2, and the bit-reversal permutation
+ * for the last size used */
+static double* twiddle = NULL;
+static int*    bitrev  = NULL;
+static int     table_n = 0;
+
+static void init_tables(int n) {
+    if (table_n == n) return;
+    free(twiddle);
+    free(bitrev);
+    twiddle = (double*)malloc(n * sizeof(double));
+    bitrev  = (int*)malloc(n * sizeof(int));
+    if (!twiddle || !bitrev) {
+        fprintf(stderr, "Error: FFT table allocation failed!\n");
+        exit(1);
+    }
+    for (int k = 0; k < n / 2; k++) {
+        twiddle[2 * k]     = cos(2.0 * M_PI * k / n);
+        twiddle[2 * k + 1] = sin(2.0 * M_PI * k / n);
+    }
+    int bits = 0;
+    while ((1 << bits) < n) bits++;
+    for (int i = 0; i < n; i++) {
+        int r = 0;
+        for (int b = 0; b < bits; b++)
+            if (i & (1 << b)) r |= 1 << (bits - 1 - b);
+        bitrev[i] = r;
+    }
+    table_n = n;
+}
+
+/* Iterative radix-2 decimation-in-time transform of one row */
+static void fft_one(double* a, int n, int sign) {
+    for (int i = 0; i < n; i++) {
+        int j = bitrev[i];
+        if (i < j) {
+            double re = a[2 * i], im = a[2 * i + 1];
+            a[2 * i]     = a[2 * j];
+            a[2 * i + 1] = a[2 * j + 1];
+            a[2 * j]     = re;
+            a[2 * j + 1] = im;
+        }
+    }
+    for (int len = 2; len <= n; len <<= 1) {
+        int half = len >> 1, step = n / len;
+        for (int s = 0; s < n; s += len) {
+            for (int k = 0; k < half; k++) {
+                double wr = twiddle[2 * k * step];
+                double wi = sign * twiddle[2 * k * step + 1];
+                double* u = a + 2 * (s + k);
+                double* v = a + 2 * (s + k + half);
+                double tr = v[0] * wr - v[1] * wi;
+                double ti = v[0] * wi + v[1] * wr;
+                v[0] = u[0] - tr;
+                v[1] = u[1] - ti;
+                u[0] += tr;
+                u[1] += ti;
+            }
+        }
+    }
+}
+
+void fft_rows(double* data, int n, int count, int sign, int n_threads) {
+    init_tables(n);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) num_threads(n_threads)
+#else
+    (void)n_threads;
+#endif
+    for (int r = 0; r < count; r++)
+        fft_one(data + 2 * (size_t)r * n, n, sign);
+}
+
+void fft_transpose(double* data, int n, int n_threads) {
+    int n_blocks = (n + TRANSPOSE_BLOCK - 1) / TRANSPOSE_BLOCK;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, 1) num_threads(n_threads)
+#else
+    (void)n_threads;
+#endif
+    for (int bi = 0; bi < n_blocks; bi++) {
+        for (int bj = bi; bj < n_blocks; bj++) {
+            int i_end = (bi + 1) * TRANSPOSE_BLOCK < n ? (bi + 1) * TRANSPOSE_BLOCK : n;
+            int j_end = (bj + 1) * TRANSPOSE_BLOCK < n ? (bj + 1) * TRANSPOSE_BLOCK : n;
+            for (int i = bi * TRANSPOSE_BLOCK; i < i_end; i++) {
+                int j0 = bj == bi ? i + 1 : bj * TRANSPOSE_BLOCK;
+                for (int j = j0; j < j_end; j++) {
+                    double* p = data + 2 * ((size_t)i * n + j);
+                    double* q = data + 2 * ((size_t)j * n + i);
+                    double re = p[0], im = p[1];
+                    p[0] = q[0];
+                    p[1] = q[1];
+                    q[0] = re;
+                    q[1] = im;
+                }
+            }
+        }
+    }
+}
@@ -0,0 +1,16 @@
+#ifndef FFT_H
+#define FFT_H
+
+// Complex data is interleaved (re, im) doubles; an n x n grid is stored
+// row by row. n must be a power of two.
+
+// In-place FFT of rows [0, count) of an n-wide grid. sign = -1 is the
+// forward transform, +1 the inverse; neither is normalised.
+void fft_rows(double* data, int n, int count, int sign, int n_threads);
+
+// In-place transpose of an n x n complex grid. A 2D transform is
+// fft_rows, fft_transpose, fft_rows, which leaves the spectrum
+// transposed; the same sequence with sign = +1 undoes it.
+void fft_transpose(double* data, int n, int n_threads);
+
+#endif
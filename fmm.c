@@ -0,0 +1,454 @@
+#include "ds.h"
+#include "kernels.h"
+#include "linear_tree.h"
+#include "morton.h"
+#include "particles.h"
+#include "time_utils.h"
+#include "types.h"
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#define G_FACTOR 100.0
+#define EPSILON  1e-3
+
+/* Expansions are Cartesian Taylor series in the plane, truncated at total
+ * order p. Coefficient (a, b), the x^a y^b term, of order n = a + b is
+ * stored at n (n + 1) / 2 + b. */
+#define FMM_MAX_ORDER 10
+#define FMM_MAX_COEF  ((FMM_MAX_ORDER + 1) * (FMM_MAX_ORDER + 2) / 2)
+#define COEF(a, b)    (((a) + (b)) * ((a) + (b) + 1) / 2 + (b))
+
+static const int    FMM_DEFAULT_ORDER   = 4;
+static const int    FMM_DEFAULT_LEAF    = 32;
+static const int    FMM_TASK_MIN        = 4096;  /* smaller targets stay in one task */
+static const double DOMAIN_PADDING_FRAC = 0.05;
+
+/* Tree and expansions, kept across timesteps */
+static LinearTree ftree    = {NULL, 0, 0};
+static uint64_t*  fcodes   = NULL;
+static int        fcodes_N = 0;
+static double*    mpole    = NULL;  /* multipole moments about each node's COM */
+static double*    local    = NULL;  /* local expansion about each node's COM */
+static double*    radius   = NULL;  /* max distance from COM to a node's particles */
+static int        node_cap = 0;
+
+static int         order  = 0;
+static int         n_coef = 0;
+static double      G_val  = 0.0;
+static int         force_store = FORCE_STORE_FORCE;
+static double      theta2 = 0.0;
+static ForceKernel kernel_fn = NULL;
+
+/* Tables depending only on the maximum order */
+static int    tables_ready = 0;
+static double fact[2 * FMM_MAX_ORDER + 2];
+static double dcoef[FMM_MAX_ORDER + 1][FMM_MAX_ORDER + 1];
+static double hcoef[FMM_MAX_ORDER + 1][FMM_MAX_ORDER / 2 + 1];
+
+static void init_tables(void);
+static void bounding_square(const ParticleSystem* sys, double* LB, double* RB,
+                            double* DB, double* UB);
+static void ensure_capacity(int n_nodes);
+static void upward(const ParticleSystem* sys, int n);
+static void interact(ParticleSystem* sys, int b, int a);
+static void downward(ParticleSystem* sys, int n);
+static void kernel_derivatives(double x, double y, double* T);
+
+static inline int is_leaf_node(const LNode* node) {
+    return node->child[0] < 0 && node->child[1] < 0 &&
+           node->child[2] < 0 && node->child[3] < 0;
+}
+
+/* pw[k] = d^k / k! for k = 0..p */
+static inline void scaled_powers(double d, double* pw) {
+    pw[0] = 1.0;
+    for (int k = 1; k <= order; k++) pw[k] = pw[k - 1] * d / k;
+}
+
+/** Fast multipole method on the linear quadtree.
+ * Particles are Morton-sorted and grouped into leaf buckets; the upward
+ * pass forms multipoles, a dual-tree traversal converts well-separated
+ * pairs into local expansions (and sums the rest directly), and the
+ * downward pass pushes locals to the leaves and evaluates them.
+ * ----------------------------------------------------------------- */
+void compute_force_fmm(ParticleSystem* sys, KernelConfig* config) {
+    int N = sys->N;
+    double t_start = sim_time_now();
+    if (!tables_ready) init_tables();
+
+    if (fcodes == NULL || fcodes_N != N) {
+        free(fcodes);
+        fcodes = (uint64_t*)malloc(N * sizeof(uint64_t));
+        if (!fcodes) {
+            fprintf(stderr, "Error: Morton code allocation failed!\n");
+            exit(1);
+        }
+        fcodes_N = N;
+    }
+
+    double LB, RB, DB, UB;
+    bounding_square(sys, &LB, &RB, &DB, &UB);
+    z_order_sort(sys, config, LB, RB, DB, UB, fcodes);
+    double t_ordered = sim_time_now();
+    config->stats.order_time += t_ordered - t_start;
+
+    order = config->fmm_order > 0 ? config->fmm_order : FMM_DEFAULT_ORDER;
+    if (order > FMM_MAX_ORDER) order = FMM_MAX_ORDER;
+    n_coef    = (order + 1) * (order + 2) / 2;
+    G_val     = G_FACTOR / N;
+    force_store = config->force_store;
+    theta2    = config->theta_max * config->theta_max;
+    kernel_fn = force_kernel_select(config->force_kernel);
+
+    int leaf = config->leaf_size > 1 ? config->leaf_size : FMM_DEFAULT_LEAF;
+    linear_tree_build(&ftree, sys, fcodes, RB - LB, leaf);
+    ensure_capacity(ftree.size);
+    if (ftree.size > 0) {
+#ifdef _OPENMP
+#pragma omp parallel num_threads(config->n_threads)
+#pragma omp single
+#endif
+        upward(sys, 0);
+    }
+    double t_built = sim_time_now();
+
+    memset(sys->fx, 0, N * sizeof(double));
+    memset(sys->fy, 0, N * sizeof(double));
+    memset(local, 0, (size_t)ftree.size * n_coef * sizeof(double));
+    if (ftree.size > 0) {
+#ifdef _OPENMP
+#pragma omp parallel num_threads(config->n_threads)
+#pragma omp single
+#endif
+        {
+            interact(sys, 0, 0);
+            downward(sys, 0);
+        }
+    }
+    config->stats.tree_time  += t_built - t_ordered;
+    config->stats.force_time += sim_time_now() - t_built;
+}
+
+/* Factorials, the radial-derivative recurrence and the Hermite-like
+ * coefficients a! / (2^k k! (a - 2k)!) used by kernel_derivatives. */
+static void init_tables(void) {
+    fact[0] = 1.0;
+    for (int k = 1; k < 2 * FMM_MAX_ORDER + 2; k++) fact[k] = fact[k - 1] * k;
+
+    /* D_n = sum_m dcoef[n][m] r^(m - 2n) g^(m)(r), D_(n+1) = D_n' / r */
+    memset(dcoef, 0, sizeof(dcoef));
+    dcoef[0][0] = 1.0;
+    for (int n = 0; n < FMM_MAX_ORDER; n++) {
+        for (int m = 0; m <= n; m++) {
+            dcoef[n + 1][m]     += (m - 2 * n) * dcoef[n][m];
+            dcoef[n + 1][m + 1] += dcoef[n][m];
+        }
+    }
+
+    for (int a = 0; a <= FMM_MAX_ORDER; a++)
+        for (int k = 0; 2 * k <= a; k++)
+            hcoef[a][k] = fact[a] / (ldexp(1.0, k) * fact[k] * fact[a - 2 * k]);
+    tables_ready = 1;
+}
+
+/* Smallest padded square containing every particle */
+static void bounding_square(const ParticleSystem* sys, double* LB, double* RB,
+                            double* DB, double* UB) {
+    double x_lo = sys->pos_x[0], x_hi = sys->pos_x[0];
+    double y_lo = sys->pos_y[0], y_hi = sys->pos_y[0];
+    for (int i = 1; i < sys->N; i++) {
+        if (sys->pos_x[i] < x_lo) x_lo = sys->pos_x[i];
+        if (sys->pos_x[i] > x_hi) x_hi = sys->pos_x[i];
+        if (sys->pos_y[i] < y_lo) y_lo = sys->pos_y[i];
+        if (sys->pos_y[i] > y_hi) y_hi = sys->pos_y[i];
+    }
+    double size = fmax(x_hi - x_lo, y_hi - y_lo);
+    if (size <= 0.0) size = 1.0;
+    double half = 0.5 * size * (1.0 + 2.0 * DOMAIN_PADDING_FRAC);
+    double cx = 0.5 * (x_lo + x_hi), cy = 0.5 * (y_lo + y_hi);
+    *LB = cx - half;
+    *RB = cx + half;
+    *DB = cy - half;
+    *UB = cy + half;
+}
+
+static void ensure_capacity(int n_nodes) {
+    if (node_cap >= n_nodes && mpole) return;
+    free(mpole);
+    free(local);
+    free(radius);
+    mpole  = (double*)malloc((size_t)n_nodes * FMM_MAX_COEF * sizeof(double));
+    local  = (double*)malloc((size_t)n_nodes * FMM_MAX_COEF * sizeof(double));
+    radius = (double*)malloc((size_t)n_nodes * sizeof(double));
+    if (!mpole || !local || !radius) {
+        fprintf(stderr, "Error: FMM expansion allocation failed!\n");
+        exit(1);
+    }
+    node_cap = n_nodes;
+}
+
+/** Post-order pass: P2M at the leaves, M2M into parents, and the
+ * enclosing radius of every node about its centre of mass.
+ * M_(a,b) = sum m dx^a dy^b / (a! b!) with d = particle - COM.
+ * ----------------------------------------------------------------- */
+static void upward(const ParticleSystem* sys, int n) {
+    const LNode* node = &ftree.nodes[n];
+    double* M = mpole + (size_t)n * n_coef;
+    memset(M, 0, n_coef * sizeof(double));
+    double px[FMM_MAX_ORDER + 1], py[FMM_MAX_ORDER + 1];
+
+    if (is_leaf_node(node)) {
+        double rad = 0.0;
+        for (int j = node->first; j < node->first + node->count; j++) {
+            double dx = sys->pos_x[j] - node->pos_x;
+            double dy = sys->pos_y[j] - node->pos_y;
+            double r  = sqrt(dx * dx + dy * dy);
+            if (r > rad) rad = r;
+            scaled_powers(dx, px);
+            scaled_powers(dy, py);
+            for (int a = 0; a <= order; a++)
+                for (int b = 0; a + b <= order; b++)
+                    M[COEF(a, b)] += sys->mass[j] * px[a] * py[b];
+        }
+        radius[n] = rad;
+        return;
+    }
+
+    for (int q = 0; q < 4; q++) {
+        int c = node->child[q];
+        if (c < 0) continue;
+        if (node->count >= FMM_TASK_MIN) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c)
+#endif
+            upward(sys, c);
+        } else {
+            upward(sys, c);
+        }
+    }
+#ifdef _OPENMP
+    if (node->count >= FMM_TASK_MIN) {
+#pragma omp taskwait
+    }
+#endif
+
+    double rad = 0.0;
+    for (int q = 0; q < 4; q++) {
+        int c = node->child[q];
+        if (c < 0) continue;
+        const LNode* child = &ftree.nodes[c];
+        const double* Mc = mpole + (size_t)c * n_coef;
+        double dx = child->pos_x - node->pos_x;
+        double dy = child->pos_y - node->pos_y;
+        double r  = sqrt(dx * dx + dy * dy) + radius[c];
+        if (r > rad) rad = r;
+        scaled_powers(dx, px);
+        scaled_powers(dy, py);
+        for (int a = 0; a <= order; a++)
+            for (int b = 0; a + b <= order; b++) {
+                double s = 0.0;
+                for (int g = 0; g <= a; g++)
+                    for (int h = 0; h <= b; h++)
+                        s += Mc[COEF(g, h)] * px[a - g] * py[b - h];
+                M[COEF(a, b)] += s;
+            }
+    }
+    radius[n] = rad;
+}
+
+/** T_(a,b) = d^a/dx^a d^b/dy^b g at (x, y) for every a + b <= p, where
+ * g(r) = 1/(r+eps) - eps/(2 (r+eps)^2) is the potential whose gradient
+ * is exactly the softened force -r_vec/(r+eps)^3 of the other engines.
+ * Uses D_n = (r^-1 d/dr)^n g and
+ * T_(a,b) = sum_k,l h(a,k) h(b,l) x^(a-2k) y^(b-2l) D_(a+b-k-l).
+ * ----------------------------------------------------------------- */
+static void kernel_derivatives(double x, double y, double* T) {
+    double r  = sqrt(x * x + y * y);
+    double iu = 1.0 / (r + EPSILON);
+    double ir = 1.0 / r;
+
+    double gm[FMM_MAX_ORDER + 1];
+    double upow = iu, sign = 1.0;
+    for (int m = 0; m <= order; m++) {
+        gm[m] = sign * (fact[m] * upow - 0.5 * EPSILON * fact[m + 1] * upow * iu);
+        upow *= iu;
+        sign = -sign;
+    }
+
+    double irpow[2 * FMM_MAX_ORDER + 1];
+    irpow[0] = 1.0;
+    for (int k = 1; k <= 2 * order; k++) irpow[k] = irpow[k - 1] * ir;
+
+    double D[FMM_MAX_ORDER + 1];
+    for (int n = 0; n <= order; n++) {
+        double s = 0.0;
+        for (int m = 0; m <= n; m++) s += dcoef[n][m] * irpow[2 * n - m] * gm[m];
+        D[n] = s;
+    }
+
+    double xp[FMM_MAX_ORDER + 1], yp[FMM_MAX_ORDER + 1];
+    xp[0] = yp[0] = 1.0;
+    for (int k = 1; k <= order; k++) {
+        xp[k] = xp[k - 1] * x;
+        yp[k] = yp[k - 1] * y;
+    }
+
+    for (int a = 0; a <= order; a++)
+        for (int b = 0; a + b <= order; b++) {
+            double s = 0.0;
+            for (int k = 0; 2 * k <= a; k++)
+                for (int l = 0; 2 * l <= b; l++)
+                    s += hcoef[a][k] * hcoef[b][l] * xp[a - 2 * k] *
+                         yp[b - 2 * l] * D[a + b - k - l];
+            T[COEF(a, b)] = s;
+        }
+}
+
+/* M2L: L_beta(b) += sum_alpha (-1)^|alpha| M_alpha(a) T_(alpha+beta) */
+static void m2l(int b, int a) {
+    const LNode* nb = &ftree.nodes[b];
+    const LNode* na = &ftree.nodes[a];
+    double T[FMM_MAX_COEF];
+    kernel_derivatives(nb->pos_x - na->pos_x, nb->pos_y - na->pos_y, T);
+
+    const double* M = mpole + (size_t)a * n_coef;
+    double* L = local + (size_t)b * n_coef;
+    for (int ba = 0; ba <= order; ba++)
+        for (int bb = 0; ba + bb <= order; bb++) {
+            double s = 0.0;
+            for (int aa = 0; ba + bb + aa <= order; aa++)
+                for (int ab = 0; ba + bb + aa + ab <= order; ab++) {
+                    double t = M[COEF(aa, ab)] * T[COEF(aa + ba, ab + bb)];
+                    s += ((aa + ab) & 1) ? -t : t;
+                }
+            L[COEF(ba, bb)] += s;
+        }
+}
+
+/* P2P: direct sum of source leaf a onto the particles of target leaf b */
+static void p2p(ParticleSystem* sys, int b, int a) {
+    const LNode* nb = &ftree.nodes[b];
+    const LNode* na = &ftree.nodes[a];
+    const double* x = sys->pos_x;
+    const double* y = sys->pos_y;
+    const double* m = sys->mass;
+    for (int i = nb->first; i < nb->first + nb->count; i++)
+        kernel_fn(x[i], y[i], G_val * sink_mass(sys, force_store, i),
+                  x + na->first, y + na->first, m + na->first, na->count,
+                  &sys->fx[i], &sys->fy[i]);
+}
+
+/** Dual-tree traversal of target node b against source node a.
+ * Well-separated pairs, (r_a + r_b) < theta * |COM_b - COM_a|, become
+ * one M2L; two nearby leaves are summed directly; otherwise the larger
+ * node is split. Only b's locals and particles are written, so target
+ * splits of big nodes run as tasks, and the taskwait keeps a later
+ * source of the same target from overlapping them.
+ * ----------------------------------------------------------------- */
+static void interact(ParticleSystem* sys, int b, int a) {
+    const LNode* nb = &ftree.nodes[b];
+    const LNode* na = &ftree.nodes[a];
+    double dx = nb->pos_x - na->pos_x;
+    double dy = nb->pos_y - na->pos_y;
+    double d2 = dx * dx + dy * dy;
+    double rr = radius[a] + radius[b];
+    if (a != b && d2 > 0.0 && rr * rr < theta2 * d2) {
+        m2l(b, a);
+        return;
+    }
+
+    int leaf_b = is_leaf_node(nb), leaf_a = is_leaf_node(na);
+    if (leaf_b && leaf_a) {
+        p2p(sys, b, a);
+        return;
+    }
+
+    if (leaf_a || (!leaf_b && radius[b] >= radius[a])) {
+        int spawn = nb->count >= FMM_TASK_MIN;
+        for (int q = 0; q < 4; q++) {
+            int c = nb->child[q];
+            if (c < 0) continue;
+            if (spawn) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c)
+#endif
+                interact(sys, c, a);
+            } else {
+                interact(sys, c, a);
+            }
+        }
+#ifdef _OPENMP
+        if (spawn) {
+#pragma omp taskwait
+        }
+#endif
+    } else {
+        for (int q = 0; q < 4; q++) {
+            int c = na->child[q];
+            if (c >= 0) interact(sys, b, c);
+        }
+    }
+}
+
+/** Pre-order pass: L2L into children, and L2P at the leaves, where
+ * F = G m grad(phi) and d(phi)/dx = sum_beta L_(beta+e_x) d^beta / beta!.
+ * ----------------------------------------------------------------- */
+static void downward(ParticleSystem* sys, int n) {
+    const LNode* node = &ftree.nodes[n];
+    const double* L = local + (size_t)n * n_coef;
+    double px[FMM_MAX_ORDER + 1], py[FMM_MAX_ORDER + 1];
+
+    if (is_leaf_node(node)) {
+        for (int i = node->first; i < node->first + node->count; i++) {
+            scaled_powers(sys->pos_x[i] - node->pos_x, px);
+            scaled_powers(sys->pos_y[i] - node->pos_y, py);
+            double gx = 0.0, gy = 0.0;
+            for (int a = 0; a < order; a++)
+                for (int b = 0; a + b < order; b++) {
+                    double w = px[a] * py[b];
+                    gx += L[COEF(a + 1, b)] * w;
+                    gy += L[COEF(a, b + 1)] * w;
+                }
+            double gm = G_val * sink_mass(sys, force_store, i);
+            sys->fx[i] += gm * gx;
+            sys->fy[i] += gm * gy;
+        }
+        return;
+    }
+
+    int spawn = node->count >= FMM_TASK_MIN;
+    for (int q = 0; q < 4; q++) {
+        int c = node->child[q];
+        if (c < 0) continue;
+        const LNode* child = &ftree.nodes[c];
+        double* Lc = local + (size_t)c * n_coef;
+        scaled_powers(child->pos_x - node->pos_x, px);
+        scaled_powers(child->pos_y - node->pos_y, py);
+        for (int a = 0; a <= order; a++)
+            for (int b = 0; a + b <= order; b++) {
+                double s = 0.0;
+                for (int g = a; g <= order; g++)
+                    for (int h = b; g + h <= order; h++)
+                        s += L[COEF(g, h)] * px[g - a] * py[h - b];
+                Lc[COEF(a, b)] += s;
+            }
+        if (spawn) {
+#ifdef _OPENMP
+#pragma omp task firstprivate(c)
+#endif
+            downward(sys, c);
+        } else {
+            downward(sys, c);
+        }
+    }
+#ifdef _OPENMP
+    if (spawn) {
+#pragma omp taskwait
+    }
+#endif
+}
@@ -2,7 +2,6 @@ import struct
 import random
 import sys
 import math
-import numpy as np
 
 def _sample_truncated_exponential_radius(r_min, r_max, r_scale):
     """
@@ -0,0 +1,323 @@
+#include "integrator.h"
+#include "particles.h"
+#include "time_utils.h"
+#include <math.h>
+#include <stdio.h>
+#include <string.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+/* Block timesteps: a particle's step is the longest dt / 2^r not above
+ * TIMESTEP_ETA * sqrt(TIMESTEP_SOFTENING / |a|). The softening is the
+ * EPSILON of the force kernels. */
+static const double TIMESTEP_ETA       = 0.01;
+static const double TIMESTEP_SOFTENING = 1e-3;
+
+/* Triple-jump weights 1 / (2 - 2^(1/3)) and -2^(1/3) / (2 - 2^(1/3)) */
+#define TRIPLE_W1  1.3512071919596578
+#define TRIPLE_W0 -1.7024143839193155
+
+/* Omelyan, Mryglod & Folk (2002), position-extended Forest-Ruth */
+#define PEFRL_XI      0.1786178958448091
+#define PEFRL_LAMBDA -0.2123418310626054
+#define PEFRL_CHI    -0.06626458266981849
+
+const Integrator INTEGRATORS[] = {
+    /* INTEGRATOR_VERLET: kick-drift-kick; the closing kick shares the
+     * next step's forces */
+    { "verlet", 2,
+      { 0.0, 1.0, 0.0 },
+      { 0.5, 0.5 } },
+    /* Yoshida (1990): three Verlet steps of TRIPLE_W1, TRIPLE_W0,
+     * TRIPLE_W1 dt with the inner half kicks merged */
+    { "yoshida4", 4,
+      { 0.0, TRIPLE_W1, TRIPLE_W0, TRIPLE_W1, 0.0 },
+      { 0.5 * TRIPLE_W1, 0.5 * (TRIPLE_W1 + TRIPLE_W0),
+        0.5 * (TRIPLE_W0 + TRIPLE_W1), 0.5 * TRIPLE_W1 } },
+    /* Forest & Ruth (1990), drift-first form of the same triple jump */
+    { "forest-ruth", 3,
+      { 0.5 * TRIPLE_W1, 0.5 * (1.0 - TRIPLE_W1), 0.5 * (1.0 - TRIPLE_W1),
+        0.5 * TRIPLE_W1 },
+      { TRIPLE_W1, 1.0 - 2.0 * TRIPLE_W1, TRIPLE_W1 } },
+    /* Four forces per step, error constant about 100x below Forest-Ruth */
+    { "pefrl", 4,
+      { PEFRL_XI, PEFRL_CHI, 1.0 - 2.0 * (PEFRL_CHI + PEFRL_XI), PEFRL_CHI,
+        PEFRL_XI },
+      { 0.5 * (1.0 - 2.0 * PEFRL_LAMBDA), PEFRL_LAMBDA, PEFRL_LAMBDA,
+        0.5 * (1.0 - 2.0 * PEFRL_LAMBDA) } },
+};
+const int N_INTEGRATORS = (int)(sizeof(INTEGRATORS) / sizeof(INTEGRATORS[0]));
+
+int integrator_find(const char* name) {
+    for (int i = 0; i < N_INTEGRATORS; i++) {
+        if (strcmp(INTEGRATORS[i].name, name) == 0) return i;
+    }
+    return -1;
+}
+
+/** Kick velocities by h_kick with the current forces, then drift
+ * positions by h_drift, in one OpenMP-parallel, vectorised pass. The
+ * pass is memory bound, so the one division per particle costs less
+ * than streaming a cached inverse mass would; stored accelerations
+ * (FORCE_STORE_ACCEL) need neither. Forces are scaled as h f (1 / m),
+ * in the order of the original integration loop.
+ * ----------------------------------------------------------------- */
+static void kick_drift(ParticleSystem* sys, double h_kick, double h_drift,
+                       int force_store, int n_threads) {
+    const int N = sys->N;
+    const double* restrict m  = sys->mass;
+    const double* restrict fx = sys->fx;
+    const double* restrict fy = sys->fy;
+    double* restrict vx = sys->vx;
+    double* restrict vy = sys->vy;
+    double* restrict x  = sys->pos_x;
+    double* restrict y  = sys->pos_y;
+    if (force_store == FORCE_STORE_ACCEL) {
+#ifdef _OPENMP
+#pragma omp parallel for simd schedule(static) num_threads(n_threads)
+#endif
+        for (int i = 0; i < N; i++) {
+            vx[i] += h_kick * fx[i];
+            vy[i] += h_kick * fy[i];
+            x[i]  += h_drift * vx[i];
+            y[i]  += h_drift * vy[i];
+        }
+        return;
+    }
+#ifdef _OPENMP
+#pragma omp parallel for simd schedule(static) num_threads(n_threads)
+#else
+    (void)n_threads;
+#endif
+    for (int i = 0; i < N; i++) {
+        double m_inv = 1.0 / m[i];
+        vx[i] += h_kick * fx[i] * m_inv;
+        vy[i] += h_kick * fy[i] * m_inv;
+        x[i]  += h_drift * vx[i];
+        y[i]  += h_drift * vy[i];
+    }
+}
+
+/** Kick velocities by h with the current forces or accelerations.
+ * ----------------------------------------------------------------- */
+static void kick(ParticleSystem* sys, double h, int force_store,
+                 int n_threads) {
+    const int N = sys->N;
+    const double* restrict m  = sys->mass;
+    const double* restrict fx = sys->fx;
+    const double* restrict fy = sys->fy;
+    double* restrict vx = sys->vx;
+    double* restrict vy = sys->vy;
+    if (force_store == FORCE_STORE_ACCEL) {
+#ifdef _OPENMP
+#pragma omp parallel for simd schedule(static) num_threads(n_threads)
+#endif
+        for (int i = 0; i < N; i++) {
+            vx[i] += h * fx[i];
+            vy[i] += h * fy[i];
+        }
+        return;
+    }
+#ifdef _OPENMP
+#pragma omp parallel for simd schedule(static) num_threads(n_threads)
+#else
+    (void)n_threads;
+#endif
+    for (int i = 0; i < N; i++) {
+        double m_inv = 1.0 / m[i];
+        vx[i] += h * fx[i] * m_inv;
+        vy[i] += h * fy[i] * m_inv;
+    }
+}
+
+/** Drift positions by h.
+ * ----------------------------------------------------------------- */
+static void drift(ParticleSystem* sys, double h, int n_threads) {
+    const int N = sys->N;
+    const double* restrict vx = sys->vx;
+    const double* restrict vy = sys->vy;
+    double* restrict x = sys->pos_x;
+    double* restrict y = sys->pos_y;
+#ifdef _OPENMP
+#pragma omp parallel for simd schedule(static) num_threads(n_threads)
+#else
+    (void)n_threads;
+#endif
+    for (int i = 0; i < N; i++) {
+        x[i] += h * vx[i];
+        y[i] += h * vy[i];
+    }
+}
+
+/** Run the splitting scheme integ lazily. Kicks are held back until
+ * the next nonzero drift and then applied with it in one fused
+ * kick_drift pass; forces are recomputed only after positions change.
+ * Consecutive kicks that share forces, such as the closing and opening
+ * half kicks of two Verlet steps, are summed into one pass under
+ * KICK_MERGED. Under KICK_SEPARATE each is its own pass, which rounds
+ * exactly like the original half kick, drift, force, half kick loop.
+ * ----------------------------------------------------------------- */
+long long integrate_split(ParticleSystem* sys, KernelConfig* config,
+                          ForceEngine compute, const Integrator* integ,
+                          int nsteps, double dt, int verbose) {
+    int    force_store = config->force_store;
+    int    n_threads   = config->n_threads;
+    int    merge       = config->kick_merge == KICK_MERGED;
+    double h_kick  = 0.0;  /* pending kick, applied before h_drift */
+    double h_drift = 0.0;  /* pending drift */
+    long long n_forces = 0;
+
+    for (int step = 0; step < nsteps; step++) {
+        double c = 0.0;  /* drift coefficients so far in this step */
+        for (int k = 0; k < integ->n_kicks; k++) {
+            h_drift += integ->drift[k] * dt;
+            c += integ->drift[k];
+            if (h_drift != 0.0) {
+                double t_int = sim_time_now();
+                kick_drift(sys, h_kick, h_drift, force_store, n_threads);
+                config->stats.integrate_time += sim_time_now() - t_int;
+                h_kick = h_drift = 0.0;
+
+                config->current_time = (step + c) * dt;
+                compute(sys, config);
+                n_forces++;
+            } else if (h_kick != 0.0 && !merge) {
+                double t_int = sim_time_now();
+                kick(sys, h_kick, force_store, n_threads);
+                config->stats.integrate_time += sim_time_now() - t_int;
+                h_kick = 0.0;
+            }
+            h_kick += integ->kick[k] * dt;
+        }
+        h_drift += integ->drift[integ->n_kicks] * dt;
+
+        if (verbose) {
+            if (step % 50 == 0)
+                printf("Step %d/%d\r", step, nsteps);
+            fflush(stdout);
+        }
+    }
+
+    /* Close the last step; a trailing drift leaves stale forces, so
+     * recompute them for the caller */
+    double t_int = sim_time_now();
+    if (h_drift != 0.0)
+        kick_drift(sys, h_kick, h_drift, force_store, n_threads);
+    else
+        kick(sys, h_kick, force_store, n_threads);
+    config->stats.integrate_time += sim_time_now() - t_int;
+    config->current_time = nsteps * dt;
+    if (h_drift != 0.0) {
+        compute(sys, config);
+        n_forces++;
+    }
+    return n_forces;
+}
+
+/** Longest block step dt / 2^r, min_rung <= r <= config->max_rung,
+ * that keeps particle i within the acceleration criterion; the shortest
+ * if none does.
+ * ----------------------------------------------------------------- */
+static double block_step(const ParticleSystem* sys,
+                         const KernelConfig* config, int i, double dt,
+                         int min_rung) {
+    double a = sqrt(sys->fx[i] * sys->fx[i] + sys->fy[i] * sys->fy[i]) /
+               sink_mass(sys, config->force_store, i);
+    double h = ldexp(dt, -min_rung);
+    if (a <= 0.0) return h;
+    double h_max = TIMESTEP_ETA * sqrt(TIMESTEP_SOFTENING / a);
+    for (int r = min_rung; r < config->max_rung && h > h_max; r++)
+        h *= 0.5;
+    return h;
+}
+
+/** Kick-drift-kick with individual power-of-two timesteps.
+ * Each of the nsteps blocks of length dt is cut into 2^max_rung
+ * substeps. At the end of a substep only the particles whose own step
+ * ends there are active: the engine computes their forces
+ * (config->active_step), and they close that step with a half kick,
+ * pick their next step and open it with a second half kick, merged into
+ * one. A step may only lengthen to one whose boundary falls at the
+ * current time, so all particles are synchronised at the end of each
+ * block. Everything drifts straight to the next substep where some
+ * particle is active, skipping those of empty rungs. Returns the number
+ * of force evaluations after the initial one.
+ * ----------------------------------------------------------------- */
+long long integrate_block(ParticleSystem* sys, KernelConfig* config,
+                          ForceEngine compute, int nsteps, double dt,
+                          int verbose) {
+    int N = sys->N;
+    int max_rung = config->max_rung;
+    int n_sub = 1 << max_rung;
+    double h_min = ldexp(dt, -max_rung);
+    double h_low = dt;  /* shortest step in use */
+    long long n_forces = 0;
+
+    double t_int = sim_time_now();
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) reduction(min:h_low) num_threads(config->n_threads)
+#endif
+    for (int i = 0; i < N; i++) {
+        double h = block_step(sys, config, i, dt, 0);
+        double k = 0.5 * h / sink_mass(sys, config->force_store, i);
+        sys->step[i] = h;
+        sys->vx[i] += k * sys->fx[i];
+        sys->vy[i] += k * sys->fy[i];
+        if (h < h_low) h_low = h;
+    }
+    config->stats.integrate_time += sim_time_now() - t_int;
+
+    for (int step = 0; step < nsteps; step++) {
+        int s = 0;
+        while (s < n_sub) {
+            int stride = (int)(h_low / h_min);
+            int next   = (s / stride + 1) * stride;
+            t_int = sim_time_now();
+            drift(sys, (next - s) * h_min, config->n_threads);
+            config->stats.integrate_time += sim_time_now() - t_int;
+            s = next;
+            config->current_time = step * dt + s * h_min;
+
+            /* Steps dt / 2^r end here for r >= rung */
+            int rung = max_rung;
+            for (int k = s; (k & 1) == 0 && rung > 0; k >>= 1)
+                rung--;
+            config->active_step = ldexp(dt, -rung);
+            compute(sys, config);
+
+            /* The engine may have reordered the particles */
+            int last = (step == nsteps - 1 && s == n_sub);
+            double h_active = config->active_step;
+            h_low = dt;
+            t_int = sim_time_now();
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) reduction(min:h_low) reduction(+:n_forces) \
+    num_threads(config->n_threads)
+#endif
+            for (int i = 0; i < N; i++) {
+                double h = sys->step[i];
+                if (h <= h_active) {
+                    double h_next = last ? 0.0 :
+                                    block_step(sys, config, i, dt, rung);
+                    double k = 0.5 * (h + h_next) /
+                               sink_mass(sys, config->force_store, i);
+                    sys->vx[i] += k * sys->fx[i];
+                    sys->vy[i] += k * sys->fy[i];
+                    if (!last) sys->step[i] = h = h_next;
+                    n_forces++;
+                }
+                if (h < h_low) h_low = h;
+            }
+            config->stats.integrate_time += sim_time_now() - t_int;
+        }
+
+        if (verbose) {
+            if (step % 50 == 0)
+                printf("Step %d/%d\r", step, nsteps);
+            fflush(stdout);
+        }
+    }
+    return n_forces;
+}
+
@@ -0,0 +1,48 @@
+#ifndef INTEGRATOR_H
+#define INTEGRATOR_H
+
+#include "types.h"
+
+#define INTEGRATOR_MAX_KICKS 4
+
+// Index of Velocity Verlet in INTEGRATORS, the default scheme and the
+// only one block timesteps support
+enum { INTEGRATOR_VERLET = 0 };
+
+// Writes the forces (or accelerations) of sys into sys->fx/fy
+typedef void (*ForceEngine)(ParticleSystem* sys, KernelConfig* config);
+
+// Symplectic splitting scheme for one step of length dt: drift by
+// drift[0] dt, kick by kick[0] dt, drift by drift[1] dt, ..., kick by
+// kick[n_kicks - 1] dt, drift by drift[n_kicks] dt. A kick that follows
+// a zero drift reuses the forces of the previous one.
+typedef struct {
+    const char* name;
+    int    n_kicks;
+    double drift[INTEGRATOR_MAX_KICKS + 1];
+    double kick[INTEGRATOR_MAX_KICKS];
+} Integrator;
+
+// Registered schemes, selected by KernelConfig.integrator.
+extern const Integrator INTEGRATORS[];
+extern const int        N_INTEGRATORS;
+
+// Index of the scheme called name in INTEGRATORS, or -1.
+int integrator_find(const char* name);
+
+// Advance sys by nsteps steps of dt with integ. sys->fx/fy must hold
+// the forces of the current positions, and hold those of the final
+// positions on return. Returns the number of compute() calls. With
+// verbose, prints progress every 50 steps.
+long long integrate_split(ParticleSystem* sys, KernelConfig* config,
+                          ForceEngine compute, const Integrator* integ,
+                          int nsteps, double dt, int verbose);
+
+// Same for Velocity Verlet with per-particle block timesteps of up to
+// config->max_rung halvings of dt; sys->step must be allocated. Returns
+// the number of particle force evaluations.
+long long integrate_block(ParticleSystem* sys, KernelConfig* config,
+                          ForceEngine compute, int nsteps, double dt,
+                          int verbose);
+
+#endif
@@ -12,6 +12,9 @@ ParticleSystem io_read_particles(const char* filename, int N) {
     sys.vy = malloc(N * sizeof(double));
     sys.fx = malloc(N * sizeof(double));
     sys.fy = malloc(N * sizeof(double));
+    sys.step = NULL;
+    for (int k = 0; k < N_BACK_ARRAYS; k++)
+        sys.back[k] = NULL;
 
     if (!sys.pos_x || !sys.pos_y || !sys.mass || !sys.vx || !sys.vy ||
         !sys.fx || !sys.fy) {
@@ -73,4 +76,9 @@ void io_free_particles(ParticleSystem* sys) {
     free(sys->vy);
     free(sys->fx);
     free(sys->fy);
+    free(sys->step);
+    for (int k = 0; k < N_BACK_ARRAYS; k++) {
+        free(sys->back[k]);
+        sys->back[k] = NULL;
+    }
 }
@@ -0,0 +1,160 @@
+#include "kernels.h"
+#include "types.h"
+#include <math.h>
+
+#define EPSILON 1e-3
+
+#if defined(__x86_64__) && (defined(__GNUC__) || defined(__clang__))
+#include <immintrin.h>
+#define KERNELS_HAVE_X86 1
+#endif
+
+/** Reference loop. Evaluates f = gm * m / (r + eps)^3 in the same order
+ * as the original per-interaction code, so results are bit-identical.
+ * ----------------------------------------------------------------- */
+static void sum_scalar(double px, double py, double gm, const double* bx,
+                       const double* by, const double* bm, int count,
+                       double* fx, double* fy) {
+    double ax = *fx, ay = *fy;
+    for (int k = 0; k < count; k++) {
+        double dx = bx[k] - px;
+        double dy = by[k] - py;
+        double denom = sqrt(dx * dx + dy * dy) + EPSILON;
+        double f = gm * bm[k] / (denom * denom * denom);
+        ax += f * dx;
+        ay += f * dy;
+    }
+    *fx = ax;
+    *fy = ay;
+}
+
+/** Portable vector loop; the compiler picks the width. Without OpenMP
+ * this is the scalar loop with a reassociated reduction.
+ * ----------------------------------------------------------------- */
+static void sum_simd(double px, double py, double gm, const double* bx,
+                     const double* by, const double* bm, int count,
+                     double* fx, double* fy) {
+    double ax = 0.0, ay = 0.0;
+#ifdef _OPENMP
+#pragma omp simd reduction(+:ax, ay)
+#endif
+    for (int k = 0; k < count; k++) {
+        double dx = bx[k] - px;
+        double dy = by[k] - py;
+        double denom = sqrt(dx * dx + dy * dy) + EPSILON;
+        double f = gm * bm[k] / (denom * denom * denom);
+        ax += f * dx;
+        ay += f * dy;
+    }
+    *fx += ax;
+    *fy += ay;
+}
+
+#ifdef KERNELS_HAVE_X86
+/** Four interactions per iteration with AVX2 and FMA.
+ * ----------------------------------------------------------------- */
+__attribute__((target("avx2,fma")))
+static void sum_avx2(double px, double py, double gm, const double* bx,
+                     const double* by, const double* bm, int count,
+                     double* fx, double* fy) {
+    __m256d vpx  = _mm256_set1_pd(px);
+    __m256d vpy  = _mm256_set1_pd(py);
+    __m256d vgm  = _mm256_set1_pd(gm);
+    __m256d veps = _mm256_set1_pd(EPSILON);
+    __m256d ax   = _mm256_setzero_pd();
+    __m256d ay   = _mm256_setzero_pd();
+
+    int k = 0;
+    for (; k + 4 <= count; k += 4) {
+        __m256d dx = _mm256_sub_pd(_mm256_loadu_pd(bx + k), vpx);
+        __m256d dy = _mm256_sub_pd(_mm256_loadu_pd(by + k), vpy);
+        __m256d r2 = _mm256_fmadd_pd(dx, dx, _mm256_mul_pd(dy, dy));
+        __m256d d  = _mm256_add_pd(_mm256_sqrt_pd(r2), veps);
+        __m256d d3 = _mm256_mul_pd(_mm256_mul_pd(d, d), d);
+        __m256d f  = _mm256_div_pd(_mm256_mul_pd(vgm, _mm256_loadu_pd(bm + k)), d3);
+        ax = _mm256_fmadd_pd(f, dx, ax);
+        ay = _mm256_fmadd_pd(f, dy, ay);
+    }
+
+    double lx[4], ly[4];
+    _mm256_storeu_pd(lx, ax);
+    _mm256_storeu_pd(ly, ay);
+    double sx = (lx[0] + lx[1]) + (lx[2] + lx[3]);
+    double sy = (ly[0] + ly[1]) + (ly[2] + ly[3]);
+    sum_scalar(px, py, gm, bx + k, by + k, bm + k, count - k, &sx, &sy);
+    *fx += sx;
+    *fy += sy;
+}
+
+/** Eight interactions per iteration with AVX-512; the tail is masked.
+ * sqrt and the division are replaced by the 14-bit rsqrt14/rcp14
+ * estimates refined with two Newton steps each (~1e-15 relative), which
+ * roughly doubles throughput over the exact instructions. A zero
+ * distance gets a zero estimate, so d = eps as in the other kernels.
+ * Masked-out lanes load zero mass and so add nothing.
+ * ----------------------------------------------------------------- */
+__attribute__((target("avx512f")))
+static void sum_avx512(double px, double py, double gm, const double* bx,
+                       const double* by, const double* bm, int count,
+                       double* fx, double* fy) {
+    __m512d vpx  = _mm512_set1_pd(px);
+    __m512d vpy  = _mm512_set1_pd(py);
+    __m512d vgm  = _mm512_set1_pd(gm);
+    __m512d veps = _mm512_set1_pd(EPSILON);
+    __m512d vzero = _mm512_setzero_pd();
+    __m512d vhalf = _mm512_set1_pd(0.5);
+    __m512d v1p5  = _mm512_set1_pd(1.5);
+    __m512d vtwo  = _mm512_set1_pd(2.0);
+    __m512d ax   = _mm512_setzero_pd();
+    __m512d ay   = _mm512_setzero_pd();
+
+    for (int k = 0; k < count; k += 8) {
+        int left = count - k;
+        __mmask8 mask = left >= 8 ? (__mmask8)0xFF : (__mmask8)((1u << left) - 1);
+        __m512d dx = _mm512_sub_pd(_mm512_maskz_loadu_pd(mask, bx + k), vpx);
+        __m512d dy = _mm512_sub_pd(_mm512_maskz_loadu_pd(mask, by + k), vpy);
+        __m512d r2 = _mm512_fmadd_pd(dx, dx, _mm512_mul_pd(dy, dy));
+        __m512d y  = _mm512_maskz_rsqrt14_pd(
+            _mm512_cmp_pd_mask(r2, vzero, _CMP_GT_OQ), r2);
+        __m512d h  = _mm512_mul_pd(vhalf, r2);
+        y = _mm512_mul_pd(y, _mm512_fnmadd_pd(h, _mm512_mul_pd(y, y), v1p5));
+        y = _mm512_mul_pd(y, _mm512_fnmadd_pd(h, _mm512_mul_pd(y, y), v1p5));
+        __m512d d  = _mm512_fmadd_pd(r2, y, veps);
+        __m512d d3 = _mm512_mul_pd(_mm512_mul_pd(d, d), d);
+        __m512d q  = _mm512_rcp14_pd(d3);
+        q = _mm512_mul_pd(q, _mm512_fnmadd_pd(d3, q, vtwo));
+        q = _mm512_mul_pd(q, _mm512_fnmadd_pd(d3, q, vtwo));
+        __m512d m  = _mm512_maskz_loadu_pd(mask, bm + k);
+        __m512d f  = _mm512_mul_pd(_mm512_mul_pd(vgm, m), q);
+        ax = _mm512_fmadd_pd(f, dx, ax);
+        ay = _mm512_fmadd_pd(f, dy, ay);
+    }
+    *fx += _mm512_reduce_add_pd(ax);
+    *fy += _mm512_reduce_add_pd(ay);
+}
+#endif
+
+int force_kernel_resolve(int kind) {
+#ifdef KERNELS_HAVE_X86
+    if (kind == FORCE_KERNEL_AVX512 && !__builtin_cpu_supports("avx512f"))
+        kind = FORCE_KERNEL_AVX2;
+    if (kind == FORCE_KERNEL_AVX2 &&
+        !(__builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma")))
+        kind = FORCE_KERNEL_SIMD;
+#else
+    if (kind == FORCE_KERNEL_AVX512 || kind == FORCE_KERNEL_AVX2)
+        kind = FORCE_KERNEL_SIMD;
+#endif
+    return kind;
+}
+
+ForceKernel force_kernel_select(int kind) {
+    switch (force_kernel_resolve(kind)) {
+#ifdef KERNELS_HAVE_X86
+    case FORCE_KERNEL_AVX512: return sum_avx512;
+    case FORCE_KERNEL_AVX2:   return sum_avx2;
+#endif
+    case FORCE_KERNEL_SIMD:   return sum_simd;
+    default:                  return sum_scalar;
+    }
+}
@@ -0,0 +1,19 @@
+#ifndef KERNELS_H
+#define KERNELS_H
+
+// Accumulate into (*fx, *fy) the softened gravity of count bodies
+// (bx, by, bm) on a target at (px, py), with gm = G * target mass.
+// A body at the target's own position contributes exactly zero.
+typedef void (*ForceKernel)(double px, double py, double gm,
+                            const double* bx, const double* by,
+                            const double* bm, int count,
+                            double* fx, double* fy);
+
+// Kernel for a FORCE_KERNEL_* value. Instruction sets the CPU lacks fall
+// back to the next narrower kernel, ending at the scalar loop.
+ForceKernel force_kernel_select(int kind);
+
+// FORCE_KERNEL_* value actually used for kind on this CPU.
+int force_kernel_resolve(int kind);
+
+#endif
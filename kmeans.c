@@ -1,9 +1,9 @@
 #include "kmeans.h"
 #include "ds.h"
+#include "particles.h"
 #include <math.h>
 #include <stdio.h>
 #include <stdlib.h>
-#include <string.h>
 
 #define MAX_ITERATIONS 50
 
@@ -13,8 +13,6 @@ typedef struct {
     int count;
 } CNode;
 
-static bool reorder_array(double* arr, const int* order, int N);
-static bool reorder_by_clusters(ParticleSystem* sys, const int* clustersP);
 static bool converged(CNode* clusters, double* old_clusters_ctr_x,
                       double* old_clusters_ctr_y, int iterations, int k);
 static void get_centroids(ParticleSystem* sys, CNode* clusters, int* labels,
@@ -82,12 +80,7 @@ bool kmeans(ParticleSystem* sys, int* clustersP, int* clusters_size, int k,
         cnt[c]++;
     }
 
-    if (!reorder_by_clusters(sys, clustersP)) {
-        free(cnt);
-        free(offsets);
-        free(labels);
-        return false;
-    }
+    particles_permute(sys, clustersP, 0, N, n_threads);
 
     free(cnt);
     free(offsets);
@@ -95,17 +88,6 @@ bool kmeans(ParticleSystem* sys, int* clustersP, int* clusters_size, int k,
     return true;
 }
 
-static bool reorder_by_clusters(ParticleSystem* sys, const int* clustersP) {
-    int N = sys->N;
-    return reorder_array(sys->pos_x, clustersP, N) &&
-           reorder_array(sys->pos_y, clustersP, N) &&
-           reorder_array(sys->mass, clustersP, N) &&
-           reorder_array(sys->vx, clustersP, N) &&
-           reorder_array(sys->vy, clustersP, N) &&
-           reorder_array(sys->fx, clustersP, N) &&
-           reorder_array(sys->fy, clustersP, N);
-}
-
 static bool converged(CNode* clusters, double* old_clusters_ctr_x,
                       double* old_clusters_ctr_y, int iterations, int k) {
     if (iterations > MAX_ITERATIONS) {
@@ -170,18 +152,3 @@ static void assign_labels(ParticleSystem* sys, CNode* clusters, int* labels,
         labels[i] = label;
     }
 }
-
-static bool reorder_array(double* arr, const int* order, int N) {
-    double* tmp = (double*)malloc((size_t)N * sizeof(double));
-    if (!tmp) {
-        fprintf(stderr, "Memory allocation failed for kmeans reorder buffer.\n");
-        return false;
-    }
-
-    for (int i = 0; i < N; i++)
-        tmp[i] = arr[order[i]];
-
-    memcpy(arr, tmp, (size_t)N * sizeof(double));
-    free(tmp);
-    return true;
-}
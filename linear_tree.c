@@ -0,0 +1,119 @@
+#include "linear_tree.h"
+#include <stdio.h>
+#include <stdlib.h>
+
+/* Number of leading 2-bit digits shared by two Morton codes */
+static int common_levels(uint64_t a, uint64_t b) {
+    uint64_t diff = a ^ b;
+    if (diff == 0) return 32;
+    int lz = 0;
+    while (!(diff & (1ULL << 63))) {
+        diff <<= 1;
+        lz++;
+    }
+    return lz / 2;
+}
+
+/* First index in [lo, hi) whose digit at shift exceeds q */
+static int digit_upper_bound(const uint64_t* codes, int lo, int hi, int shift,
+                             uint64_t q) {
+    while (lo < hi) {
+        int mid = lo + (hi - lo) / 2;
+        if (((codes[mid] >> shift) & 3) <= q) lo = mid + 1;
+        else                                  hi = mid;
+    }
+    return lo;
+}
+
+/** Fill node n with the particles [lo, hi) and recurse into its children.
+ * The node sits at the deepest level whose cell still contains the whole
+ * range, so chains of single-child cells never materialise. Children of
+ * a node are allocated next to each other before descending.
+ * ----------------------------------------------------------------- */
+static void build_node(LinearTree* tree, int n, const ParticleSystem* sys,
+                       const uint64_t* codes, double domain_size,
+                       int leaf_size, int lo, int hi) {
+    LNode* node = &tree->nodes[n];
+    int level   = common_levels(codes[lo], codes[hi - 1]);
+    node->first = lo;
+    node->count = hi - lo;
+    node->size  = domain_size / (double)(1ULL << level);
+    for (int q = 0; q < 4; q++) node->child[q] = -1;
+
+    /* A small enough range, or particles sharing one code, form a leaf */
+    if (hi - lo <= leaf_size || level == 32) {
+        double m = 0.0, cx = 0.0, cy = 0.0, ux = 0.0, uy = 0.0;
+        for (int i = lo; i < hi; i++) {
+            m  += sys->mass[i];
+            cx += sys->pos_x[i] * sys->mass[i];
+            cy += sys->pos_y[i] * sys->mass[i];
+            ux += sys->pos_x[i];
+            uy += sys->pos_y[i];
+        }
+        /* A node of massless tracers only is centred on them */
+        node->mass  = m;
+        node->pos_x = m > 0.0 ? cx / m : ux / (hi - lo);
+        node->pos_y = m > 0.0 ? cy / m : uy / (hi - lo);
+        return;
+    }
+
+    int shift = 62 - 2 * level;
+    int bound[5];
+    bound[0] = lo;
+    for (int q = 0; q < 4; q++)
+        bound[q + 1] = digit_upper_bound(codes, bound[q], hi, shift, q);
+
+    for (int q = 0; q < 4; q++) {
+        if (bound[q + 1] > bound[q]) node->child[q] = tree->size++;
+    }
+    double m = 0.0, cx = 0.0, cy = 0.0, ux = 0.0, uy = 0.0;
+    int n_children = 0;
+    for (int q = 0; q < 4; q++) {
+        int c = node->child[q];
+        if (c < 0) continue;
+        build_node(tree, c, sys, codes, domain_size, leaf_size, bound[q],
+                   bound[q + 1]);
+        /* tree->nodes is never reallocated during a build */
+        LNode* child = &tree->nodes[c];
+        m  += child->mass;
+        cx += child->pos_x * child->mass;
+        cy += child->pos_y * child->mass;
+        ux += child->pos_x;
+        uy += child->pos_y;
+        n_children++;
+    }
+    node->mass  = m;
+    node->pos_x = m > 0.0 ? cx / m : ux / n_children;
+    node->pos_y = m > 0.0 ? cy / m : uy / n_children;
+}
+
+/** Build the linear quadtree for particles sorted by their Morton codes.
+ * Node 0 is the root; a compressed quadtree has at most 2N - 1 nodes.
+ * ----------------------------------------------------------------- */
+void linear_tree_build(LinearTree* tree, const ParticleSystem* sys,
+                       const uint64_t* codes, double domain_size,
+                       int leaf_size) {
+    int N = sys->N;
+    if (tree->nodes == NULL || tree->capacity < 2 * N) {
+        free(tree->nodes);
+        tree->nodes    = (LNode*)malloc((size_t)2 * N * sizeof(LNode));
+        tree->capacity = 2 * N;
+        if (!tree->nodes) {
+            fprintf(stderr, "Error: linear tree allocation failed!\n");
+            exit(1);
+        }
+    }
+    tree->size = 0;
+    if (N == 0) return;
+
+    tree->size = 1;
+    build_node(tree, 0, sys, codes, domain_size, leaf_size < 1 ? 1 : leaf_size,
+               0, N);
+}
+
+void linear_tree_free(LinearTree* tree) {
+    free(tree->nodes);
+    tree->nodes    = NULL;
+    tree->capacity = 0;
+    tree->size     = 0;
+}
@@ -0,0 +1,15 @@
+#ifndef LINEAR_TREE_H
+#define LINEAR_TREE_H
+
+#include "ds.h"
+#include "types.h"
+#include <stdint.h>
+
+// Build a compressed quadtree from particles already sorted by Morton code.
+// Ranges of at most leaf_size particles become one leaf bucket.
+void linear_tree_build(LinearTree* tree, const ParticleSystem* sys,
+                       const uint64_t* codes, double domain_size,
+                       int leaf_size);
+void linear_tree_free(LinearTree* tree);
+
+#endif
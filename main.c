@@ -1,37 +1,98 @@
+#include "integrator.h"
 #include "io.h"
+#include "kernels.h"
 #include "time_utils.h"
 #include "types.h"
 #include <stdio.h>
 #include <stdlib.h>
+#include <string.h>
 #ifdef _OPENMP
 #include <omp.h>
 #endif
 
 void compute_force_naive(ParticleSystem* sys, KernelConfig* config);
 void compute_force_barnes_hut(ParticleSystem* sys, KernelConfig* config);
+void compute_force_fmm(ParticleSystem* sys, KernelConfig* config);
+void compute_force_pm(ParticleSystem* sys, KernelConfig* config);
 
-static void integrate_positions(ParticleSystem* sys, double dt);
-static void integrate_velocities(ParticleSystem* sys, double dt);
+/* Force engines by version number, starting at 1 */
+static const struct {
+    const char* label;  /* output file suffix */
+    ForceEngine compute;
+} ENGINES[] = {
+    { "naive",      compute_force_naive },
+    { "barnes_hut", compute_force_barnes_hut },
+    { "fmm",        compute_force_fmm },
+    { "pm",         compute_force_pm },
+};
+#define N_ENGINES ((int)(sizeof(ENGINES) / sizeof(ENGINES[0])))
+
+static int  parse_option(const char* arg, KernelConfig* config);
 
 static const int    DEFAULT_STEPS   = 200;
 static const double DEFAULT_DT      = 1e-5;
 static const int    DEFAULT_THREADS = 8;
 static const double DEFAULT_THETA   = 0.5;
 static const int    DEFAULT_K       = 0;
+static const int    DEFAULT_LEAF    = 1;
+static const int    DEFAULT_ORDER   = 4;
+static const int    DEFAULT_GRID    = 256;
+static const double DEFAULT_SPLIT   = 0.0;
+static const int    DEFAULT_RUNGS   = 0;
+static const int    MAX_RUNGS       = 16;
 
 int main(int argc, char* argv[]) {
-    if (argc != 4 && argc != 5 && argc != 6 && argc != 9) {
-        fprintf(stderr, "Usage: %s <version> N <input.gal> [nsteps] [n_threads]\n", argv[0]);
-        fprintf(stderr, "   or: %s <version> N <input.gal> nsteps dt n_threads theta k\n", argv[0]);
-        fprintf(stderr, "Versions: 1=Naive  2=Barnes-Hut\n");
+    KernelConfig config = { DEFAULT_THETA, DEFAULT_THREADS, DEFAULT_K, 0.0,
+                            TREE_BUILD_SERIAL, MORTON_SORT_QSORT,
+                            TREE_WALK_POINTER, TREE_COM_INSERT,
+                            TREE_REUSE_REBUILD, DEFAULT_LEAF,
+                            FORCE_KERNEL_SCALAR, NAIVE_PAIRS_FULL,
+                            MULTIPOLE_MONOPOLE, DEFAULT_ORDER, DEFAULT_GRID,
+                            DEFAULT_SPLIT, DEFAULT_RUNGS, 0.0,
+                            FORCE_STORE_FORCE, INTEGRATOR_VERLET,
+                            KICK_SEPARATE, { 0 } };
+
+    /* Consume --name=value options, leaving the positional arguments */
+    int n_pos = 1;
+    for (int a = 1; a < argc; a++) {
+        if (strncmp(argv[a], "--", 2) != 0) {
+            argv[n_pos++] = argv[a];
+        } else if (!parse_option(argv[a], &config)) {
+            fprintf(stderr, "Unknown option: %s\n", argv[a]);
+            return 1;
+        }
+    }
+    argc = n_pos;
+
+    if (argc != 4 && argc != 5 && argc != 6 && argc != 8 && argc != 9) {
+        fprintf(stderr, "Usage: %s <version> N <input.gal> [nsteps] [n_threads] [options]\n", argv[0]);
+        fprintf(stderr, "   or: %s <version> N <input.gal> nsteps dt n_threads theta [k] [options]\n", argv[0]);
+        fprintf(stderr, "Versions: 1=Naive  2=Barnes-Hut  3=FMM  4=PM\n");
         fprintf(stderr, "k: locality strategy for version 2 (0=Morton, >0=k-means with k clusters)\n");
+        fprintf(stderr, "Options: --build=serial|parallel|linear  quadtree construction for version 2\n");
+        fprintf(stderr, "         --sort=qsort|radix|incremental  Morton ordering sort for version 2\n");
+        fprintf(stderr, "         --walk=pointer|packed|soa|group|dual  force traversal of the pointer tree\n");
+        fprintf(stderr, "         --com=insert|bottomup  when tree node mass/COM is computed\n");
+        fprintf(stderr, "         --tree=rebuild|refit  rebuild the pointer tree every step or refit it\n");
+        fprintf(stderr, "         --leaf=<n>  max particles per leaf of the linear tree or FMM tree\n");
+        fprintf(stderr, "         --order=<p>  expansion order of version 3 (1-10)\n");
+        fprintf(stderr, "         --grid=<n>  mesh cells per side of version 4 and TreePM (power of two, 16-4096)\n");
+        fprintf(stderr, "         --split=<s>  TreePM for version 2: Gaussian split scale in mesh cells (0=off)\n");
+        fprintf(stderr, "         --kernel=scalar|simd|avx2|avx512  batched interaction kernel\n");
+        fprintf(stderr, "         --pairs=full|symmetric  pairs evaluated by version 1\n");
+        fprintf(stderr, "         --multipole=monopole|quadrupole  expansion of accepted cells\n");
+        fprintf(stderr, "         --store=force|accel  engines output forces or accelerations (massless tracers)\n");
+        fprintf(stderr, "         --integrator=verlet|yoshida4|forest-ruth|pefrl  symplectic scheme for each dt\n");
+        fprintf(stderr, "         --kicks=separate|merged  apply kicks that share forces one by one or in one pass\n");
+        fprintf(stderr, "         --rungs=<n>  block timesteps down to dt / 2^n per particle (0-%d, 0=off)\n", MAX_RUNGS);
         return 1;
     }
 
     char* end = NULL;
     int version_id = (int)strtol(argv[1], &end, 10);
-    if (end == argv[1] || *end != '\0' || version_id < 1 || version_id > 2) {
-        fprintf(stderr, "Version must be 1 or 2.\n");
+    if (end == argv[1] || *end != '\0' || version_id < 1 ||
+        version_id > N_ENGINES) {
+        fprintf(stderr, "Version must be between 1 and %d.\n", N_ENGINES);
         return 1;
     }
 
@@ -49,91 +110,345 @@ int main(int argc, char* argv[]) {
         nsteps = (int)strtol(argv[4], &end, 10);
         if (end == argv[4] || *end != '\0' || nsteps <= 0) return 1;
     }
-    if (argc >= 6) {
+    if (argc == 6) {
         n_threads = (int)strtol(argv[5], &end, 10);
         if (end == argv[5] || *end != '\0' || n_threads <= 0) return 1;
     }
-    if (argc == 9) {
+    if (argc >= 8) {
         dt = strtod(argv[5], &end);
         if (end == argv[5] || *end != '\0' || dt <= 0.0) return 1;
         n_threads = (int)strtol(argv[6], &end, 10);
         if (end == argv[6] || *end != '\0' || n_threads <= 0) return 1;
         theta = strtod(argv[7], &end);
         if (end == argv[7] || *end != '\0' || theta < 0.0) return 1;
+    }
+    if (argc == 9) {
         k_clusters = (int)strtol(argv[8], &end, 10);
         if (end == argv[8] || *end != '\0' || k_clusters < 0) return 1;
     }
 
-    if (version_id == 1 && k_clusters != 0) {
+    if (version_id != 2 && k_clusters != 0) {
         fprintf(stderr, "k-means is only supported for version 2.\n");
         return 1;
     }
+    if (version_id != 2 &&
+        (config.tree_build != TREE_BUILD_SERIAL ||
+         config.tree_walk != TREE_WALK_POINTER ||
+         config.tree_com != TREE_COM_INSERT ||
+         config.tree_reuse != TREE_REUSE_REBUILD ||
+         config.multipole != MULTIPOLE_MONOPOLE)) {
+        fprintf(stderr, "--build, --walk, --com, --tree and --multipole are only supported for version 2.\n");
+        return 1;
+    }
+    if (version_id != 2 && version_id != 3 && config.leaf_size != DEFAULT_LEAF) {
+        fprintf(stderr, "--leaf is only supported for versions 2 and 3.\n");
+        return 1;
+    }
+    if (config.tree_build == TREE_BUILD_LINEAR && k_clusters != 0) {
+        fprintf(stderr, "The linear tree requires Morton ordering (k=0).\n");
+        return 1;
+    }
+    if (config.multipole == MULTIPOLE_QUADRUPOLE &&
+        (config.tree_build == TREE_BUILD_LINEAR ||
+         config.tree_walk != TREE_WALK_POINTER)) {
+        fprintf(stderr, "Quadrupoles require a pointer-tree build walked with --walk=pointer.\n");
+        return 1;
+    }
+    if (config.force_store == FORCE_STORE_ACCEL &&
+        version_id == 1 && config.naive_pairs == NAIVE_PAIRS_SYMMETRIC) {
+        fprintf(stderr, "Acceleration output requires --pairs=full.\n");
+        return 1;
+    }
+    if (config.max_rung > 0 && config.integrator != INTEGRATOR_VERLET) {
+        fprintf(stderr, "Block timesteps require --integrator=verlet.\n");
+        return 1;
+    }
+    if (config.max_rung > 0 &&
+        (version_id > 2 ||
+         (version_id == 1 && config.naive_pairs == NAIVE_PAIRS_SYMMETRIC) ||
+         (version_id == 2 && (config.tree_walk == TREE_WALK_GROUP ||
+                              config.tree_walk == TREE_WALK_DUAL)))) {
+        fprintf(stderr, "Block timesteps require version 1 with --pairs=full or version 2 without --walk=group|dual.\n");
+        return 1;
+    }
+    if (config.tree_reuse == TREE_REUSE_REFIT &&
+        (config.tree_build == TREE_BUILD_LINEAR || config.pm_split > 0.0 ||
+         config.tree_walk == TREE_WALK_DUAL)) {
+        fprintf(stderr, "Refitting requires a pointer-tree build without TreePM or --walk=dual.\n");
+        return 1;
+    }
+    if (config.pm_split > 0.0 &&
+        (version_id != 2 || k_clusters != 0 ||
+         config.tree_build == TREE_BUILD_LINEAR ||
+         config.tree_walk != TREE_WALK_POINTER ||
+         config.multipole != MULTIPOLE_MONOPOLE)) {
+        fprintf(stderr, "TreePM requires version 2 with k=0, a pointer-tree build, --walk=pointer and monopoles.\n");
+        return 1;
+    }
+    if (version_id == 2 && config.tree_build != TREE_BUILD_LINEAR &&
+        config.leaf_size > 1) {
+        fprintf(stderr, "Leaf buckets require the linear tree (--build=linear).\n");
+        return 1;
+    }
 
 #ifdef _OPENMP
     omp_set_num_threads(n_threads);
 #endif
 
-    KernelConfig config = { theta, n_threads, k_clusters, 0.0 };
+    config.theta_max  = theta;
+    config.n_threads  = n_threads;
+    config.k_clusters = k_clusters;
     ParticleSystem sys = io_read_particles(filename, N);
+    for (int i = 0; i < sys.N; i++) {
+        if (sys.mass[i] < 0.0 ||
+            (sys.mass[i] == 0.0 && config.force_store != FORCE_STORE_ACCEL)) {
+            fprintf(stderr, "Particle %d has mass %g; massless tracers require --store=accel.\n",
+                    i, sys.mass[i]);
+            return 1;
+        }
+    }
 
     printf("Running v%d | N=%d | Steps=%d | Threads=%d\n",
            version_id, sys.N, nsteps, n_threads);
-    printf("dt=%.1e | theta=%.2f | k=%d\n", dt, theta, k_clusters);
-
-    /* Initial force computation */
-    if (version_id == 1) compute_force_naive(&sys, &config);
-    else                 compute_force_barnes_hut(&sys, &config);
+    static const char* build_names[] = { "serial", "parallel", "linear" };
+    static const char* sort_names[]  = { "qsort", "radix", "incremental" };
+    static const char* walk_names[]  = { "pointer", "packed", "soa", "group", "dual" };
+    static const char* com_names[]   = { "insert", "bottomup" };
+    static const char* kernel_names[] = { "scalar", "simd", "avx2", "avx512" };
+    printf("dt=%.1e | theta=%.2f | k=%d | build=%s | sort=%s | walk=%s | com=%s | leaf=%d\n",
+           dt, theta, k_clusters, build_names[config.tree_build],
+           sort_names[config.morton_sort], walk_names[config.tree_walk],
+           com_names[config.tree_com], config.leaf_size);
+    printf("kernel=%s | pairs=%s | multipole=%s | order=%d | grid=%d | split=%.2f | rungs=%d | store=%s\n",
+           kernel_names[force_kernel_resolve(config.force_kernel)],
+           config.naive_pairs == NAIVE_PAIRS_SYMMETRIC ? "symmetric" : "full",
+           config.multipole == MULTIPOLE_QUADRUPOLE ? "quadrupole" : "monopole",
+           config.fmm_order, config.pm_grid, config.pm_split, config.max_rung,
+           config.force_store == FORCE_STORE_ACCEL ? "accel" : "force");
+    printf("integrator=%s | kicks=%s\n", INTEGRATORS[config.integrator].name,
+           config.kick_merge == KICK_MERGED ? "merged" : "separate");
 
-    double t_start = sim_time_now();
-
-    for (int step = 0; step < nsteps; step++) {
-        /* Velocity Verlet: half kick, full drift, recompute forces, half kick */
-        integrate_positions(&sys, dt);
+    if (config.max_rung > 0) {
+        sys.step = (double*)malloc(sys.N * sizeof(double));
+        if (!sys.step) {
+            fprintf(stderr, "Error: Memory allocation failed for timesteps.\n");
+            return 1;
+        }
+        for (int i = 0; i < sys.N; i++)
+            sys.step[i] = dt;
+        config.active_step = dt;
+    }
 
-        config.current_time = (step + 1) * dt;
+    /* Initial force computation */
+    ENGINES[version_id - 1].compute(&sys, &config);
 
-        if (version_id == 1) compute_force_naive(&sys, &config);
-        else                 compute_force_barnes_hut(&sys, &config);
+    /* Phase times cover the timed steps only, like the total */
+    config.stats.order_time = config.stats.tree_time = 0.0;
+    config.stats.force_time = config.stats.integrate_time = 0.0;
 
-        integrate_velocities(&sys, dt);
+    double t_start = sim_time_now();
+    long long n_forces;
 
-        if (step % 50 == 0)
-            printf("Step %d/%d\r", step, nsteps);
-        fflush(stdout);
+    if (config.max_rung > 0) {
+        n_forces = integrate_block(&sys, &config, ENGINES[version_id - 1].compute,
+                                   nsteps, dt, 1);
+    } else {
+        n_forces = integrate_split(&sys, &config, ENGINES[version_id - 1].compute,
+                                   &INTEGRATORS[config.integrator], nsteps, dt, 1);
     }
 
     printf("\nSimulation Complete: %.2fs\n", sim_time_now() - t_start);
+    if (config.max_rung > 0) {
+        printf("Block steps: %.2f force evaluations per particle per dt (%d substeps)\n",
+               (double)n_forces / ((double)sys.N * nsteps), 1 << config.max_rung);
+    } else {
+        printf("Force evaluations: %lld (%.2f per step)\n",
+               n_forces, (double)n_forces / nsteps);
+    }
+    if (version_id >= 2) {
+        printf("Phases: order %.4fs | tree %.4fs | force %.4fs | integrate %.4fs\n",
+               config.stats.order_time, config.stats.tree_time,
+               config.stats.force_time, config.stats.integrate_time);
+    } else {
+        printf("Phases: integrate %.4fs\n", config.stats.integrate_time);
+    }
+    if (config.stats.reorders > 0 && config.morton_sort == MORTON_SORT_INCREMENTAL) {
+        long long n_inc = config.stats.reorders - config.stats.full_sorts;
+        printf("Morton reorders: %lld (%lld full sorts), %.1f ranks changed per reorder",
+               config.stats.reorders, config.stats.full_sorts,
+               (double)config.stats.ranks_changed / config.stats.reorders);
+        if (n_inc > 0)
+            printf(", %.1f displaced per incremental reorder",
+                   (double)config.stats.displaced / n_inc);
+        printf("\n");
+    }
+
+    if (config.tree_reuse == TREE_REUSE_REFIT) {
+        printf("Tree reuse: %lld refits, %lld rebuilds\n",
+               config.stats.refits, config.stats.rebuilds);
+    }
 
     char out_name[64];
-    const char* label = (version_id == 1) ? "naive" : "barnes_hut";
-    snprintf(out_name, sizeof(out_name), "data/outputs/result_%s.gal", label);
+    snprintf(out_name, sizeof(out_name), "data/outputs/result_%s.gal",
+             ENGINES[version_id - 1].label);
     io_write_result(out_name, &sys);
     io_free_particles(&sys);
     return 0;
 }
 
-/** Velocity Verlet half-kick + full drift
- * Updates velocities by half a step then advances positions.
+/** Apply one --name=value option to the kernel configuration.
+ * Returns 0 if the option or its value is not recognised.
  * ----------------------------------------------------------------- */
-static void integrate_positions(ParticleSystem* sys, double dt) {
-    int N = sys->N;
-    for (int i = 0; i < N; i++) {
-        double m_inv = 1.0 / sys->mass[i];
-        sys->vx[i] += 0.5 * dt * sys->fx[i] * m_inv;
-        sys->vy[i] += 0.5 * dt * sys->fy[i] * m_inv;
-        sys->pos_x[i] += dt * sys->vx[i];
-        sys->pos_y[i] += dt * sys->vy[i];
+static int parse_option(const char* arg, KernelConfig* config) {
+    if (strncmp(arg, "--order=", 8) == 0) {
+        char* end = NULL;
+        long p = strtol(arg + 8, &end, 10);
+        if (end == arg + 8 || *end != '\0' || p < 1 || p > 10) return 0;
+        config->fmm_order = (int)p;
+        return 1;
     }
-}
-
-/** Velocity Verlet second half-kick
- * Completes the velocity update after new forces are computed.
- * ----------------------------------------------------------------- */
-static void integrate_velocities(ParticleSystem* sys, double dt) {
-    int N = sys->N;
-    for (int i = 0; i < N; i++) {
-        double m_inv = 1.0 / sys->mass[i];
-        sys->vx[i] += 0.5 * dt * sys->fx[i] * m_inv;
-        sys->vy[i] += 0.5 * dt * sys->fy[i] * m_inv;
+    if (strncmp(arg, "--grid=", 7) == 0) {
+        char* end = NULL;
+        long n = strtol(arg + 7, &end, 10);
+        if (end == arg + 7 || *end != '\0' || n < 16 || n > 4096 ||
+            (n & (n - 1)) != 0) return 0;
+        config->pm_grid = (int)n;
+        return 1;
+    }
+    if (strncmp(arg, "--split=", 8) == 0) {
+        char* end = NULL;
+        double s = strtod(arg + 8, &end);
+        if (end == arg + 8 || *end != '\0' || s < 0.0 || s > 16.0) return 0;
+        config->pm_split = s;
+        return 1;
+    }
+    if (strcmp(arg, "--store=force") == 0) {
+        config->force_store = FORCE_STORE_FORCE;
+        return 1;
+    }
+    if (strcmp(arg, "--store=accel") == 0) {
+        config->force_store = FORCE_STORE_ACCEL;
+        return 1;
+    }
+    if (strcmp(arg, "--kicks=separate") == 0) {
+        config->kick_merge = KICK_SEPARATE;
+        return 1;
+    }
+    if (strcmp(arg, "--kicks=merged") == 0) {
+        config->kick_merge = KICK_MERGED;
+        return 1;
+    }
+    if (strncmp(arg, "--integrator=", 13) == 0) {
+        int i = integrator_find(arg + 13);
+        if (i < 0) return 0;
+        config->integrator = i;
+        return 1;
+    }
+    if (strncmp(arg, "--rungs=", 8) == 0) {
+        char* end = NULL;
+        long n = strtol(arg + 8, &end, 10);
+        if (end == arg + 8 || *end != '\0' || n < 0 || n > MAX_RUNGS) return 0;
+        config->max_rung = (int)n;
+        return 1;
+    }
+    if (strncmp(arg, "--leaf=", 7) == 0) {
+        char* end = NULL;
+        long n = strtol(arg + 7, &end, 10);
+        if (end == arg + 7 || *end != '\0' || n < 1 || n > 1024) return 0;
+        config->leaf_size = (int)n;
+        return 1;
+    }
+    if (strcmp(arg, "--tree=rebuild") == 0) {
+        config->tree_reuse = TREE_REUSE_REBUILD;
+        return 1;
+    }
+    if (strcmp(arg, "--tree=refit") == 0) {
+        config->tree_reuse = TREE_REUSE_REFIT;
+        return 1;
+    }
+    if (strcmp(arg, "--build=serial") == 0) {
+        config->tree_build = TREE_BUILD_SERIAL;
+        return 1;
+    }
+    if (strcmp(arg, "--build=parallel") == 0) {
+        config->tree_build = TREE_BUILD_PARALLEL;
+        return 1;
+    }
+    if (strcmp(arg, "--build=linear") == 0) {
+        config->tree_build = TREE_BUILD_LINEAR;
+        return 1;
+    }
+    if (strcmp(arg, "--sort=qsort") == 0) {
+        config->morton_sort = MORTON_SORT_QSORT;
+        return 1;
+    }
+    if (strcmp(arg, "--sort=radix") == 0) {
+        config->morton_sort = MORTON_SORT_RADIX;
+        return 1;
+    }
+    if (strcmp(arg, "--sort=incremental") == 0) {
+        config->morton_sort = MORTON_SORT_INCREMENTAL;
+        return 1;
+    }
+    if (strcmp(arg, "--walk=pointer") == 0) {
+        config->tree_walk = TREE_WALK_POINTER;
+        return 1;
+    }
+    if (strcmp(arg, "--walk=packed") == 0) {
+        config->tree_walk = TREE_WALK_PACKED;
+        return 1;
     }
+    if (strcmp(arg, "--walk=soa") == 0) {
+        config->tree_walk = TREE_WALK_SOA;
+        return 1;
+    }
+    if (strcmp(arg, "--walk=group") == 0) {
+        config->tree_walk = TREE_WALK_GROUP;
+        return 1;
+    }
+    if (strcmp(arg, "--walk=dual") == 0) {
+        config->tree_walk = TREE_WALK_DUAL;
+        return 1;
+    }
+    if (strcmp(arg, "--multipole=monopole") == 0) {
+        config->multipole = MULTIPOLE_MONOPOLE;
+        return 1;
+    }
+    if (strcmp(arg, "--multipole=quadrupole") == 0) {
+        config->multipole = MULTIPOLE_QUADRUPOLE;
+        return 1;
+    }
+    if (strcmp(arg, "--pairs=full") == 0) {
+        config->naive_pairs = NAIVE_PAIRS_FULL;
+        return 1;
+    }
+    if (strcmp(arg, "--pairs=symmetric") == 0) {
+        config->naive_pairs = NAIVE_PAIRS_SYMMETRIC;
+        return 1;
+    }
+    if (strcmp(arg, "--kernel=scalar") == 0) {
+        config->force_kernel = FORCE_KERNEL_SCALAR;
+        return 1;
+    }
+    if (strcmp(arg, "--kernel=simd") == 0) {
+        config->force_kernel = FORCE_KERNEL_SIMD;
+        return 1;
+    }
+    if (strcmp(arg, "--kernel=avx2") == 0) {
+        config->force_kernel = FORCE_KERNEL_AVX2;
+        return 1;
+    }
+    if (strcmp(arg, "--kernel=avx512") == 0) {
+        config->force_kernel = FORCE_KERNEL_AVX512;
+        return 1;
+    }
+    if (strcmp(arg, "--com=insert") == 0) {
+        config->tree_com = TREE_COM_INSERT;
+        return 1;
+    }
+    if (strcmp(arg, "--com=bottomup") == 0) {
+        config->tree_com = TREE_COM_BOTTOM_UP;
+        return 1;
+    }
+    return 0;
 }
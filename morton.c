@@ -1,11 +1,36 @@
 #include "morton.h"
-#include <stdint.h>
+#include "particles.h"
+#include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#define RADIX_BITS 8
+#define RADIX_SIZE (1 << RADIX_BITS)
+
+/* Incremental re-sort gives up beyond N / this many displaced entries */
+#define INCREMENTAL_MAX_DISPLACED_DIV 8
+
+/* Buffers reused across calls, grown on demand */
+static SortEntry* sort_entries  = NULL;
+static SortEntry* sort_scratch  = NULL;
+static SortEntry* sort_moved    = NULL;
+static int*       sort_order    = NULL;
+static int        sort_capacity = 0;
+static size_t*    radix_hist    = NULL;
+static int        hist_threads  = 0;
+
+#if defined(__x86_64__) && (defined(__GNUC__) || defined(__clang__))
+#include <immintrin.h>
+#define MORTON_HAVE_PDEP 1
+#endif
 
 /** Interleave x and y bits into a 64-bit Morton (Z-order) code.
+ * Bit-by-bit reference implementation.
  * ----------------------------------------------------------------- */
-static uint64_t morton_encode(unsigned int x, unsigned int y) {
+uint64_t morton_encode_loop(uint32_t x, uint32_t y) {
     uint64_t code = 0;
     for (uint64_t i = 0; i < 32; i++) {
         uint64_t x_bit = (x >> i) & 1;
@@ -15,10 +40,62 @@ static uint64_t morton_encode(unsigned int x, unsigned int y) {
     return code;
 }
 
-typedef struct {
-    int      index;
-    uint64_t code;
-} SortEntry;
+/* Each byte spread into the even bits of 16 */
+#define SPREAD2(n) n, n + 1, n + 4, n + 5
+#define SPREAD4(n) SPREAD2(n), SPREAD2(n + 16), SPREAD2(n + 64), SPREAD2(n + 80)
+#define SPREAD6(n) SPREAD4(n), SPREAD4(n + 256), SPREAD4(n + 1024), SPREAD4(n + 1280)
+#define SPREAD8(n) SPREAD6(n), SPREAD6(n + 4096), SPREAD6(n + 16384), SPREAD6(n + 20480)
+static const uint16_t SPREAD_LUT[256] = { SPREAD8(0) };
+
+static uint64_t spread_lut(uint32_t v) {
+    return  (uint64_t)SPREAD_LUT[v & 0xFF]
+         | ((uint64_t)SPREAD_LUT[(v >>  8) & 0xFF] << 16)
+         | ((uint64_t)SPREAD_LUT[(v >> 16) & 0xFF] << 32)
+         | ((uint64_t)SPREAD_LUT[(v >> 24) & 0xFF] << 48);
+}
+
+uint64_t morton_encode_lut(uint32_t x, uint32_t y) {
+    return spread_lut(x) | (spread_lut(y) << 1);
+}
+
+#ifdef MORTON_HAVE_PDEP
+__attribute__((target("bmi2")))
+static uint64_t encode_bmi2(uint32_t x, uint32_t y) {
+    return _pdep_u64(x, 0x5555555555555555ULL) |
+           _pdep_u64(y, 0xAAAAAAAAAAAAAAAAULL);
+}
+
+__attribute__((target("bmi2")))
+static void decode_bmi2(uint64_t code, uint32_t* x, uint32_t* y) {
+    *x = (uint32_t)_pext_u64(code, 0x5555555555555555ULL);
+    *y = (uint32_t)_pext_u64(code, 0xAAAAAAAAAAAAAAAAULL);
+}
+#endif
+
+int morton_have_bmi2(void) {
+#ifdef MORTON_HAVE_PDEP
+    return __builtin_cpu_supports("bmi2");
+#else
+    return 0;
+#endif
+}
+
+uint64_t morton_encode_pdep(uint32_t x, uint32_t y) {
+#ifdef MORTON_HAVE_PDEP
+    if (morton_have_bmi2()) return encode_bmi2(x, y);
+#endif
+    return morton_encode(x, y);
+}
+
+void morton_decode_pdep(uint64_t code, uint32_t* x, uint32_t* y) {
+#ifdef MORTON_HAVE_PDEP
+    if (morton_have_bmi2()) {
+        decode_bmi2(code, x, y);
+        return;
+    }
+#endif
+    morton_decode(code, x, y);
+}
 
 static int compare_entries(const void* a, const void* b) {
     uint64_t ca = ((SortEntry*)a)->code;
@@ -28,51 +105,195 @@ static int compare_entries(const void* a, const void* b) {
     return 0;
 }
 
+void morton_sort_qsort(SortEntry* entries, int N) {
+    qsort(entries, N, sizeof(SortEntry), compare_entries);
+}
+
+/** Stable LSD radix sort on the 64-bit codes, RADIX_BITS per pass.
+ * Each thread histograms a contiguous slice, the per-thread counts are
+ * prefix-summed in (digit, thread) order, and each thread then scatters
+ * its slice to its own offsets, which keeps every pass stable. Passes
+ * whose digit is the same for all entries are skipped.
+ * ----------------------------------------------------------------- */
+void morton_sort_radix(SortEntry* entries, SortEntry* scratch, int N,
+                       int n_threads) {
+    if (n_threads < 1) n_threads = 1;
+    if (hist_threads < n_threads) {
+        free(radix_hist);
+        radix_hist = (size_t*)malloc((size_t)n_threads * RADIX_SIZE * sizeof(size_t));
+        hist_threads = radix_hist ? n_threads : 0;
+    }
+    if (!radix_hist) {
+        morton_sort_qsort(entries, N);
+        return;
+    }
+    size_t* hist = radix_hist;
+
+    SortEntry* src = entries;
+    SortEntry* dst = scratch;
+
+    for (int shift = 0; shift < 64; shift += RADIX_BITS) {
+        int n_team = 1;
+        int trivial = 0;
+
+#ifdef _OPENMP
+#pragma omp parallel num_threads(n_threads)
+#endif
+        {
+#ifdef _OPENMP
+            int t = omp_get_thread_num();
+#pragma omp single
+            n_team = omp_get_num_threads();
+#else
+            int t = 0;
+#endif
+            size_t* h  = hist + (size_t)t * RADIX_SIZE;
+            int     lo = (int)((long long)N * t / n_team);
+            int     hi = (int)((long long)N * (t + 1) / n_team);
+
+            for (int d = 0; d < RADIX_SIZE; d++) h[d] = 0;
+            for (int i = lo; i < hi; i++)
+                h[(src[i].code >> shift) & (RADIX_SIZE - 1)]++;
+
+#ifdef _OPENMP
+#pragma omp barrier
+#pragma omp single
+#endif
+            {
+                size_t sum = 0;
+                for (int d = 0; d < RADIX_SIZE; d++) {
+                    size_t digit_total = 0;
+                    for (int tt = 0; tt < n_team; tt++) {
+                        size_t c = hist[(size_t)tt * RADIX_SIZE + d];
+                        hist[(size_t)tt * RADIX_SIZE + d] = sum;
+                        sum += c;
+                        digit_total += c;
+                    }
+                    if (digit_total == (size_t)N) trivial = 1;
+                }
+            }
+
+            if (!trivial) {
+                for (int i = lo; i < hi; i++) {
+                    int d = (int)((src[i].code >> shift) & (RADIX_SIZE - 1));
+                    dst[h[d]++] = src[i];
+                }
+            }
+        }
+
+        if (!trivial) {
+            SortEntry* tmp = src;
+            src = dst;
+            dst = tmp;
+        }
+    }
+
+    if (src != entries)
+        memcpy(entries, src, (size_t)N * sizeof(SortEntry));
+}
+
+/** Re-sort entries that are nearly in order already.
+ * A single pass keeps a sorted subsequence (an entry is kept if it is
+ * not below the last kept code and not above its successor) in kept and
+ * sets the rest aside in moved; the displaced entries are sorted and
+ * merged back in, for O(N + D log D) work. Returns D, or -1 (leaving
+ * entries untouched) when more than N / INCREMENTAL_MAX_DISPLACED_DIV
+ * entries are displaced.
+ * ----------------------------------------------------------------- */
+static int fixup_nearly_sorted(SortEntry* entries, int N, SortEntry* kept,
+                               SortEntry* moved) {
+    int descents = 0;
+    for (int i = 1; i < N; i++)
+        if (entries[i - 1].code > entries[i].code) descents++;
+    if (descents == 0) return 0;
+
+    int max_displaced = N / INCREMENTAL_MAX_DISPLACED_DIV;
+    if (2 * descents > max_displaced) return -1;
+
+    int n_kept = 0, n_moved = 0;
+    for (int i = 0; i < N; i++) {
+        uint64_t c = entries[i].code;
+        int in_order = (n_kept == 0 || c >= kept[n_kept - 1].code) &&
+                       (i == N - 1 || c <= entries[i + 1].code);
+        if (in_order) {
+            kept[n_kept++] = entries[i];
+        } else {
+            if (n_moved == max_displaced) return -1;
+            moved[n_moved++] = entries[i];
+        }
+    }
+
+    morton_sort_qsort(moved, n_moved);
+
+    int a = 0, b = 0;
+    for (int i = 0; i < N; i++) {
+        if (b == n_moved || (a < n_kept && kept[a].code <= moved[b].code))
+            entries[i] = kept[a++];
+        else
+            entries[i] = moved[b++];
+    }
+    return n_moved;
+}
+
 /** Reorder all particle arrays by Z-order curve within the given bounding box.
  * Nearby particles in space end up nearby in memory after this sort.
+ * Only the span between the first and last particle that changed rank
+ * is permuted; rank changes are added to config->stats.
  * ----------------------------------------------------------------- */
-void z_order_sort(ParticleSystem* sys, double LB, double RB, double DB, double UB) {
+void z_order_sort(ParticleSystem* sys, KernelConfig* config, double LB,
+                  double RB, double DB, double UB, uint64_t* codes) {
     int N = sys->N;
-    SortEntry* entries = (SortEntry*)malloc(N * sizeof(SortEntry));
-    if (!entries) return;
+    if (sort_capacity < N) {
+        free(sort_entries); free(sort_scratch); free(sort_moved); free(sort_order);
+        sort_entries = (SortEntry*)malloc(N * sizeof(SortEntry));
+        sort_scratch = (SortEntry*)malloc(N * sizeof(SortEntry));
+        sort_moved   = (SortEntry*)malloc((N / INCREMENTAL_MAX_DISPLACED_DIV + 1) *
+                                          sizeof(SortEntry));
+        sort_order   = (int*)malloc(N * sizeof(int));
+        if (!sort_entries || !sort_scratch || !sort_moved || !sort_order) {
+            fprintf(stderr, "Error: Morton sort allocation failed!\n");
+            exit(1);
+        }
+        sort_capacity = N;
+    }
+    SortEntry* entries = sort_entries;
 
     double scale_x = (double)((1ULL << 32) - 1) / (RB - LB);
     double scale_y = (double)((1ULL << 32) - 1) / (UB - DB);
 
     for (int i = 0; i < N; i++) {
-        unsigned int ix = (unsigned int)((sys->pos_x[i] - LB) * scale_x);
-        unsigned int iy = (unsigned int)((sys->pos_y[i] - DB) * scale_y);
+        uint32_t ix = (uint32_t)((sys->pos_x[i] - LB) * scale_x);
+        uint32_t iy = (uint32_t)((sys->pos_y[i] - DB) * scale_y);
         entries[i].index = i;
         entries[i].code  = morton_encode(ix, iy);
     }
 
-    qsort(entries, N, sizeof(SortEntry), compare_entries);
-
-    /* Permute each particle array into the new order */
-    double* temp = (double*)malloc(N * sizeof(double));
-    if (!temp) { free(entries); return; }
-
-    for (int i = 0; i < N; i++) temp[i] = sys->pos_x[entries[i].index];
-    memcpy(sys->pos_x, temp, N * sizeof(double));
-
-    for (int i = 0; i < N; i++) temp[i] = sys->pos_y[entries[i].index];
-    memcpy(sys->pos_y, temp, N * sizeof(double));
-
-    for (int i = 0; i < N; i++) temp[i] = sys->mass[entries[i].index];
-    memcpy(sys->mass, temp, N * sizeof(double));
-
-    for (int i = 0; i < N; i++) temp[i] = sys->vx[entries[i].index];
-    memcpy(sys->vx, temp, N * sizeof(double));
-
-    for (int i = 0; i < N; i++) temp[i] = sys->vy[entries[i].index];
-    memcpy(sys->vy, temp, N * sizeof(double));
-
-    for (int i = 0; i < N; i++) temp[i] = sys->fx[entries[i].index];
-    memcpy(sys->fx, temp, N * sizeof(double));
+    int displaced = -1;
+    if (config->morton_sort == MORTON_SORT_INCREMENTAL)
+        displaced = fixup_nearly_sorted(entries, N, sort_scratch, sort_moved);
+    if (displaced >= 0) {
+        config->stats.displaced += displaced;
+    } else {
+        if (config->morton_sort == MORTON_SORT_QSORT)
+            morton_sort_qsort(entries, N);
+        else
+            morton_sort_radix(entries, sort_scratch, N, config->n_threads);
+        config->stats.full_sorts++;
+    }
+    config->stats.reorders++;
 
-    for (int i = 0; i < N; i++) temp[i] = sys->fy[entries[i].index];
-    memcpy(sys->fy, temp, N * sizeof(double));
+    int lo = N, hi = 0, changed = 0;
+    for (int i = 0; i < N; i++) {
+        if (codes) codes[i] = entries[i].code;
+        sort_order[i] = entries[i].index;
+        if (entries[i].index != i) {
+            if (i < lo) lo = i;
+            hi = i + 1;
+            changed++;
+        }
+    }
+    config->stats.ranks_changed += changed;
 
-    free(temp);
-    free(entries);
+    if (changed > 0)
+        particles_permute(sys, sort_order, lo, hi, config->n_threads);
 }
@@ -2,9 +2,64 @@
 #define MORTON_H
 
 #include "types.h"
+#include <stdint.h>
 
-// Reorder particles by Morton code within the given bounding box.
-void z_order_sort(ParticleSystem* sys, double LB, double RB, double DB,
-                  double UB);
+// Spread the 32 bits of v into the even bits of a 64-bit word.
+static inline uint64_t morton_part1by1(uint32_t v) {
+    uint64_t x = v;
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFFULL;
+    x = (x | (x <<  8)) & 0x00FF00FF00FF00FFULL;
+    x = (x | (x <<  4)) & 0x0F0F0F0F0F0F0F0FULL;
+    x = (x | (x <<  2)) & 0x3333333333333333ULL;
+    x = (x | (x <<  1)) & 0x5555555555555555ULL;
+    return x;
+}
+
+// Gather the even bits of a 64-bit word back into 32 bits.
+static inline uint32_t morton_compact1by1(uint64_t x) {
+    x &= 0x5555555555555555ULL;
+    x = (x | (x >>  1)) & 0x3333333333333333ULL;
+    x = (x | (x >>  2)) & 0x0F0F0F0F0F0F0F0FULL;
+    x = (x | (x >>  4)) & 0x00FF00FF00FF00FFULL;
+    x = (x | (x >>  8)) & 0x0000FFFF0000FFFFULL;
+    x = (x | (x >> 16)) & 0x00000000FFFFFFFFULL;
+    return (uint32_t)x;
+}
+
+// Interleave x (even bits) and y (odd bits) into a 64-bit Morton code.
+static inline uint64_t morton_encode(uint32_t x, uint32_t y) {
+    return morton_part1by1(x) | (morton_part1by1(y) << 1);
+}
+
+static inline void morton_decode(uint64_t code, uint32_t* x, uint32_t* y) {
+    *x = morton_compact1by1(code);
+    *y = morton_compact1by1(code >> 1);
+}
+
+// Alternative encoders, all producing the same codes as morton_encode:
+// bit-by-bit reference, byte lookup table, and BMI2 pdep (falls back to
+// morton_encode when the CPU lacks BMI2; see morton_have_bmi2).
+uint64_t morton_encode_loop(uint32_t x, uint32_t y);
+uint64_t morton_encode_lut(uint32_t x, uint32_t y);
+uint64_t morton_encode_pdep(uint32_t x, uint32_t y);
+void     morton_decode_pdep(uint64_t code, uint32_t* x, uint32_t* y);
+int      morton_have_bmi2(void);
+
+typedef struct {
+    int      index;
+    uint64_t code;
+} SortEntry;
+
+// Reorder particles by Morton code within the given bounding box, using
+// the sort selected by config->morton_sort, and update config->stats.
+// If codes is non-NULL it receives the sorted codes (N entries).
+void z_order_sort(ParticleSystem* sys, KernelConfig* config, double LB,
+                  double RB, double DB, double UB, uint64_t* codes);
+
+// Sort entries by code: comparison sort, or stable parallel LSD radix sort
+// using scratch (N entries) as the second buffer.
+void morton_sort_qsort(SortEntry* entries, int N);
+void morton_sort_radix(SortEntry* entries, SortEntry* scratch, int N,
+                       int n_threads);
 
 #endif
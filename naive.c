@@ -1,12 +1,71 @@
+#include "kernels.h"
+#include "particles.h"
 #include "types.h"
 #include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
 
 #define G_FACTOR 100.0
 #define EPSILON  1e-3
 
+static const int NAIVE_ROWS = 64;   /* targets per parallel work item */
+static const int NAIVE_TILE = 512;  /* bodies per tile: 12 KB of x, y, m */
+
+/* Per-thread force accumulators for the symmetric pass */
+static double* pair_acc      = NULL;
+static size_t  pair_acc_size = 0;
+
+static void compute_force_symmetric(ParticleSystem* sys, int n_threads);
+
+#if defined(__x86_64__) && defined(__GNUC__) && !defined(__clang__)
+/* One clone per instruction set, picked by the loader at startup */
+#define PAIR_TILE_CLONES __attribute__((target_clones("avx512f", "avx2", "default")))
+#else
+#define PAIR_TILE_CLONES
+#endif
+
+/** Interactions between targets [i0, i1) and bodies [j0, j1), each pair
+ * once: the action is summed for i and the reaction subtracted from j.
+ * On a diagonal tile only j > i is visited.
+ * ----------------------------------------------------------------- */
+PAIR_TILE_CLONES
+static void pair_tile(const double* x, const double* y, const double* m,
+                      double* ax, double* ay, int i0, int i1, int j0, int j1,
+                      int diagonal) {
+    for (int i = i0; i < i1; i++) {
+        const double xi = x[i], yi = y[i], mi = m[i];
+        int js = diagonal ? i + 1 : j0;
+        double sx = 0.0, sy = 0.0;
+#ifdef _OPENMP
+#pragma omp simd reduction(+:sx, sy)
+#endif
+        for (int j = js; j < j1; j++) {
+            const double dx = x[j] - xi;
+            const double dy = y[j] - yi;
+            const double denom = sqrt(dx * dx + dy * dy) + EPSILON;
+            const double f = mi * m[j] / (denom * denom * denom);
+            sx += f * dx;
+            sy += f * dy;
+            ax[j] -= f * dx;
+            ay[j] -= f * dy;
+        }
+        ax[i] += sx;
+        ay[i] += sy;
+    }
+}
+
 /* Brute-force baseline, O(N^2) complexity. */
 void compute_force_naive(ParticleSystem* sys, KernelConfig* config) {
-    (void)config;
+    if (config->naive_pairs == NAIVE_PAIRS_SYMMETRIC) {
+        compute_force_symmetric(sys, config->n_threads);
+        return;
+    }
+
+    ForceKernel kernel = force_kernel_select(config->force_kernel);
     const int N = sys->N;
     const double G = G_FACTOR / N;
 
@@ -16,25 +75,102 @@ void compute_force_naive(ParticleSystem* sys, KernelConfig* config) {
     double* fx_out = sys->fx;
     double* fy_out = sys->fy;
 
-    for (int i = 0; i < N; i++) {
-        double fx = 0.0;
-        double fy = 0.0;
+    // Blocks of NAIVE_ROWS targets sweep the bodies one tile at a time,
+    // so each tile is reused from cache by every target in the block.
+    // Per target, tiles are visited in order and the kernel keeps
+    // accumulating, so the summation order is that of a plain j loop.
+    int n_blocks = (N + NAIVE_ROWS - 1) / NAIVE_ROWS;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(dynamic, 1) num_threads(config->n_threads)
+#endif
+    for (int b = 0; b < n_blocks; b++) {
+        int i0 = b * NAIVE_ROWS;
+        int i1 = i0 + NAIVE_ROWS < N ? i0 + NAIVE_ROWS : N;
+        for (int i = i0; i < i1; i++) {
+            fx_out[i] = 0.0;
+            fy_out[i] = 0.0;
+        }
+        for (int j0 = 0; j0 < N; j0 += NAIVE_TILE) {
+            int len = N - j0 < NAIVE_TILE ? N - j0 : NAIVE_TILE;
+            // Particle i itself sits at distance zero and adds nothing.
+            for (int i = i0; i < i1; i++) {
+                if (particle_active(sys, config, i))
+                    kernel(x[i], y[i], G * sink_mass(sys, config->force_store, i),
+                           x + j0, y + j0, m + j0, len, &fx_out[i], &fy_out[i]);
+            }
+        }
+    }
+}
+
+/** All-pairs forces evaluating each pair once (Newton's third law).
+ * Tile pairs (I, J) with J >= I are handed out dynamically; the reaction
+ * on tile J goes to the calling thread's own accumulator, and the
+ * accumulators are summed at the end. Half the interactions of the full
+ * pass, but the summation order, and so the rounding, differs from it.
+ * ----------------------------------------------------------------- */
+static void compute_force_symmetric(ParticleSystem* sys, int n_threads) {
+    const int N = sys->N;
+    const double G = G_FACTOR / N;
+    const double* x = sys->pos_x;
+    const double* y = sys->pos_y;
+    const double* m = sys->mass;
+    if (n_threads < 1) n_threads = 1;
 
-        // Direct all-pairs interaction: accumulate the force on particle i.
-        for (int j = 0; j < N; j++) {
-            if (i == j)
-                continue;
+    size_t need = (size_t)2 * N * n_threads;
+    if (pair_acc_size < need) {
+        free(pair_acc);
+        pair_acc = (double*)malloc(need * sizeof(double));
+        if (!pair_acc) {
+            fprintf(stderr, "Error: pair accumulator allocation failed!\n");
+            exit(1);
+        }
+        pair_acc_size = need;
+    }
+    memset(pair_acc, 0, need * sizeof(double));
+
+    int n_tiles = (N + NAIVE_TILE - 1) / NAIVE_TILE;
+    int n_pairs = n_tiles * (n_tiles + 1) / 2;
 
-            const double dx = x[j] - x[i];
-            const double dy = y[j] - y[i];
-            const double r = sqrt(dx * dx + dy * dy);
-            const double denom = r + EPSILON;
+#ifdef _OPENMP
+#pragma omp parallel num_threads(n_threads)
+#endif
+    {
+#ifdef _OPENMP
+        int t = omp_get_thread_num();
+#else
+        int t = 0;
+#endif
+        double* ax = pair_acc + (size_t)2 * N * t;
+        double* ay = ax + N;
+
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic, 1)
+#endif
+        for (int p = 0; p < n_pairs; p++) {
+            int ti = 0, rem = p;
+            while (rem >= n_tiles - ti) {
+                rem -= n_tiles - ti;
+                ti++;
+            }
+            int tj = ti + rem;
+            int i0 = ti * NAIVE_TILE;
+            int i1 = i0 + NAIVE_TILE < N ? i0 + NAIVE_TILE : N;
+            int j1 = (tj + 1) * NAIVE_TILE < N ? (tj + 1) * NAIVE_TILE : N;
+
+            pair_tile(x, y, m, ax, ay, i0, i1, tj * NAIVE_TILE, j1, ti == tj);
+        }
 
-            const double f = G * m[i] * m[j] / (denom * denom * denom);
-            fx += f * dx;
-            fy += f * dy;
+#ifdef _OPENMP
+#pragma omp for
+#endif
+        for (int i = 0; i < N; i++) {
+            double fx = 0.0, fy = 0.0;
+            for (int s = 0; s < n_threads; s++) {
+                fx += pair_acc[(size_t)2 * N * s + i];
+                fy += pair_acc[(size_t)2 * N * s + N + i];
+            }
+            sys->fx[i] = G * fx;
+            sys->fy[i] = G * fy;
         }
-        fx_out[i] = fx;
-        fy_out[i] = fy;
     }
 }
@@ -0,0 +1,94 @@
+#include "particles.h"
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+/* Addresses of the front arrays carried across a reorder, in the order
+ * of sys->back. Forces are not permuted because every caller recomputes
+ * them in the new order straight after reordering. */
+static void front_arrays(ParticleSystem* sys, double** fields[]) {
+    fields[0] = &sys->pos_x;
+    fields[1] = &sys->pos_y;
+    fields[2] = &sys->mass;
+    fields[3] = &sys->vx;
+    fields[4] = &sys->vy;
+    fields[5] = &sys->step;
+}
+
+static void alloc_back_arrays(ParticleSystem* sys) {
+    double** fields[N_BACK_ARRAYS];
+    front_arrays(sys, fields);
+    for (int k = 0; k < N_BACK_ARRAYS; k++) {
+        if (sys->back[k] || !*fields[k]) continue;
+        sys->back[k] = (double*)malloc(sys->N * sizeof(double));
+        if (!sys->back[k]) {
+            fprintf(stderr, "Error: Memory allocation failed for back buffer.\n");
+            exit(1);
+        }
+    }
+}
+
+static void swap_arrays(ParticleSystem* sys) {
+    double** fields[N_BACK_ARRAYS];
+    front_arrays(sys, fields);
+    for (int k = 0; k < N_BACK_ARRAYS; k++) {
+        double* tmp  = *fields[k];
+        *fields[k]   = sys->back[k];
+        sys->back[k] = tmp;
+    }
+}
+
+/** Gather the live particle arrays into the back buffers in one pass.
+ * When the span covers at least half the system the whole system is
+ * gathered (identity outside the span) and the buffers are swapped;
+ * otherwise only the span is gathered and copied back, which moves
+ * less data than a full swap would.
+ * ----------------------------------------------------------------- */
+void particles_permute(ParticleSystem* sys, const int* order, int lo, int hi,
+                       int n_threads) {
+    int N = sys->N;
+    if (hi <= lo) return;
+    alloc_back_arrays(sys);
+
+    int swap = 2 * (hi - lo) >= N;
+    if (swap) {
+        lo = 0;
+        hi = N;
+    }
+
+    const double* x  = sys->pos_x;
+    const double* y  = sys->pos_y;
+    const double* m  = sys->mass;
+    const double* vx = sys->vx;
+    const double* vy = sys->vy;
+    const double* st = sys->step;
+    double* const* b = sys->back;
+#ifndef _OPENMP
+    (void)n_threads;
+#endif
+
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) num_threads(n_threads)
+#endif
+    for (int i = lo; i < hi; i++) {
+        int j = order[i];
+        b[0][i] = x[j];
+        b[1][i] = y[j];
+        b[2][i] = m[j];
+        b[3][i] = vx[j];
+        b[4][i] = vy[j];
+        if (st) b[5][i] = st[j];
+    }
+
+    if (swap) {
+        swap_arrays(sys);
+        return;
+    }
+
+    double** fields[N_BACK_ARRAYS];
+    front_arrays(sys, fields);
+    for (int k = 0; k < N_BACK_ARRAYS; k++) {
+        if (*fields[k])
+            memcpy(*fields[k] + lo, b[k] + lo, (hi - lo) * sizeof(double));
+    }
+}
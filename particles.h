@@ -0,0 +1,32 @@
+#ifndef PARTICLES_H
+#define PARTICLES_H
+
+#include "types.h"
+
+// Whether particle i needs its force in this engine call: every
+// particle unless block timesteps are on, then those whose step is no
+// longer than config->active_step.
+static inline int particle_active(const ParticleSystem* sys,
+                                  const KernelConfig* config, int i) {
+    return !sys->step || sys->step[i] <= config->active_step;
+}
+
+// Factor of particle i's own mass in what the engines write for it
+// under force_store (FORCE_STORE_*): its mass for forces, 1 for
+// accelerations.
+static inline double sink_mass(const ParticleSystem* sys, int force_store,
+                               int i) {
+    return force_store == FORCE_STORE_ACCEL ? 1.0 : sys->mass[i];
+}
+
+// Reorder positions, masses, velocities and steps so that slot i
+// receives the particle previously at order[i]. order must cover [0, N)
+// and be the identity outside [lo, hi). Forces are left as they are:
+// callers must recompute them before use. Writes go to the back buffers
+// in one fused, OpenMP-parallel pass; large spans are then swapped in,
+// small ones copied back. The back buffers are allocated on the first
+// call. After a swap, pointers into the particle arrays go stale.
+void particles_permute(ParticleSystem* sys, const int* order, int lo, int hi,
+                       int n_threads);
+
+#endif
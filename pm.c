@@ -0,0 +1,332 @@
+#include "fft.h"
+#include "morton.h"
+#include "particles.h"
+#include "pm.h"
+#include "time_utils.h"
+#include "types.h"
+#include <math.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#define G_FACTOR 100.0
+#define EPSILON  1e-3
+
+static const int    PM_DEFAULT_GRID     = 256;
+static const int    PM_TILE_CELLS       = 8;  /* deposition tile side, >= 4 */
+static const double DOMAIN_PADDING_FRAC = 0.05;
+
+/* The mesh covers [LB, RB] x [DB, UB] with grid x grid cells. Mass is
+ * deposited into the lower-left quarter of a grid twice as wide, whose
+ * zero padding turns the FFT's cyclic convolution into the open one. */
+static int    grid   = 0;
+static int    padded = 0;
+static double LB = 0.0, RB = 0.0, DB = 0.0, UB = 0.0, cell = 0.0;
+static double split  = 0.0;    /* Gaussian split scale, 0 for the full force */
+static double* mesh   = NULL;  /* density, then acceleration (ax + i ay) */
+static double* kernel = NULL;  /* transposed spectrum of the cell kernel */
+
+/* Sorted Morton codes and the first particle of every deposition tile */
+static uint64_t* pcodes     = NULL;
+static int       pcodes_N   = 0;
+static int*      tile_start = NULL;
+static int       tiles      = 0;  /* tiles per side */
+
+static void   bounding_square(const ParticleSystem* sys);
+static int    inside_mesh(const ParticleSystem* sys);
+static void   setup_mesh(int n_threads);
+static void   deposit(const ParticleSystem* sys, const uint64_t* codes,
+                      int n_threads);
+static void   convolve(int n_threads);
+static void   interpolate(ParticleSystem* sys, int force_store,
+                          int n_threads);
+
+/* Lower cell and weight of the upper one along an axis for cloud-in-cell:
+ * a particle spreads over the two cell centres around it. Clouds that
+ * stick out of the mesh are pushed back onto its edge cells. */
+static inline int cic(double u, double* w) {
+    double f = floor(u - 0.5);
+    *w = u - 0.5 - f;
+    if (f < 0.0)        { *w = 0.0; return 0; }
+    if (f > grid - 2.0) { *w = 1.0; return grid - 2; }
+    return (int)f;
+}
+
+/** Particle-mesh gravity.
+ * Particles are Morton-sorted inside the mesh domain, deposited onto the
+ * mesh with cloud-in-cell weights, the mesh is convolved with the
+ * softened point-mass acceleration via FFT, and the acceleration is
+ * interpolated back with the same weights. The grid only resolves
+ * forces beyond a few cells, so this suits smooth distributions.
+ * ----------------------------------------------------------------- */
+void compute_force_pm(ParticleSystem* sys, KernelConfig* config) {
+    int N = sys->N;
+    double t_start = sim_time_now();
+
+    if (pcodes == NULL || pcodes_N != N) {
+        free(pcodes);
+        pcodes = (uint64_t*)malloc(N * sizeof(uint64_t));
+        if (!pcodes) {
+            fprintf(stderr, "Error: Morton code allocation failed!\n");
+            exit(1);
+        }
+        pcodes_N = N;
+    }
+
+    /* The domain, and with it the kernel spectrum, is kept until a
+     * particle leaves it */
+    int g = config->pm_grid > 0 ? config->pm_grid : PM_DEFAULT_GRID;
+    if (g != grid || split != 0.0 || !inside_mesh(sys)) {
+        grid  = g;
+        split = 0.0;
+        bounding_square(sys);
+        setup_mesh(config->n_threads);
+    }
+    double t_setup = sim_time_now();
+    z_order_sort(sys, config, LB, RB, DB, UB, pcodes);
+    double t_ordered = sim_time_now();
+    config->stats.order_time += t_ordered - t_setup;
+
+    deposit(sys, pcodes, config->n_threads);
+    double t_deposited = sim_time_now();
+
+    convolve(config->n_threads);
+    interpolate(sys, config->force_store, config->n_threads);
+    config->stats.tree_time  += (t_setup - t_start) + (t_deposited - t_ordered);
+    config->stats.force_time += sim_time_now() - t_deposited;
+}
+
+/** Long-range part of the Gaussian force split, for TreePM.
+ * The caller owns the domain and the Morton order; the kernel is rebuilt
+ * whenever the domain, grid or split scale changes.
+ * ----------------------------------------------------------------- */
+void pm_long_range(ParticleSystem* sys, const uint64_t* codes, double lb,
+                   double rb, double db, double ub, int grid_size,
+                   double r_split, int force_store, int n_threads) {
+    if (grid_size != grid || r_split != split || lb != LB || rb != RB ||
+        db != DB || ub != UB || !mesh) {
+        grid  = grid_size;
+        split = r_split;
+        LB = lb;  RB = rb;
+        DB = db;  UB = ub;
+        cell = (RB - LB) / grid;
+        setup_mesh(n_threads);
+    }
+    deposit(sys, codes, n_threads);
+    convolve(n_threads);
+    interpolate(sys, force_store, n_threads);
+}
+
+/* Smallest padded square containing every particle */
+static void bounding_square(const ParticleSystem* sys) {
+    double x_lo = sys->pos_x[0], x_hi = sys->pos_x[0];
+    double y_lo = sys->pos_y[0], y_hi = sys->pos_y[0];
+    for (int i = 1; i < sys->N; i++) {
+        if (sys->pos_x[i] < x_lo) x_lo = sys->pos_x[i];
+        if (sys->pos_x[i] > x_hi) x_hi = sys->pos_x[i];
+        if (sys->pos_y[i] < y_lo) y_lo = sys->pos_y[i];
+        if (sys->pos_y[i] > y_hi) y_hi = sys->pos_y[i];
+    }
+    double size = fmax(x_hi - x_lo, y_hi - y_lo);
+    if (size <= 0.0) size = 1.0;
+    double half = 0.5 * size * (1.0 + 2.0 * DOMAIN_PADDING_FRAC);
+    double cx = 0.5 * (x_lo + x_hi), cy = 0.5 * (y_lo + y_hi);
+    LB = cx - half;
+    RB = cx + half;
+    DB = cy - half;
+    UB = cy + half;
+    cell = (RB - LB) / grid;
+}
+
+/* Whether every particle's cloud still falls inside the mesh */
+static int inside_mesh(const ParticleSystem* sys) {
+    if (!mesh) return 0;
+    double lo_x = LB + 0.5 * cell, hi_x = RB - 0.5 * cell;
+    double lo_y = DB + 0.5 * cell, hi_y = UB - 0.5 * cell;
+    for (int i = 0; i < sys->N; i++) {
+        if (sys->pos_x[i] < lo_x || sys->pos_x[i] >= hi_x ||
+            sys->pos_y[i] < lo_y || sys->pos_y[i] >= hi_y)
+            return 0;
+    }
+    return 1;
+}
+
+/** Size the mesh for the current grid and transform the kernel: the
+ * acceleration -R / (|R| + eps)^3 of a unit mass at cell offset R,
+ * stored as Kx + i Ky at the cyclic index of R so that one complex
+ * convolution yields both components. The bodies feel 1/r^2 gravity
+ * confined to the plane, not the 1/r force of the 2D Poisson equation,
+ * so the mesh Green's function is this kernel rather than -1/k^2. With
+ * a split scale only the long-range fraction 1 - pm_short_factor is
+ * kept, which is smooth on the scale of a few cells.
+ * ----------------------------------------------------------------- */
+static void setup_mesh(int n_threads) {
+    int L = 2 * grid;
+    if (padded != L) {
+        free(mesh);
+        free(kernel);
+        free(tile_start);
+        mesh   = (double*)malloc(2 * (size_t)L * L * sizeof(double));
+        kernel = (double*)malloc(2 * (size_t)L * L * sizeof(double));
+        tiles  = grid / PM_TILE_CELLS;
+        tile_start = (int*)malloc(((size_t)tiles * tiles + 1) * sizeof(int));
+        if (!mesh || !kernel || !tile_start) {
+            fprintf(stderr, "Error: PM mesh allocation failed!\n");
+            exit(1);
+        }
+        padded = L;
+    }
+
+    /* Offsets of +-grid never occur between two cells of the mesh */
+    double norm = 1.0 / ((double)L * L);
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) num_threads(n_threads)
+#endif
+    for (int iy = 0; iy < L; iy++) {
+        int dy = iy < grid ? iy : iy - L;
+        for (int ix = 0; ix < L; ix++) {
+            int dx = ix < grid ? ix : ix - L;
+            double* k = kernel + 2 * ((size_t)iy * L + ix);
+            k[0] = k[1] = 0.0;
+            if ((dx == 0 && dy == 0) || iy == grid || ix == grid) continue;
+            double rx = dx * cell, ry = dy * cell;
+            double r  = sqrt(rx * rx + ry * ry);
+            double d  = r + EPSILON;
+            double f  = norm / (d * d * d);
+            if (split > 0.0) f *= 1.0 - pm_short_factor(r, split);
+            k[0] = -f * rx;
+            k[1] = -f * ry;
+        }
+    }
+    fft_rows(kernel, L, L, -1, n_threads);
+    fft_transpose(kernel, L, n_threads);
+    fft_rows(kernel, L, L, -1, n_threads);
+}
+
+/** Cloud-in-cell mass assignment without atomics.
+ * The mesh is cut into tiles of PM_TILE_CELLS cells, numbered in Morton
+ * order, so each tile's particles are one contiguous range of the
+ * sorted codes. A particle's cloud reaches at most one cell (two at a
+ * rounded tile boundary) past its tile, so tiles of the same colour,
+ * (tx & 1, ty & 1), never write the same cell. The four colours run one
+ * after another, each split over the threads tile by tile.
+ * ----------------------------------------------------------------- */
+static void deposit(const ParticleSystem* sys, const uint64_t* codes,
+                    int n_threads) {
+    int L = padded;
+    int N = sys->N;
+    int n_tiles = tiles * tiles;
+    int shift = 0;
+    while ((1 << shift) < tiles) shift++;
+    shift = 64 - 2 * shift;
+    double inv_cell = 1.0 / cell;
+
+#ifdef _OPENMP
+#pragma omp parallel num_threads(n_threads)
+#else
+    (void)n_threads;
+#endif
+    {
+#ifdef _OPENMP
+#pragma omp for schedule(static)
+#endif
+        for (int iy = 0; iy < L; iy++)
+            memset(mesh + 2 * (size_t)iy * L, 0, 2 * (size_t)L * sizeof(double));
+
+        /* First code at or above each tile key */
+#ifdef _OPENMP
+#pragma omp for schedule(static)
+#endif
+        for (int t = 0; t <= n_tiles; t++) {
+            int lo = t < n_tiles ? 0 : N, hi = N;
+            uint64_t key = (uint64_t)t << shift;
+            while (lo < hi) {
+                int mid = lo + (hi - lo) / 2;
+                if (codes[mid] < key) lo = mid + 1;
+                else                   hi = mid;
+            }
+            tile_start[t] = lo;
+        }
+
+        int half = tiles / 2;
+        for (int colour = 0; colour < 4; colour++) {
+#ifdef _OPENMP
+#pragma omp for schedule(dynamic, 1)
+#endif
+            for (int k = 0; k < half * half; k++) {
+                uint32_t tx = 2 * (k % half) + (colour & 1);
+                uint32_t ty = 2 * (k / half) + (colour >> 1);
+                int t = (int)morton_encode(tx, ty);
+                for (int i = tile_start[t]; i < tile_start[t + 1]; i++) {
+                    double wx, wy;
+                    int ix = cic((sys->pos_x[i] - LB) * inv_cell, &wx);
+                    int iy = cic((sys->pos_y[i] - DB) * inv_cell, &wy);
+                    double m  = sys->mass[i];
+                    double* row0 = mesh + 2 * ((size_t)iy * L + ix);
+                    double* row1 = row0 + 2 * (size_t)L;
+                    row0[0] += m * (1.0 - wx) * (1.0 - wy);
+                    row0[2] += m * wx * (1.0 - wy);
+                    row1[0] += m * (1.0 - wx) * wy;
+                    row1[2] += m * wx * wy;
+                }
+            }
+        }
+    }
+}
+
+/** Convolve the density with the kernel: forward 2D transform of the
+ * occupied rows, multiply by the (equally transposed) kernel spectrum,
+ * and transform back only the rows that cover the mesh.
+ * ----------------------------------------------------------------- */
+static void convolve(int n_threads) {
+    int L = padded;
+    fft_rows(mesh, L, grid, -1, n_threads);
+    fft_transpose(mesh, L, n_threads);
+    fft_rows(mesh, L, L, -1, n_threads);
+
+    size_t n = (size_t)L * L;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) num_threads(n_threads)
+#endif
+    for (size_t j = 0; j < n; j++) {
+        double ar = mesh[2 * j], ai = mesh[2 * j + 1];
+        double br = kernel[2 * j], bi = kernel[2 * j + 1];
+        mesh[2 * j]     = ar * br - ai * bi;
+        mesh[2 * j + 1] = ar * bi + ai * br;
+    }
+
+    fft_rows(mesh, L, L, 1, n_threads);
+    fft_transpose(mesh, L, n_threads);
+    fft_rows(mesh, L, grid, 1, n_threads);
+}
+
+/** Gather each particle's acceleration with its cloud-in-cell weights.
+ * ----------------------------------------------------------------- */
+static void interpolate(ParticleSystem* sys, int force_store,
+                        int n_threads) {
+    int L = padded;
+    double G_val = G_FACTOR / sys->N;
+    double inv_cell = 1.0 / cell;
+#ifdef _OPENMP
+#pragma omp parallel for schedule(static) num_threads(n_threads)
+#else
+    (void)n_threads;
+#endif
+    for (int i = 0; i < sys->N; i++) {
+        double wx, wy;
+        int ix = cic((sys->pos_x[i] - LB) * inv_cell, &wx);
+        int iy = cic((sys->pos_y[i] - DB) * inv_cell, &wy);
+        const double* row0 = mesh + 2 * ((size_t)iy * L + ix);
+        const double* row1 = row0 + 2 * (size_t)L;
+        double w00 = (1.0 - wx) * (1.0 - wy), w10 = wx * (1.0 - wy);
+        double w01 = (1.0 - wx) * wy,         w11 = wx * wy;
+        double ax = w00 * row0[0] + w10 * row0[2] + w01 * row1[0] + w11 * row1[2];
+        double ay = w00 * row0[1] + w10 * row0[3] + w01 * row1[1] + w11 * row1[3];
+        double gm = G_val * sink_mass(sys, force_store, i);
+        sys->fx[i] = gm * ax;
+        sys->fy[i] = gm * ay;
+    }
+}
@@ -0,0 +1,25 @@
+#ifndef PM_H
+#define PM_H
+
+#include "types.h"
+#include <math.h>
+#include <stdint.h>
+
+// Fraction of the softened force at distance r kept by the short-range
+// (tree) side of a Gaussian split with scale r_split:
+// erfc(u) + 2u / sqrt(pi) exp(-u^2), u = r / (2 r_split). The mesh
+// carries the remaining 1 - S(r).
+static inline double pm_short_factor(double r, double r_split) {
+    double u = r / (2.0 * r_split);
+    return erfc(u) + 1.1283791670955126 * u * exp(-u * u);
+}
+
+// Write into sys->fx/fy the long-range forces (or accelerations, per
+// force_store) of the split on a grid_size mesh covering the square
+// [LB, RB] x [DB, UB]. Particles must be sorted by the Morton codes
+// (N entries) of that square.
+void pm_long_range(ParticleSystem* sys, const uint64_t* codes, double LB,
+                   double RB, double DB, double UB, int grid_size,
+                   double r_split, int force_store, int n_threads);
+
+#endif
@@ -0,0 +1,112 @@
+"""
+Parameter sweeps of nbody_simulate, saved under data/metrics/.
+
+  leaf:      --leaf of the linear tree at N=100,000, theta 0.5, 10 steps
+  multipole: monopole vs quadrupole cells for theta 0.2-1.0; time at
+             N=100,000 over 5 steps, error against naive at N=2,000 over
+             200 steps
+
+Every row comes from one run on 1 thread. Its runtime and phase times are
+read from that run's summary and cover the same timed steps. Inputs are
+generated with fixed seeds.
+"""
+
+import json
+import math
+import os
+import random
+import re
+import struct
+import subprocess
+import sys
+
+import generate_data
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+METRICS_DIR = os.path.join(ROOT, "data", "metrics")
+
+DT = 1e-5
+LEAF_SIZES = [1, 2, 4, 8, 16, 32, 64]
+THETAS = [0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+MULTIPOLES = ["monopole", "quadrupole"]
+
+
+def input_path(n):
+    """Generate the disk of n bodies once, from a fixed seed."""
+    path = os.path.join(ROOT, "data", "inputs", f"sweep_disk_{n}.gal")
+    if not os.path.exists(path):
+        random.seed(n)
+        generate_data.generate_disk(n, path)
+    return path
+
+
+def run(binary, version, n, nsteps, theta, options):
+    """Run once on 1 thread and return its timings and result path."""
+    cmd = [binary, str(version), str(n), input_path(n), str(nsteps), str(DT),
+           "1", str(theta)] + options
+    out = subprocess.run(cmd, cwd=ROOT, check=True, capture_output=True,
+                         text=True).stdout
+    row = {"runtime": float(re.search(r"Simulation Complete: ([\d.]+)s", out)[1])}
+    for phase in ("order", "tree", "force"):
+        m = re.search(rf"{phase} ([\d.]+)s", out)
+        row[f"{phase}_time"] = float(m[1]) if m else 0.0
+    label = "naive" if version == 1 else "barnes_hut"
+    return row, os.path.join(ROOT, "data", "outputs", f"result_{label}.gal")
+
+
+def read_positions(path):
+    """Final positions keyed by mass, which survives Morton reordering."""
+    with open(path, "rb") as f:
+        data = f.read()
+    return {m: (x, y) for x, y, m, _, _ in struct.iter_unpack("5d", data)}
+
+
+def position_error(path, reference):
+    got = read_positions(path)
+    diffs = [math.hypot(x - rx, y - ry)
+             for m, (rx, ry) in reference.items() for x, y in [got[m]]]
+    return max(diffs), sum(diffs) / len(diffs)
+
+
+def sweep_leaf(binary):
+    n = 100000
+    rows = []
+    for leaf in LEAF_SIZES:
+        row, _ = run(binary, 2, n, 10, 0.5,
+                     ["--build=linear", f"--leaf={leaf}"])
+        rows.append(dict(row, leaf_size=leaf, N=n, theta=0.5))
+        print(f"leaf={leaf}: {row}")
+    return rows
+
+
+def sweep_multipole(binary):
+    n, n_acc = 100000, 2000
+    _, path = run(binary, 1, n_acc, 200, 0.0, [])
+    reference = read_positions(path)
+    rows = []
+    for theta in THETAS:
+        for multipole in MULTIPOLES:
+            options = [f"--multipole={multipole}"]
+            _, path = run(binary, 2, n_acc, 200, theta, options)
+            max_diff, mean_diff = position_error(path, reference)
+            row, _ = run(binary, 2, n, 5, theta, options)
+            rows.append(dict(row, theta=theta, multipole=multipole,
+                             max_diff=float(f"{max_diff:.4g}"),
+                             mean_diff=float(f"{mean_diff:.4g}"), N=n))
+            print(f"theta={theta} {multipole}: {rows[-1]}")
+    return rows
+
+
+SWEEPS = {"leaf": sweep_leaf, "multipole": sweep_multipole}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in SWEEPS:
+        print("Usage: python3 sweep.py leaf|multipole [path/to/nbody_simulate]")
+        sys.exit(1)
+    binary = os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 else \
+        os.path.join(ROOT, "build", "nbody_simulate")
+    rows = SWEEPS[sys.argv[1]](binary)
+    with open(os.path.join(METRICS_DIR, f"sweep_{sys.argv[1]}.json"), "w") as f:
+        json.dump(rows, f, indent=4)
+        f.write("\n")
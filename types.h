@@ -1,6 +1,8 @@
 #ifndef TYPES_H
 #define TYPES_H
 
+#define N_BACK_ARRAYS 6
+
 typedef struct {
     int N;
     double* pos_x;
@@ -8,15 +10,119 @@ typedef struct {
     double* mass;
     double* vx;
     double* vy;
-    double* fx;
+    double* step;  /* individual timestep; NULL unless block timesteps are on */
+    double* fx;    /* force, or acceleration under FORCE_STORE_ACCEL */
     double* fy;
+    /* Back buffers of pos_x .. step in the order above, NULL until the
+     * first reorder (and while the front array is NULL). Forces have
+     * none. Swapped with the front arrays by particles_permute(). */
+    double* back[N_BACK_ARRAYS];
 } ParticleSystem;
 
+/* Quadtree construction strategy for compute_force_barnes_hut */
+enum {
+    TREE_BUILD_SERIAL   = 0,  /* insert every particle from the root */
+    TREE_BUILD_PARALLEL = 1,  /* serial top levels, one subtree per task */
+    TREE_BUILD_LINEAR   = 2   /* flat tree from sorted Morton codes */
+};
+
+/* Sort used by z_order_sort */
+enum {
+    MORTON_SORT_QSORT = 0,  /* comparison sort, serial */
+    MORTON_SORT_RADIX = 1,  /* LSD radix sort, OpenMP parallel */
+    MORTON_SORT_INCREMENTAL = 2  /* fix up last step's order, else radix */
+};
+
+/* When internal-node mass and centre of mass are computed */
+enum {
+    TREE_COM_INSERT    = 0,  /* running average updated by every insert */
+    TREE_COM_BOTTOM_UP = 1   /* topology first, then one post-order pass */
+};
+
+/* What happens to the pointer tree between timesteps */
+enum {
+    TREE_REUSE_REBUILD = 0,  /* reorder and rebuild every step */
+    TREE_REUSE_REFIT   = 1   /* keep the topology, refit it until it drifts */
+};
+
+/* What the force engines write to sys->fx/fy */
+enum {
+    FORCE_STORE_FORCE = 0,  /* forces m_i a_i; every mass must be positive */
+    FORCE_STORE_ACCEL = 1   /* accelerations a_i; massless tracers allowed */
+};
+
+/* How integrate_split applies consecutive kicks that share forces */
+enum {
+    KICK_SEPARATE = 0,  /* one pass each, rounding as the original loop */
+    KICK_MERGED   = 1   /* summed into one pass */
+};
+
+/* Kernel for batched particle-body interactions (see kernels.h) */
+enum {
+    FORCE_KERNEL_SCALAR = 0,  /* reference loop, bit-identical results */
+    FORCE_KERNEL_SIMD   = 1,  /* OpenMP simd loop */
+    FORCE_KERNEL_AVX2   = 2,  /* AVX2 + FMA intrinsics, 4 lanes */
+    FORCE_KERNEL_AVX512 = 3   /* AVX-512 intrinsics, 8 lanes */
+};
+
+/* Pairs evaluated by the naive all-pairs pass */
+enum {
+    NAIVE_PAIRS_FULL      = 0,  /* every (i, j), bit-identical reference */
+    NAIVE_PAIRS_SYMMETRIC = 1   /* each pair once, reaction applied to j */
+};
+
+/* Expansion order of accepted cells in the pointer walk */
+enum {
+    MULTIPOLE_MONOPOLE   = 0,  /* mass at the centre of mass */
+    MULTIPOLE_QUADRUPOLE = 1   /* plus the traceless quadrupole moment */
+};
+
+/* Node layout walked by the force loop of the pointer-tree builds */
+enum {
+    TREE_WALK_POINTER = 0,  /* TNode tree with child pointers */
+    TREE_WALK_PACKED  = 1,  /* depth-first PackedNode copy, stackless */
+    TREE_WALK_SOA     = 2,  /* depth-first WalkView arrays, stackless */
+    TREE_WALK_GROUP   = 3,  /* WalkView walked once per particle group */
+    TREE_WALK_DUAL    = 4   /* cell-cell dual-tree traversal of TNodes */
+};
+
+/* Counters accumulated by the kernels over a run */
+typedef struct {
+    long long reorders;       /* Morton reorders */
+    long long full_sorts;     /* reorders that needed a full sort */
+    long long ranks_changed;  /* particles that changed position, summed */
+    long long displaced;      /* particles re-inserted by incremental fixups */
+    long long refits;         /* steps that refitted the previous tree */
+    long long rebuilds;       /* steps that built a new tree in refit mode */
+    double order_time;        /* seconds in domain update and reordering */
+    double tree_time;         /* seconds building the tree */
+    double force_time;        /* seconds in the force walk */
+    double integrate_time;    /* seconds in the integrator's kicks and drifts */
+} KernelStats;
+
 typedef struct {
     double theta_max;
     int    n_threads;
     int    k_clusters;  /* 0 = use Morton ordering, >0 = use k-means clustering */
     double current_time;
+    int    tree_build;  /* TREE_BUILD_* */
+    int    morton_sort; /* MORTON_SORT_* */
+    int    tree_walk;   /* TREE_WALK_* */
+    int    tree_com;    /* TREE_COM_* */
+    int    tree_reuse;  /* TREE_REUSE_* */
+    int    leaf_size;   /* max particles per linear-tree leaf (<= 1: one) */
+    int    force_kernel; /* FORCE_KERNEL_* */
+    int    naive_pairs;  /* NAIVE_PAIRS_* */
+    int    multipole;    /* MULTIPOLE_* */
+    int    fmm_order;    /* expansion order of version 3 (<= 0: default) */
+    int    pm_grid;      /* mesh cells per side of version 4 and TreePM (<= 0: default) */
+    double pm_split;     /* TreePM split scale of version 2, in mesh cells (<= 0: off) */
+    int    max_rung;     /* block timestep levels below dt (0: one global step) */
+    double active_step;  /* with block timesteps, longest step needing forces */
+    int    force_store;  /* FORCE_STORE_* */
+    int    integrator;   /* index into INTEGRATORS of integrator.h */
+    int    kick_merge;   /* KICK_* */
+    KernelStats stats;
 } KernelConfig;
 
 #endif